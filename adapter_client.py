@@ -0,0 +1,262 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Metrics
+
+
+class AdapterClientError(Exception):
+    """Custom exception for adapter client errors."""
+
+
+class CircuitOpenError(AdapterClientError):
+    """Raised without calling the adapter while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for open_duration_in_s.
+    Then a single trial call is let through (half-open): success closes the breaker, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, open_duration_in_s):
+        self.failure_threshold = failure_threshold
+        self.open_duration_in_s = open_duration_in_s
+        self._state = CircuitBreaker.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == CircuitBreaker.OPEN and time.monotonic() - self._opened_at >= self.open_duration_in_s:
+                return CircuitBreaker.HALF_OPEN
+            return self._state
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.OPEN and time.monotonic() - self._opened_at >= self.open_duration_in_s:
+                self._state = CircuitBreaker.HALF_OPEN
+            if self._state == CircuitBreaker.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Frees the half-open trial slot of a call that ended without a success or failure, e.g. on a bug."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == CircuitBreaker.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != CircuitBreaker.OPEN:
+                    self.times_opened += 1
+                    logging.getLogger(CircuitBreaker.__name__).warning(
+                        f"Adapter circuit breaker opened after {self._consecutive_failures} consecutive failures")
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of the calls, so retries cannot multiply the load on a struggling adapter.
+    Every call deposits ratio tokens, every retry withdraws one.
+    """
+
+    def __init__(self, ratio, min_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = min_tokens
+        self._tokens = min_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    @property
+    def tokens(self):
+        with self._lock:
+            return self._tokens
+
+
+class AdapterClient:
+    """
+    HTTP client for the formula data adapter shared by all requests of a process.
+    Reuses pooled keep-alive connections, applies (connect, read) timeouts to every call,
+    retries idempotent calls within a retry budget and fails fast while the circuit breaker is open.
+    """
+
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(self, pool_size=32, connect_timeout_in_s=1.0, read_timeout_in_s=5.0, max_retries=2,
+                 retry_budget_ratio=0.2, backoff_in_s=0.05, breaker_failure_threshold=5, breaker_open_in_s=30.0):
+        self.timeout = (connect_timeout_in_s, read_timeout_in_s)
+        self.max_retries = max_retries
+        self.backoff_in_s = backoff_in_s
+        self.pool_size = pool_size
+        self.retry_budget = RetryBudget(retry_budget_ratio)
+        self.circuit_breaker = CircuitBreaker(breaker_failure_threshold, breaker_open_in_s)
+
+        self.session = requests.Session()
+        # retries are done here, within the budget, not by urllib3
+        http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+        self.session.mount('http://', http_adapter)
+        self.session.mount('https://', http_adapter)
+        self._http_adapter = http_adapter
+
+        self._stats_lock = threading.Lock()
+        self._calls = 0
+        self._retries = 0
+        self._failures = 0
+        self._retries_denied = 0
+
+    @staticmethod
+    def from_config(app_config):
+        return AdapterClient(pool_size=app_config.adapter_pool_size,
+                             connect_timeout_in_s=app_config.adapter_connect_timeout_in_s,
+                             read_timeout_in_s=app_config.adapter_read_timeout_in_s,
+                             max_retries=app_config.adapter_max_retries,
+                             retry_budget_ratio=app_config.adapter_retry_budget_ratio,
+                             breaker_failure_threshold=app_config.adapter_breaker_failure_threshold,
+                             breaker_open_in_s=app_config.adapter_breaker_open_in_s)
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, url, endpoint='other'):
+        return self._timed_call('GET', url, endpoint, retry=True)
+
+    def post(self, url, json=None, idempotent=False, endpoint='other'):
+        # only read-only POSTs (batch fetches) may be retried
+        return self._timed_call('POST', url, endpoint, retry=idempotent, json=json)
+
+    def _timed_call(self, method, url, endpoint, retry, **kwargs):
+        # endpoint names the route for metrics, the url itself contains user ids
+        started_at = time.perf_counter()
+        outcome = 'exception'
+        try:
+            response = self._call(method, url, retry, **kwargs)
+            outcome = 'success' if response.status_code < 400 else f'status_{response.status_code}'
+            return response
+        except CircuitOpenError:
+            outcome = 'circuit_open'
+            raise
+        finally:
+            Metrics.observe_adapter_call(method, endpoint, outcome, time.perf_counter() - started_at)
+
+    def _call(self, method, url, retry, **kwargs):
+        self._count('_calls')
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not self.circuit_breaker.allow_request():
+                raise CircuitOpenError(f"Adapter circuit breaker is open, not calling {method} {url}")
+            outcome_recorded = False
+            try:
+                try:
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                except requests.RequestException as e:
+                    self.circuit_breaker.record_failure()
+                    outcome_recorded = True
+                    self._count('_failures')
+                    if not self._may_retry(retry, attempt):
+                        raise AdapterClientError(f"{method} {url} failed: {e}") from e
+                else:
+                    if response.status_code not in AdapterClient.RETRY_STATUS_CODES:
+                        # 4xx are caller errors, the adapter itself is healthy
+                        self.circuit_breaker.record_success()
+                        outcome_recorded = True
+                        return response
+                    self.circuit_breaker.record_failure()
+                    outcome_recorded = True
+                    self._count('_failures')
+                    if not self._may_retry(retry, attempt):
+                        return response
+                    response.close()
+            finally:
+                # any other exception would otherwise leave a half-open breaker waiting for its trial forever
+                if not outcome_recorded:
+                    self.circuit_breaker.release_trial()
+
+            attempt += 1
+            self._count('_retries')
+            time.sleep(self.backoff_in_s * (2 ** (attempt - 1)) * (0.5 + random.random()))
+
+    def _may_retry(self, retry, attempt):
+        if not retry or attempt >= self.max_retries:
+            return False
+        if not self.retry_budget.try_withdraw():
+            self._count('_retries_denied')
+            return False
+        return True
+
+    def _pool_stats(self):
+        # urllib3 exposes no pool statistics API, so the numbers are best effort and left out when unavailable
+        pools = []
+        pool_manager = self._http_adapter.poolmanager
+        for pool_key in pool_manager.pools.keys():
+            try:
+                pool = pool_manager.pools[pool_key]
+                queued = list(pool.pool.queue) if pool.pool is not None else []
+                pools.append({
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "max_connections": self.pool_size,
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    # the queue is pre-filled with None placeholders for connections not opened yet
+                    "idle_connections": sum(1 for connection in queued if connection is not None),
+                })
+            except (KeyError, AttributeError) as e:
+                # evicted meanwhile, or a urllib3 version with a different pool layout
+                logging.getLogger(AdapterClient.__name__).debug(f"No statistics for adapter pool {pool_key}: {e}")
+        return pools
+
+    def stats(self):
+        with self._stats_lock:
+            calls, retries, failures, retries_denied = self._calls, self._retries, self._failures, self._retries_denied
+        return {
+            "calls": calls,
+            "retries": retries,
+            "retries_denied": retries_denied,
+            "failures": failures,
+            "retry_budget_tokens": round(self.retry_budget.tokens, 2),
+            "circuit_breaker": {
+                "state": self.circuit_breaker.state,
+                "times_opened": self.circuit_breaker.times_opened,
+                "rejected": self.circuit_breaker.rejected,
+            },
+            "pool_size": self.pool_size,
+            "pools": self._pool_stats(),
+        }
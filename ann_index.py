@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class AnnIndexError(Exception):
+    """Custom exception for approximate nearest neighbour index errors."""
+
+
+class InnerProductIndex:
+    """
+    Clustered (IVF) index for maximum inner product search, in NumPy.
+    Vectors are grouped by k-means into n_lists lists; a query scores only the lists whose upper bound
+    q.c + |q| * radius is highest, so the work grows with n_probe instead of with the number of vectors.
+    Probing every list returns the exact result.
+    """
+
+    def __init__(self, centroids, radii, list_indptr, list_ids):
+        self.centroids = np.asarray(centroids)
+        self.radii = np.asarray(radii)
+        # CSR layout of list -> vector ids
+        self.list_indptr = np.asarray(list_indptr)
+        self.list_ids = np.asarray(list_ids)
+
+    @property
+    def n_lists(self):
+        return len(self.radii)
+
+    @staticmethod
+    def build(vectors, n_lists=0, iterations=10, sample_size=50_000, seed=42):
+        """Clusters vectors into n_lists lists (0 = sqrt of the number of vectors) with a few rounds of k-means."""
+        vectors = np.asarray(vectors, dtype=np.float64)
+        n_vectors = len(vectors)
+        if n_vectors == 0:
+            raise AnnIndexError("Cannot build an index over zero vectors")
+        if n_lists <= 0:
+            n_lists = int(round(np.sqrt(n_vectors)))
+        n_lists = max(1, min(n_lists, n_vectors))
+
+        rng = np.random.default_rng(seed)
+        # the centroids are fitted on a sample, every vector is assigned afterwards
+        sample = vectors[rng.choice(n_vectors, size=min(sample_size, n_vectors), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = InnerProductIndex._nearest(sample, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+        assignment = InnerProductIndex._nearest(vectors, centroids)
+        radii = np.zeros(n_lists)
+        np.maximum.at(radii, assignment, np.linalg.norm(vectors - centroids[assignment], axis=1))
+        list_indptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_indptr[1:])
+        list_ids = np.argsort(assignment, kind='stable')
+        return InnerProductIndex(centroids, radii, list_indptr, list_ids)
+
+    @staticmethod
+    def _nearest(vectors, centroids, block_size=8192):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            # |v - c|^2 without the |v|^2 term, which does not change the argmin
+            assignment[start:start + block_size] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+        return assignment
+
+    def candidates(self, query, n_probe, min_candidates=0):
+        """
+        Ids of the vectors in the n_probe most promising lists for query, in list order;
+        further lists are probed until there are at least min_candidates ids.
+        """
+        query = np.asarray(query, dtype=np.float64)
+        bounds = self.centroids @ query + np.linalg.norm(query) * self.radii
+        order = np.argsort(-bounds, kind='stable')
+        enough = np.flatnonzero(np.cumsum(np.diff(self.list_indptr)[order]) >= min_candidates)
+        probed = max(min(n_probe, self.n_lists), enough[0] + 1 if len(enough) else self.n_lists)
+        return np.concatenate([self.list_ids[self.list_indptr[list_number]:self.list_indptr[list_number + 1]]
+                               for list_number in order[:probed]])
+
+    def artifact_arrays(self, prefix):
+        return {f"{prefix}centroids": self.centroids, f"{prefix}radii": self.radii,
+                f"{prefix}list_indptr": self.list_indptr, f"{prefix}list_ids": self.list_ids}
@@ -1,77 +1,441 @@
 # app_configuration.py
+import logging
 import os
+import threading
+import typing
+from functools import cached_property
+from types import MappingProxyType
+
 import yaml
 
+
+class AppConfigError(Exception):
+    """Custom exception for configuration errors."""
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
 class AppConfig:
-    def __init__(self):
-        self.config = {}
-        self.load_config()
+    """
+    Immutable, validated snapshot of application.yml. Use AppConfig.current(): the file is parsed once per process,
+    every setting is computed and type-checked when the snapshot is built and afterwards is a plain attribute read.
+    AppConfig.reload() and the file watcher swap in a new snapshot atomically; holders of the old one keep
+    a consistent view. Settings read per request (adapter URLs, batch sizes, knn-sparse) follow a reload,
+    pools, caches and the database engine are built once and need a restart.
+    """
+
+    DATA_SOURCES = ('postgres', 'csv')
+
+    _current = None
+    _lock = threading.Lock()
+    _watcher = None
+    _watcher_pid = None
+
+    def __init__(self, config=None, config_path=None):
+        config_path = config_path or os.environ.get('CONFIG_PATH', 'application.yml')
+        if config is None:
+            config = AppConfig._read(config_path)
+        object.__setattr__(self, 'config_path', config_path)
+        object.__setattr__(self, 'config', _freeze(config))
+        self._validate()
+
+    def __setattr__(self, name, value):
+        raise AppConfigError(f"Configuration is immutable, cannot set '{name}'")
 
-    def load_config(self):
-        config_path = os.environ.get('CONFIG_PATH', 'application.yml')
-        with open(config_path, 'r') as file:
-            self.config = yaml.safe_load(file)
+    @staticmethod
+    def _read(config_path):
+        try:
+            with open(config_path, 'r') as file:
+                config = yaml.safe_load(file)
+        except (OSError, yaml.YAMLError) as e:
+            raise AppConfigError(f"Cannot read configuration {config_path}: {e}")
+        if not isinstance(config, dict) or not isinstance(config.get('service-configuration'), dict):
+            raise AppConfigError(f"Configuration {config_path} has no 'service-configuration' section")
+        return config
 
-    @property
-    def postgres_url(self):
+    @staticmethod
+    def _settings():
+        return [name for name, value in vars(AppConfig).items() if isinstance(value, cached_property)]
+
+    def _validate(self):
+        errors = []
+        for name in AppConfig._settings():
+            expected_type = typing.get_type_hints(getattr(AppConfig, name).func)['return']
+            try:
+                # evaluating every setting caches it, so later reads do not walk the YAML tree
+                value = getattr(self, name)
+            except (KeyError, TypeError, AttributeError) as e:
+                errors.append(f"{name}: missing setting {e}")
+                continue
+            if expected_type is float:
+                valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            elif expected_type is int:
+                valid = isinstance(value, int) and not isinstance(value, bool)
+            else:
+                valid = isinstance(value, expected_type)
+            if not valid:
+                errors.append(f"{name}: expected {expected_type.__name__}, got {value!r}")
+
+        if not errors and self.data_source not in AppConfig.DATA_SOURCES:
+            errors.append(f"data_source: expected one of {AppConfig.DATA_SOURCES}, got {self.data_source!r}")
+        if errors:
+            raise AppConfigError(f"Invalid configuration {self.config_path}: " + "; ".join(errors))
+
+    @staticmethod
+    def current():
+        """The process-wide configuration, loaded on first use."""
+        config = AppConfig._current
+        if config is None:
+            with AppConfig._lock:
+                if AppConfig._current is None:
+                    AppConfig._current = AppConfig()
+                config = AppConfig._current
+        if AppConfig._watcher is not None and AppConfig._watcher_pid != os.getpid():
+            # the watcher thread of a parent process does not survive a fork
+            AppConfig.watch(AppConfig._watcher.interval_in_s)
+        return config
+
+    @staticmethod
+    def reload():
+        """Re-reads the configuration file and swaps it in; on an invalid file the current configuration stays."""
+        config = AppConfig(config_path=AppConfig.current().config_path)
+        AppConfig._current = config
+        logging.getLogger(AppConfig.__name__).info(f"Reloaded configuration from {config.config_path}")
+        return config
+
+    @staticmethod
+    def watch(interval_in_s):
+        """Reloads the configuration whenever its file changes, checked every interval_in_s seconds."""
+        with AppConfig._lock:
+            if AppConfig._watcher is not None and AppConfig._watcher_pid == os.getpid() and AppConfig._watcher.is_alive():
+                return
+            AppConfig._watcher = ConfigFileWatcher(interval_in_s)
+            AppConfig._watcher_pid = os.getpid()
+            AppConfig._watcher.start()
+
+
+    @cached_property
+    def postgres_url(self) -> str:
         return self.config['service-configuration']['data-layer']['postgres']['url']
 
-    @property
-    def postgres_schema(self):
+    @cached_property
+    def postgres_schema(self) -> str:
         return self.config['service-configuration']['data-layer']['postgres']['schema']
 
-    @property
-    def postgres_table(self):
+    @cached_property
+    def postgres_table(self) -> str:
         return self.config['service-configuration']['data-layer']['postgres']['table']
 
-    @property
-    def csv_path(self):
+    @cached_property
+    def csv_path(self) -> str:
         return self.config['service-configuration']['data-layer']['csv']['path_to_file']
 
-    @property
-    def http_port(self):
+    @cached_property
+    def http_port(self) -> int:
         return self.config['service-configuration']['http']['port']
 
-    @property
-    def a_formula_data_url(self):
+    @cached_property
+    def a_formula_data_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['a-formula-data-url']
 
-    @property
-    def r_formula_data_url(self):
+    @cached_property
+    def r_formula_data_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['r-formula-data-url']
 
-    @property
-    def post_rating_formula_data_url(self):
+    @cached_property
+    def post_rating_formula_data_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['post-rating-formula-data-url']
 
-    @property
-    def karma_formula_data_url(self):
+    @cached_property
+    def karma_formula_data_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['karma-formula-data-url']
 
-    @property
-    def karma_level_formula_data_url(self):
+    @cached_property
+    def karma_level_formula_data_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['karma-level-formula-data-url']
 
-    @property
-    def update_userinfo_url(self):
+    @cached_property
+    def update_userinfo_url(self) -> str:
         return self.config['service-configuration']['data-layer']['adapter']['update-user-values-url']
 
-    @property
-    def trainset_cache_time(self):
+    @cached_property
+    def a_formula_data_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['a-formula-data-batch-url']
+
+    @cached_property
+    def r_formula_data_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['r-formula-data-batch-url']
+
+    @cached_property
+    def post_rating_formula_data_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['post-rating-formula-data-batch-url']
+
+    @cached_property
+    def karma_formula_data_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['karma-formula-data-batch-url']
+
+    @cached_property
+    def karma_level_formula_data_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['karma-level-formula-data-batch-url']
+
+    @cached_property
+    def update_userinfo_batch_url(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter']['update-user-values-batch-url']
+
+    @cached_property
+    def adapter_fetch_batch_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('fetch-batch-size', 500)
+
+    @cached_property
+    def adapter_update_batch_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('update-batch-size', 200)
+
+    @cached_property
+    def adapter_fetch_workers(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('fetch-workers', 16)
+
+    @cached_property
+    def adapter_pool_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('pool-size', 32)
+
+    @cached_property
+    def adapter_connect_timeout_in_s(self) -> float:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('connect-timeout-in-s', 1.0)
+
+    @cached_property
+    def adapter_read_timeout_in_s(self) -> float:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('read-timeout-in-s', 5.0)
+
+    @cached_property
+    def adapter_max_retries(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('max-retries', 2)
+
+    @cached_property
+    def adapter_retry_budget_ratio(self) -> float:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('retry-budget-ratio', 0.2)
+
+    @cached_property
+    def adapter_breaker_failure_threshold(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('breaker-failure-threshold', 5)
+
+    @cached_property
+    def adapter_breaker_open_in_s(self) -> float:
+        return self.config['service-configuration']['data-layer']['adapter'].get('client', {}).get('breaker-open-in-s', 30)
+
+    @cached_property
+    def write_behind_enabled(self) -> bool:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('enabled', False)
+
+    @cached_property
+    def write_behind_max_queue_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('max-queue-size', 10000)
+
+    @cached_property
+    def write_behind_batch_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('batch-size', 200)
+
+    @cached_property
+    def write_behind_flush_interval_in_s(self) -> float:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('flush-interval-in-s', 1.0)
+
+    @cached_property
+    def write_behind_max_retries(self) -> int:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('max-retries', 3)
+
+    @cached_property
+    def write_behind_spill_file(self) -> str:
+        return self.config['service-configuration']['data-layer']['adapter'].get('write-behind', {}).get('spill-file', './update-queue.spill.jsonl')
+
+    @cached_property
+    def trainset_cache_time(self) -> float:
         return self.config['service-configuration']['cache']['trainset']
 
-    @property
-    def engine_pool_size(self):
+    @cached_property
+    def model_cache_max_size(self) -> int:
+        return self.config['service-configuration']['cache'].get('max-models', 16)
+
+    @cached_property
+    def retrain_interval_in_s(self) -> float:
+        return self.config['service-configuration']['cache'].get('retrain-interval-in-s', 0)
+
+    @cached_property
+    def formula_inputs_ttl_in_s(self) -> float:
+        return self.config['service-configuration']['cache'].get('formula-inputs-ttl-in-s', 0)
+
+    @cached_property
+    def formula_inputs_max_entries(self) -> int:
+        return self.config['service-configuration']['cache'].get('formula-inputs-max-entries', 500000)
+
+    @cached_property
+    def engine_pool_size(self) -> int:
         return self.config['service-configuration']['data-layer']['postgres']['sql-engine']['pool-size']
 
 
-    @property
-    def engine_pool_timeout_in_s(self):
+    @cached_property
+    def engine_pool_timeout_in_s(self) -> float:
         return self.config['service-configuration']['data-layer']['postgres']['sql-engine']['pool-timeout-in-s']
 
-    @property
-    def engine_pool_recycle_in_s(self):
+    @cached_property
+    def engine_pool_recycle_in_s(self) -> float:
         return self.config['service-configuration']['data-layer']['postgres']['sql-engine']['pool-recycle-in-s']
 
+    @cached_property
+    def postgres_id_column(self) -> str:
+        return self.config['service-configuration']['data-layer']['postgres'].get('incremental-load', {}).get('id-column', 'id')
+
+    @cached_property
+    def incremental_load_enabled(self) -> bool:
+        return self.config['service-configuration']['data-layer']['postgres'].get('incremental-load', {}).get('enabled', False)
+
+    @cached_property
+    def full_reload_interval_in_s(self) -> float:
+        return self.config['service-configuration']['data-layer']['postgres'].get('incremental-load', {}).get('full-reload-interval-in-s', 86400)
+
+    @cached_property
+    def load_chunk_size(self) -> int:
+        return self.config['service-configuration']['data-layer']['postgres'].get('load-chunk-size', 50000)
+
+    @cached_property
+    def data_source(self) -> str:
+        return self.config['service-configuration']['data-layer'].get('source', 'postgres')
+
+    @cached_property
+    def model_store_enabled(self) -> bool:
+        return self.config['service-configuration'].get('model-store', {}).get('enabled', False)
+
+    @cached_property
+    def model_store_directory(self) -> str:
+        return self.config['service-configuration'].get('model-store', {}).get('directory', './model-store')
+
+    @cached_property
+    def sparse_knn_neighbors(self) -> int:
+        return self.config['service-configuration'].get('knn-sparse', {}).get('neighbors', 200)
+
+    @cached_property
+    def sparse_knn_block_size(self) -> int:
+        return self.config['service-configuration'].get('knn-sparse', {}).get('block-size', 1024)
+
+    @cached_property
+    def ann_enabled(self) -> bool:
+        return self.config['service-configuration'].get('ann', {}).get('enabled', False)
+
+    @cached_property
+    def ann_n_lists(self) -> int:
+        return self.config['service-configuration'].get('ann', {}).get('n-lists', 0)
+
+    @cached_property
+    def ann_n_probe(self) -> int:
+        return self.config['service-configuration'].get('ann', {}).get('n-probe', 16)
+
+    @cached_property
+    def config_reload_interval_in_s(self) -> float:
+        return self.config['service-configuration'].get('config-reload-interval-in-s', 0)
+
+
+    @cached_property
+    def startup_warmup(self) -> bool:
+        return self.config['service-configuration'].get('startup', {}).get('warmup', True)
+
+    @cached_property
+    def startup_warm_connections(self) -> int:
+        return self.config['service-configuration'].get('startup', {}).get('warm-connections', 1)
+
+    @cached_property
+    def startup_preload_models(self) -> tuple:
+        return tuple(self.config['service-configuration'].get('startup', {}).get('preload-models', ()))
+
+    @cached_property
+    def recommend_batch_chunk_size(self) -> int:
+        return self.config['service-configuration'].get('recommend-batch', {}).get('chunk-size', 256)
+
+    @cached_property
+    def recommend_batch_max_users(self) -> int:
+        return self.config['service-configuration'].get('recommend-batch', {}).get('max-users', 100000)
+
+    @cached_property
+    def precompute_serving_enabled(self) -> bool:
+        return self.config['service-configuration'].get('precompute', {}).get('serving', False)
+
+    @cached_property
+    def precompute_directory(self) -> str:
+        return self.config['service-configuration'].get('precompute', {}).get('directory', './precomputed')
+
+    @cached_property
+    def precompute_top_n(self) -> int:
+        return self.config['service-configuration'].get('precompute', {}).get('top-n', 50)
+
+    @cached_property
+    def precompute_max_age_in_s(self) -> float:
+        return self.config['service-configuration'].get('precompute', {}).get('max-age-in-s', 86400)
+
+    @cached_property
+    def precompute_workers(self) -> int:
+        return self.config['service-configuration'].get('precompute', {}).get('workers', os.cpu_count() or 1)
+
+    @cached_property
+    def precompute_chunk_size(self) -> int:
+        return self.config['service-configuration'].get('precompute', {}).get('chunk-size', 512)
+
+    @cached_property
+    def metrics_enabled(self) -> bool:
+        return self.config['service-configuration'].get('metrics', {}).get('enabled', True)
+
+    @cached_property
+    def profiling_enabled(self) -> bool:
+        return self.config['service-configuration'].get('profiling', {}).get('enabled', False)
+
+    @cached_property
+    def profiling_sample_rate(self) -> float:
+        return self.config['service-configuration'].get('profiling', {}).get('sample-rate', 0.0)
+
+    @cached_property
+    def profiling_header(self) -> str:
+        return self.config['service-configuration'].get('profiling', {}).get('header', 'X-Profile-Request')
+
+    @cached_property
+    def profiling_token(self) -> str:
+        return self.config['service-configuration'].get('profiling', {}).get('token', '')
+
+    @cached_property
+    def profiling_directory(self) -> str:
+        return self.config['service-configuration'].get('profiling', {}).get('directory', './profiles')
+
+    @cached_property
+    def profiling_max_profiles(self) -> int:
+        return self.config['service-configuration'].get('profiling', {}).get('max-profiles', 50)
+
+
+class ConfigFileWatcher(threading.Thread):
+    def __init__(self, interval_in_s):
+        super().__init__(name=ConfigFileWatcher.__name__, daemon=True)
+        self.interval_in_s = interval_in_s
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _signature(config_path):
+        try:
+            stat = os.stat(config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
+    def stop(self):
+        self._stop_event.set()
 
+    def run(self):
+        signature = self._signature(AppConfig.current().config_path)
+        while not self._stop_event.wait(self.interval_in_s):
+            new_signature = self._signature(AppConfig.current().config_path)
+            if new_signature is None or new_signature == signature:
+                continue
+            signature = new_signature
+            try:
+                AppConfig.reload()
+            except AppConfigError as e:
+                logging.getLogger(ConfigFileWatcher.__name__).error(f"Keeping the current configuration: {e}")
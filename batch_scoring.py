@@ -0,0 +1,342 @@
+import numpy as np
+from surprise import KNNBasic, SVD
+
+from ann_index import InnerProductIndex
+from ratings_snapshot import RatingsSnapshot
+from sparse_knn import SparseKNN
+
+
+class BatchScoringError(Exception):
+    """Custom exception for batch scoring errors."""
+
+
+class BatchScorer:
+    """
+    Scores many items for one user with NumPy instead of one algorithm.predict call per item.
+    Results match surprise's predict (including the default prediction and clipping to the rating scale).
+    """
+
+    KIND = None
+
+    def __init__(self, snapshot: RatingsSnapshot, global_mean, rating_scale):
+        # inner ids of the trained model are the snapshot codes
+        self.snapshot = snapshot
+        self.global_mean = float(global_mean)
+        self.rating_scale = tuple(rating_scale)
+
+    @staticmethod
+    def from_algorithm(algorithm, snapshot: RatingsSnapshot):
+        trainset = getattr(algorithm, 'trainset', None)
+        if trainset is not None and (trainset.n_users != snapshot.n_users or trainset.n_items != snapshot.n_items):
+            raise BatchScoringError("Algorithm must be trained on a trainset built from the given snapshot")
+        if isinstance(algorithm, SparseKNN):
+            return SparseKnnScorer.from_sparse_knn(algorithm, snapshot)
+        if isinstance(algorithm, SVD):
+            return SvdScorer.from_svd(algorithm, snapshot)
+        if isinstance(algorithm, KNNBasic):
+            return KnnScorer.from_knn(algorithm, snapshot)
+        raise BatchScoringError(f"Batch scoring is not supported for {type(algorithm).__name__}")
+
+    @staticmethod
+    def from_artifact(kind, params, arrays, snapshot: RatingsSnapshot):
+        scorer_classes = {scorer_class.KIND: scorer_class for scorer_class in (SvdScorer, KnnScorer, SparseKnnScorer)}
+        if kind not in scorer_classes:
+            raise BatchScoringError(f"Unknown scorer kind '{kind}'")
+        return scorer_classes[kind](snapshot, **params, **arrays)
+
+    def artifact_params(self):
+        # JSON-serializable scalars, together with artifact_arrays enough to rebuild the scorer
+        return {"global_mean": self.global_mean, "rating_scale": list(self.rating_scale)}
+
+    def artifact_arrays(self):
+        return {}
+
+    @property
+    def n_items(self):
+        return self.snapshot.n_items
+
+    def to_inner_uid(self, raw_uid):
+        return self.snapshot.user_code(raw_uid)
+
+    def to_inner_iids(self, raw_iids):
+        # -1 marks items unknown to the trainset
+        return self.snapshot.item_codes_of(raw_iids)
+
+    def score(self, inner_uid, inner_iids):
+        inner_iids = np.asarray(inner_iids, dtype=np.intp)
+        known_items = inner_iids >= 0
+        scores = np.empty(len(inner_iids), dtype=np.float64)
+        scores[~known_items] = self._estimate_unknown_items(inner_uid)
+        scores[known_items] = self._estimate(inner_uid, inner_iids[known_items])
+        lower_bound, higher_bound = self.rating_scale
+        return np.clip(scores, lower_bound, higher_bound)
+
+    def score_raw(self, raw_uid, raw_iids):
+        return self.score(self.to_inner_uid(raw_uid), self.to_inner_iids(raw_iids))
+
+    def score_users(self, inner_uids):
+        """Scores of every item for each of inner_uids (None for unknown users), one row per user."""
+        all_items = np.arange(self.n_items)
+        scores = np.empty((len(inner_uids), self.n_items), dtype=np.float64)
+        for row, inner_uid in enumerate(inner_uids):
+            scores[row] = self.score(inner_uid, all_items)
+        return scores
+
+    def rated_mask(self, inner_uids):
+        """Boolean matrix marking the items each of inner_uids rated, the rows of score_users that are not candidates."""
+        snapshot = self.snapshot
+        codes = np.array([-1 if inner_uid is None else inner_uid for inner_uid in inner_uids], dtype=np.int64)
+        known = codes >= 0
+        starts = np.zeros(len(codes), dtype=np.int64)
+        counts = np.zeros(len(codes), dtype=np.int64)
+        starts[known] = snapshot.user_indptr[codes[known]]
+        counts[known] = snapshot.user_indptr[codes[known] + 1] - starts[known]
+        rows = np.repeat(np.arange(len(codes)), counts)
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+        mask = np.zeros((len(codes), self.n_items), dtype=bool)
+        mask[rows, snapshot.user_items[positions]] = True
+        return mask
+
+    def candidate_items(self, inner_uid, n, n_probe):
+        """Unrated items that likely hold the n best of inner_uid, from an approximate index; None to score them all."""
+        return None
+
+    def _estimate(self, inner_uid, inner_iids):
+        raise NotImplementedError
+
+    def _estimate_unknown_items(self, inner_uid):
+        return self.global_mean
+
+    @staticmethod
+    def top_n(scores, n):
+        """Indices of the n highest scores in descending order, ties broken by position, without a full sort."""
+        scores = np.asarray(scores)
+        if n >= len(scores):
+            return np.lexsort((np.arange(len(scores)), -scores))
+
+        threshold = np.partition(scores, len(scores) - n)[len(scores) - n]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:n - len(above)]
+        selected = np.concatenate([above, ties])
+        return selected[np.lexsort((selected, -scores[selected]))]
+
+    @staticmethod
+    def top_n_rows(scores, excluded, n):
+        """
+        top_n for every row of a score matrix at once, skipping the excluded cells.
+        Returns row numbers and column indices grouped by row, each row in descending score order with ties broken
+        by column like top_n, so row r yields the same items as top_n over its candidates alone.
+        The excluded cells of scores are overwritten with -inf, the returned cells keep their scores.
+        """
+        # in place: the partition below already needs a second matrix, a masked copy would be a third
+        np.copyto(scores, -np.inf, where=excluded)
+        n_columns = scores.shape[1]
+        if n < n_columns:
+            # a list index copies the column out, so the partitioned matrix is freed right away
+            threshold = np.partition(scores, n_columns - n, axis=1)[:, [n_columns - n]]
+            above = scores > threshold
+            ties = scores == threshold
+            # the lowest columns among the ties fill the places the higher scores left; the cumsum makes two
+            # int64 matrices, so it runs only on the rows whose ties do not all fit
+            missing = n - above.sum(axis=1)
+            selected = above | ties
+            crowded = np.flatnonzero(ties.sum(axis=1) > missing)
+            if len(crowded):
+                crowded_ties = ties[crowded]
+                selected[crowded] = above[crowded] | \
+                    (crowded_ties & (np.cumsum(crowded_ties, axis=1) <= missing[crowded, None]))
+        else:
+            selected = np.ones(scores.shape, dtype=bool)
+        selected &= ~excluded
+
+        rows, columns = np.nonzero(selected)
+        order = np.lexsort((columns, -scores[rows, columns], rows))
+        return rows[order], columns[order]
+
+
+class SvdScorer(BatchScorer):
+    KIND = 'SVD'
+
+    def __init__(self, snapshot: RatingsSnapshot, global_mean, rating_scale, biased, bu, bi, pu, qi,
+                 ann_centroids=None, ann_radii=None, ann_list_indptr=None, ann_list_ids=None):
+        super().__init__(snapshot, global_mean, rating_scale)
+        self.biased = bool(biased)
+        self.bu = np.asarray(bu)
+        self.bi = np.asarray(bi)
+        self.pu = np.asarray(pu)
+        self.qi = np.asarray(qi)
+        self.ann_index = None
+        if ann_centroids is not None:
+            self.ann_index = InnerProductIndex(ann_centroids, ann_radii, ann_list_indptr, ann_list_ids)
+
+    @staticmethod
+    def from_svd(algorithm, snapshot: RatingsSnapshot):
+        return SvdScorer(snapshot, algorithm.trainset.global_mean, algorithm.trainset.rating_scale, algorithm.biased,
+                         algorithm.bu, algorithm.bi, algorithm.pu, algorithm.qi)
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params["biased"] = self.biased
+        return params
+
+    def artifact_arrays(self):
+        arrays = {"bu": self.bu, "bi": self.bi, "pu": self.pu, "qi": self.qi}
+        if self.ann_index is not None:
+            arrays.update(self.ann_index.artifact_arrays('ann_'))
+        return arrays
+
+    def build_ann_index(self, n_lists=0, seed=42):
+        # with biases the ranked part bi + qi.pu is the inner product of [qi, bi] and [pu, 1], bu is shared by all items
+        item_vectors = np.column_stack([self.qi, self.bi]) if self.biased else self.qi
+        self.ann_index = InnerProductIndex.build(item_vectors, n_lists, seed=seed)
+        return self.ann_index
+
+    def candidate_items(self, inner_uid, n, n_probe):
+        if self.ann_index is None or inner_uid is None:
+            return None
+        query = np.append(self.pu[inner_uid], 1.0) if self.biased else self.pu[inner_uid]
+        rated = self.snapshot.items_rated_by(inner_uid)
+        # every rated item may sit in the probed lists, so enough lists are probed to leave n unrated ones
+        candidates = self.ann_index.candidates(query, n_probe, n + len(rated))
+        return np.sort(candidates[~np.isin(candidates, rated)])
+
+    def _estimate(self, inner_uid, inner_iids):
+        if not self.biased:
+            if inner_uid is None:
+                return np.full(len(inner_iids), self.global_mean)
+            return self.qi[inner_iids] @ self.pu[inner_uid]
+
+        est = self.global_mean + self.bi[inner_iids]
+        if inner_uid is not None:
+            est += self.bu[inner_uid] + self.qi[inner_iids] @ self.pu[inner_uid]
+        return est
+
+    def _estimate_unknown_items(self, inner_uid):
+        if self.biased and inner_uid is not None:
+            return self.global_mean + self.bu[inner_uid]
+        return self.global_mean
+
+    def score_users(self, inner_uids):
+        # one matrix product for all users instead of a product per user
+        known = np.array([inner_uid is not None for inner_uid in inner_uids], dtype=bool)
+        codes = np.array([inner_uid for inner_uid in inner_uids if inner_uid is not None], dtype=np.int64)
+        scores = np.empty((len(inner_uids), self.n_items), dtype=np.float64)
+        interactions = self.pu[codes] @ self.qi.T
+        if self.biased:
+            # the same grouping of the sum as _estimate
+            item_part = self.global_mean + self.bi
+            scores[known] = item_part + (self.bu[codes][:, None] + interactions)
+            scores[~known] = item_part
+        else:
+            scores[known] = interactions
+            scores[~known] = self.global_mean
+        lower_bound, higher_bound = self.rating_scale
+        return np.clip(scores, lower_bound, higher_bound, out=scores)
+
+
+class KnnScorer(BatchScorer):
+    KIND = 'KNN'
+
+    def __init__(self, snapshot: RatingsSnapshot, global_mean, rating_scale, k, min_k, sim,
+                 item_indptr, item_users, item_ratings):
+        super().__init__(snapshot, global_mean, rating_scale)
+        self.k = int(k)
+        self.min_k = int(min_k)
+        self.sim = np.asarray(sim)
+        self.item_indptr = np.asarray(item_indptr)
+        self.item_users = np.asarray(item_users)
+        self.item_ratings = np.asarray(item_ratings)
+
+    @staticmethod
+    def from_knn(algorithm, snapshot: RatingsSnapshot):
+        if not algorithm.sim_options.get("user_based", True):
+            raise BatchScoringError("Batch scoring supports only user based KNN")
+
+        return KnnScorer(snapshot, algorithm.trainset.global_mean, algorithm.trainset.rating_scale,
+                         algorithm.k, algorithm.min_k, algorithm.sim, *KnnScorer.item_raters(snapshot))
+
+    @staticmethod
+    def item_raters(snapshot: RatingsSnapshot):
+        # CSR layout of item -> (user, rating) in table order, the same order as trainset.ir,
+        # so ties resolve like heapq.nlargest
+        order = np.argsort(snapshot.item_codes, kind='stable')
+        item_indptr = np.zeros(snapshot.n_items + 1, dtype=np.int64)
+        np.cumsum(np.bincount(snapshot.item_codes, minlength=snapshot.n_items), out=item_indptr[1:])
+        return item_indptr, snapshot.user_codes[order], snapshot.ratings[order]
+
+    def _similarity_row(self, inner_uid):
+        return self.sim[inner_uid]
+
+    def artifact_params(self):
+        params = super().artifact_params()
+        params.update({"k": self.k, "min_k": self.min_k})
+        return params
+
+    def artifact_arrays(self):
+        return {"sim": self.sim, "item_indptr": self.item_indptr, "item_users": self.item_users,
+                "item_ratings": self.item_ratings}
+
+    def _estimate(self, inner_uid, inner_iids):
+        if inner_uid is None:
+            return np.full(len(inner_iids), self.global_mean)
+
+        starts = self.item_indptr[inner_iids]
+        counts = self.item_indptr[inner_iids + 1] - starts
+        total = int(counts.sum())
+        group_starts = np.cumsum(counts) - counts
+        groups = np.repeat(np.arange(len(inner_iids)), counts)
+        positions = np.repeat(starts - group_starts, counts) + np.arange(total)
+
+        sims = self._similarity_row(inner_uid)[self.item_users[positions]]
+        ratings = self.item_ratings[positions]
+
+        # keep the k most similar raters of every item; lexsort is stable like heapq.nlargest
+        in_top_k = np.ones(total, dtype=bool)
+        if total and counts.max() > self.k:
+            order = np.lexsort((-sims, groups))
+            ranks = np.arange(total) - np.repeat(group_starts, counts)
+            in_top_k[order] = ranks < self.k
+
+        weights = np.where(in_top_k & (sims > 0), sims, 0.0)
+        sum_sim = np.bincount(groups, weights=weights, minlength=len(inner_iids))
+        sum_ratings = np.bincount(groups, weights=weights * ratings, minlength=len(inner_iids))
+        actual_k = np.bincount(groups, weights=weights > 0, minlength=len(inner_iids))
+
+        est = np.full(len(inner_iids), self.global_mean)
+        enough_neighbors = actual_k >= self.min_k
+        np.divide(sum_ratings, sum_sim, out=est, where=enough_neighbors & (sum_sim > 0))
+        return est
+
+
+class SparseKnnScorer(KnnScorer):
+    KIND = 'KNN_SPARSE'
+
+    def __init__(self, snapshot: RatingsSnapshot, global_mean, rating_scale, k, min_k,
+                 neighbor_indptr, neighbor_ids, neighbor_sims, item_indptr, item_users, item_ratings):
+        BatchScorer.__init__(self, snapshot, global_mean, rating_scale)
+        self.k = int(k)
+        self.min_k = int(min_k)
+        self.neighbor_indptr = np.asarray(neighbor_indptr)
+        self.neighbor_ids = np.asarray(neighbor_ids)
+        self.neighbor_sims = np.asarray(neighbor_sims)
+        self.item_indptr = np.asarray(item_indptr)
+        self.item_users = np.asarray(item_users)
+        self.item_ratings = np.asarray(item_ratings)
+
+    @staticmethod
+    def from_sparse_knn(algorithm, snapshot: RatingsSnapshot):
+        return SparseKnnScorer(snapshot, algorithm.global_mean, algorithm.rating_scale, algorithm.k, algorithm.min_k,
+                               algorithm.neighbor_indptr, algorithm.neighbor_ids, algorithm.neighbor_sims,
+                               *KnnScorer.item_raters(snapshot))
+
+    def artifact_arrays(self):
+        return {"neighbor_indptr": self.neighbor_indptr, "neighbor_ids": self.neighbor_ids,
+                "neighbor_sims": self.neighbor_sims, "item_indptr": self.item_indptr,
+                "item_users": self.item_users, "item_ratings": self.item_ratings}
+
+    def _similarity_row(self, inner_uid):
+        # users outside the kept neighbors count as similarity 0, which KNNBasic never aggregates either
+        start, end = self.neighbor_indptr[inner_uid], self.neighbor_indptr[inner_uid + 1]
+        row = np.zeros(self.snapshot.n_users, dtype=np.float64)
+        row[self.neighbor_ids[start:end]] = self.neighbor_sims[start:end]
+        return row
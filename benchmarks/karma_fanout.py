@@ -0,0 +1,93 @@
+# benchmarks/karma_fanout.py
+"""
+Latency of FormulaService.calculate_for_user against the mock adapter, sequential vs concurrent adapter calls.
+
+Run from the repository root:
+    python benchmarks/karma_fanout.py --latency-ms 20 --requests 50
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from formula_service import FormulaService  # noqa: E402
+
+
+def start_mock_adapter(latency_in_s):
+    spec = importlib.util.spec_from_file_location(
+        'formula_data_adapter_service', os.path.join(ROOT, 'mock-server', 'formula_data_adapter_service.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.app.before_request(lambda: time.sleep(latency_in_s))
+    # the adapter answers many calls at once, like the real one
+    server = make_server('127.0.0.1', 0, module.app, threaded=True)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def point_to(formula_service, base_url):
+    formula_service.a_formula_data_url = base_url + '/v1/formula-data/a-formula/{user_id}'
+    formula_service.r_formula_data_url = base_url + '/v1/formula-data/r-formula/{user_id}'
+    formula_service.post_rating_formula_data_url = base_url + '/v1/formula-data/post-rating/{user_id}'
+    formula_service.karma_formula_data_url = base_url + '/v1/formula-data/karma-formula/{user_id}'
+    formula_service.karma_level_formula_data_url = base_url + '/v1/formula-data/karma-level/{user_id}'
+    formula_service.update_url = base_url + '/v1/update-info'
+    return formula_service
+
+
+def measure(base_url, n_requests):
+    latencies, results = [], set()
+    for user_id in range(n_requests):
+        started_at = time.perf_counter()
+        result = point_to(FormulaService(), base_url).calculate_for_user(user_id)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        results.add((result.karma_value, result.karma_lvl_value))
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 2),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "results": sorted(results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='delay the mock adapter adds to every call')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    # both runs fetch the same users, so the formula data cache would answer the second one without the adapter
+    FormulaService.input_cache = None
+    server, base_url = start_mock_adapter(args.latency_ms / 1000)
+    try:
+        shared_executor = FormulaService.fetch_executor
+        FormulaService.fetch_executor = None
+        sequential = measure(base_url, args.requests)
+        FormulaService.fetch_executor = shared_executor or ThreadPoolExecutor(max_workers=args.workers)
+        concurrent = measure(base_url, args.requests)
+    finally:
+        server.shutdown()
+
+    if sequential["results"] != concurrent["results"]:
+        raise SystemExit(f"Results differ: {sequential['results']} vs {concurrent['results']}")
+    print(json.dumps({"adapter_latency_ms": args.latency_ms, "requests": args.requests,
+                      "sequential": sequential, "concurrent": concurrent,
+                      "speedup_p50": round(sequential["p50_ms"] / concurrent["p50_ms"], 2)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
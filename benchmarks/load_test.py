@@ -0,0 +1,255 @@
+# benchmarks/load_test.py
+"""
+End-to-end load test of /v1/recommend and /v1/calculate-karma on a single Linux box.
+
+Starts the mock adapter (mock-server/formula_data_adapter_service.py) and the real service
+(by default `gunicorn -w 4 controller:app`) on a synthetic csv dataset, waits for /health/ready,
+then drives both endpoints with concurrent closed-loop clients spread over several processes.
+With several --adapter-latency-ms values the same load runs once per adapter latency, changed at runtime
+through the mock's /mock/faults, showing how the service degrades when the adapter slows down.
+Reports throughput, p50/p95/p99 latency and errors per endpoint and phase as JSON.
+
+Run from the repository root (gunicorn installed):
+    python benchmarks/load_test.py --clients 32 --duration 30 --adapter-latency-ms 0 20 100
+    python benchmarks/load_test.py --target http://127.0.0.1:5001 --mock-url http://127.0.0.1:5002 --users 30
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_ratings import generate_ratings, write_ratings_csv  # noqa: E402
+
+ENDPOINTS = {
+    'recommend': '/v1/recommend',
+    'karma': '/v1/calculate-karma',
+}
+
+
+def request_body(endpoint, user_id, args):
+    if endpoint == 'karma':
+        return {"user_id": user_id}
+    return {"user_id": user_id, "algo": args.algo, "user_column_name": "user_id", "item_column_name": "item_id",
+            "rating_column_name": "rating", "response_size": args.response_size}
+
+
+def client_loop(base_url, args, weights, started_at, deadline, records, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    endpoints = list(weights)
+    cumulative_weights = [sum(list(weights.values())[:position + 1]) for position in range(len(weights))]
+    while time.monotonic() < deadline:
+        endpoint = rng.choices(endpoints, cum_weights=cumulative_weights)[0]
+        body = request_body(endpoint, rng.randint(1, args.users), args)
+        request_started_at = time.monotonic()
+        try:
+            status = session.post(base_url + ENDPOINTS[endpoint], json=body, timeout=args.timeout).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        finished_at = time.monotonic()
+        if request_started_at >= started_at:
+            # requests of the warmup period are not counted
+            records.append((endpoint, status, finished_at - request_started_at, finished_at))
+
+
+def load_process(base_url, args, weights, clients, started_at, deadline, seed):
+    records = []
+    threads = [threading.Thread(target=client_loop,
+                                args=(base_url, args, weights, started_at, deadline, records, seed * 1000 + client))
+               for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+
+def summarize(records, duration_in_s):
+    summary = {}
+    for endpoint in sorted({record[0] for record in records}):
+        endpoint_records = [record for record in records if record[0] == endpoint]
+        latencies = sorted(record[2] * 1000 for record in endpoint_records)
+        errors = {}
+        for _, status, _, _ in endpoint_records:
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+        summary[endpoint] = {
+            "requests": len(endpoint_records),
+            "throughput_per_s": round(len(endpoint_records) / duration_in_s, 1),
+            "ok_per_s": round((len(endpoint_records) - sum(errors.values())) / duration_in_s, 1),
+            "errors": errors,
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "max_ms": round(latencies[-1], 2),
+        }
+    return summary
+
+
+def run_phase(base_url, args, weights):
+    # monotonic clocks are system-wide on Linux, so the child processes share the deadlines
+    started_at = time.monotonic() + args.warmup
+    deadline = started_at + args.duration
+    processes = max(1, min(args.processes, args.clients))
+    clients_per_process = [args.clients // processes + (1 if index < args.clients % processes else 0)
+                           for index in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        results = [pool.apply_async(load_process, (base_url, args, weights, clients, started_at, deadline, index))
+                   for index, clients in enumerate(clients_per_process)]
+        records = [record for result in results for record in result.get()]
+    return summarize(records, args.duration)
+
+
+def wait_until_ready(url, timeout_in_s, process=None):
+    deadline = time.monotonic() + timeout_in_s
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit(f"Process for {url} exited with code {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{url} not ready after {timeout_in_s}s")
+
+
+def write_service_config(work_dir, args, csv_path, adapter_url):
+    with open(os.path.join(ROOT, 'application.yml')) as config_file:
+        config = yaml.safe_load(config_file)
+    service_config = config['service-configuration']
+    data_layer = service_config['data-layer']
+    data_layer['source'] = 'csv'
+    data_layer['csv']['path_to_file'] = csv_path
+    for name, url in data_layer['adapter'].items():
+        if isinstance(url, str) and url.startswith('http'):
+            data_layer['adapter'][name] = adapter_url + '/' + url.split('/', 3)[3]
+    data_layer['adapter']['write-behind']['spill-file'] = os.path.join(work_dir, 'update-queue.spill.jsonl')
+    # one worker trains the preloaded model and the others attach it, like a production deployment
+    service_config['model-store']['enabled'] = True
+    service_config['model-store']['directory'] = os.path.join(work_dir, 'model-store')
+    service_config['http']['port'] = args.port
+    service_config['startup']['preload-models'] = [[args.algo, 'user_id', 'item_id', 'rating']]
+    service_config['config-reload-interval-in-s'] = 0
+    config_path = os.path.join(work_dir, 'application.yml')
+    with open(config_path, 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+    return config_path
+
+
+def start_environment(args, work_dir):
+    """Starts the mock adapter and the service, returns their base URLs and processes."""
+    csv_path = os.path.abspath(args.dataset) if args.dataset else os.path.join(work_dir, 'ratings.csv')
+    if not args.dataset:
+        write_ratings_csv(csv_path, *generate_ratings(args.users, args.items, args.density, seed=args.seed))
+
+    log_file = open(os.path.join(work_dir, 'processes.log'), 'w')
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mock-server', 'formula_data_adapter_service.py'),
+                             '--port', str(args.mock_port), '--quiet'], stdout=log_file, stderr=log_file)
+    processes = [mock]
+    wait_until_ready(mock_url + '/mock/faults', 30, mock)
+
+    environment = dict(os.environ, CONFIG_PATH=write_service_config(work_dir, args, csv_path, mock_url))
+    service = subprocess.Popen(shlex.split(args.server_command.format(port=args.port, workers=args.workers)),
+                               cwd=ROOT, env=environment, stdout=log_file, stderr=log_file)
+    processes.append(service)
+    target = f"http://127.0.0.1:{args.port}"
+    logging.getLogger('load_test').info(f"Waiting for {target}/health/ready, logs in {log_file.name}")
+    wait_until_ready(target + '/health/ready', args.startup_timeout, service)
+    return target, mock_url, processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help='base URL of a running service instead of starting one')
+    parser.add_argument('--mock-url', help='base URL of a running mock adapter, needed with --target to vary latency')
+    parser.add_argument('--server-command', default='gunicorn -w {workers} -b 127.0.0.1:{port} controller:app')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--mock-port', type=int, default=5102)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--dataset', help='user_id,item_id,rating CSV, default a generated one')
+    parser.add_argument('--users', type=int, default=5000, help='users of the generated dataset, user ids requested')
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--algo', default='SVD', choices=['KNN', 'SVD', 'KNN_SPARSE'])
+    parser.add_argument('--response-size', type=int, default=10)
+    parser.add_argument('--mix', default='recommend=0.8,karma=0.2', help='share of requests per endpoint')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients, each waits for its response')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='processes running the clients')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per phase')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before each phase')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--adapter-latency-ms', type=float, nargs='+', default=[0.0], help='one phase per value')
+    parser.add_argument('--adapter-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--adapter-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='JSON result file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    weights = {endpoint: float(share) for endpoint, share in (item.split('=') for item in args.mix.split(','))}
+    unknown = set(weights) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f"Unknown endpoints in --mix: {sorted(unknown)}, expected {sorted(ENDPOINTS)}")
+
+    work_dir = tempfile.mkdtemp(prefix='load-test-')
+    processes = []
+    try:
+        if args.target:
+            target, mock_url = args.target.rstrip('/'), args.mock_url
+        else:
+            target, mock_url, processes = start_environment(args, work_dir)
+
+        phases = []
+        for latency_ms in args.adapter_latency_ms:
+            faults = {"latency_ms": latency_ms, "jitter_ms": args.adapter_jitter_ms,
+                      "error_rate": args.adapter_error_rate}
+            if mock_url:
+                requests.post(mock_url + '/mock/faults', json=faults, timeout=5).raise_for_status()
+            elif len(args.adapter_latency_ms) > 1 or latency_ms:
+                raise SystemExit("Varying the adapter latency needs --mock-url")
+            logging.getLogger('load_test').info(f"Phase with adapter faults {faults}")
+            phases.append({"adapter": faults, "endpoints": run_phase(target, args, weights)})
+            logging.getLogger('load_test').info(json.dumps(phases[-1]["endpoints"]))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {"target": args.server_command.format(port=args.port, workers=args.workers) if not args.target
+               else args.target, "clients": args.clients, "duration_in_s": args.duration, "mix": weights,
+               "phases": phases}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# benchmarks/recommend_pipeline.py
+"""
+Offline benchmark of the /v1/recommend pipeline on the csv data source, no Postgres or HTTP involved.
+
+Generates a synthetic dataset (or uses --dataset) and times every stage with the service's own code:
+loading through DataAccess (parsing the CSV and reopening the binary snapshot), trainset build, fit per algo,
+RecommendationService._predict_ratings, top-N selection and serialization of the response.
+For SVD it also builds the approximate item factor index and reports recall@N and latency per n-probe.
+Reports throughput, latency percentiles and the peak RSS after each stage, and saves them as JSON so runs
+can be compared across commits.
+
+Run from the repository root:
+    python benchmarks/recommend_pipeline.py --users 20000 --items 5000 --density 0.005 --algos SVD KNN_SPARSE
+    python benchmarks/recommend_pipeline.py ... --output after.json --compare before.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_ratings import generate_ratings, write_ratings_csv  # noqa: E402
+
+COLUMNS = ('user_id', 'item_id', 'rating')
+
+
+def peak_rss_in_mb():
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def timed(action):
+    gc.collect()
+    started_at = time.perf_counter()
+    result = action()
+    return result, {"seconds": round(time.perf_counter() - started_at, 4), "peak_rss_mb": peak_rss_in_mb()}
+
+
+def latency_summary(latencies_in_s):
+    latencies = sorted(latency * 1000 for latency in latencies_in_s)
+
+    def percentile(share):
+        return round(latencies[min(len(latencies) - 1, int(share * len(latencies)))], 3)
+
+    return {"count": len(latencies), "p50_ms": percentile(0.50), "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99), "max_ms": round(latencies[-1], 3),
+            "mean_ms": round(statistics.fmean(latencies), 3)}
+
+
+def use_csv_config(csv_path, work_dir):
+    """Points the service at the dataset through its own configuration file, before any service module is imported."""
+    with open(os.path.join(ROOT, 'application.yml')) as config_file:
+        config = yaml.safe_load(config_file)
+    service_config = config['service-configuration']
+    service_config['data-layer']['source'] = 'csv'
+    service_config['data-layer']['csv']['path_to_file'] = csv_path
+    # every algo is trained by the benchmark itself, nothing persisted or retrained in the background
+    service_config['model-store']['enabled'] = False
+    service_config['cache']['retrain-interval-in-s'] = 0
+    service_config['config-reload-interval-in-s'] = 0
+    config_path = os.path.join(work_dir, 'application.yml')
+    with open(config_path, 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+    os.environ['CONFIG_PATH'] = config_path
+
+
+def new_algorithm(algo):
+    # the same instances RecommendationService.train_model creates
+    from surprise import KNNBasic, SVD
+
+    from app_configuration import AppConfig
+    from sparse_knn import SparseKNN
+    if algo == 'KNN':
+        return KNNBasic(verbose=False)
+    if algo == 'SVD':
+        return SVD()
+    return SparseKNN(n_neighbors=AppConfig.current().sparse_knn_neighbors,
+                     block_size=AppConfig.current().sparse_knn_block_size)
+
+
+def benchmark_serving(service, scorer, user_ids, n):
+    import pandas as pd
+
+    from batch_scoring import BatchScorer
+    user_col, item_col, rating_col = COLUMNS
+    stage_latencies = {"predict": [], "top_n": [], "serialize": [], "request": []}
+    for user_id in user_ids:
+        started_at = time.perf_counter()
+        items_to_predict, scores = service._predict_ratings(scorer, user_id, user_col, item_col, rating_col)
+        predicted_at = time.perf_counter()
+        top_indices = BatchScorer.top_n(scores, n)
+        selected_at = time.perf_counter()
+        recommendations = pd.DataFrame({
+            user_col: [user_id] * len(top_indices),
+            item_col: items_to_predict[top_indices],
+            rating_col: scores[top_indices],
+        })
+        # what jsonify does with the records
+        json.dumps(recommendations.to_dict(orient='records'))
+        finished_at = time.perf_counter()
+        stage_latencies["predict"].append(predicted_at - started_at)
+        stage_latencies["top_n"].append(selected_at - predicted_at)
+        stage_latencies["serialize"].append(finished_at - selected_at)
+        stage_latencies["request"].append(finished_at - started_at)
+
+    results = {stage: latency_summary(latencies) for stage, latencies in stage_latencies.items()}
+    results["request"]["throughput_per_s"] = round(len(user_ids) / sum(stage_latencies["request"]), 1)
+    results["peak_rss_mb"] = peak_rss_in_mb()
+    return results
+
+
+def benchmark_ann(scorer, user_ids, n, n_lists, n_probes):
+    """
+    Builds the item factor index of an SVD scorer and, per n_probe, times the approximate path of /v1/recommend
+    (candidates from the index, scoring, top-N) and its recall@N against exact scoring of every unrated item.
+    An item is a hit when it scores at least as high as the exact N-th item, so ties at the rating bound count.
+    """
+    from batch_scoring import BatchScorer
+
+    snapshot = scorer.snapshot
+    index, build = timed(lambda: scorer.build_ann_index(n_lists))
+    results = {"build": build, "n_lists": index.n_lists, "n_probe": {}}
+
+    exact_latencies, exact_thresholds = [], []
+    for user_id in user_ids:
+        started_at = time.perf_counter()
+        user_code = snapshot.user_code(user_id)
+        scores = scorer.score(user_code, snapshot.items_not_rated_by(user_code))
+        top_scores = scores[BatchScorer.top_n(scores, n)]
+        exact_latencies.append(time.perf_counter() - started_at)
+        exact_thresholds.append((top_scores[-1], len(top_scores)) if len(top_scores) else (None, 0))
+    results["exact"] = latency_summary(exact_latencies)
+
+    for n_probe in n_probes:
+        latencies, candidate_counts, hits, expected = [], [], 0, 0
+        for user_id, (threshold, count) in zip(user_ids, exact_thresholds):
+            started_at = time.perf_counter()
+            user_code = snapshot.user_code(user_id)
+            candidates = scorer.candidate_items(user_code, n, n_probe)
+            scores = scorer.score(user_code, candidates)
+            top_scores = scores[BatchScorer.top_n(scores, n)]
+            latencies.append(time.perf_counter() - started_at)
+            candidate_counts.append(len(candidates))
+            hits += int((top_scores >= threshold).sum()) if count else 0
+            expected += count
+        results["n_probe"][str(n_probe)] = {
+            "recall_at_n": round(hits / expected, 4) if expected else None,
+            "candidates_mean": round(statistics.fmean(candidate_counts), 1),
+            "request": latency_summary(latencies),
+        }
+        logging.getLogger('benchmark').info(
+            f"SVD ann n_probe {n_probe}: recall@{n} {results['n_probe'][str(n_probe)]['recall_at_n']}, "
+            f"p50 {results['n_probe'][str(n_probe)]['request']['p50_ms']}ms "
+            f"(exact {results['exact']['p50_ms']}ms)")
+    # the index is not kept for the next algo
+    scorer.ann_index = None
+    return results
+
+
+def run(args, csv_path):
+    import numpy as np
+
+    from batch_scoring import BatchScorer
+    from data_access import DataAccess
+    from recommendation_service import RecommendationService
+
+    user_col, item_col, rating_col = COLUMNS
+    results = {"stages": {}, "algos": {}}
+    data_access = DataAccess(csv_path)
+
+    # first load parses the CSV and writes the binary snapshot, later loads memory-map it
+    shutil.rmtree(f"{csv_path}.snapshot", ignore_errors=True)
+    _, results["stages"]["load_csv"] = timed(lambda: data_access.load_ratings_snapshot(user_col, item_col, rating_col))
+    snapshot, results["stages"]["load_snapshot"] = timed(
+        lambda: data_access.load_ratings_snapshot(user_col, item_col, rating_col))
+    results["dataset"] = {"path": csv_path, "ratings": snapshot.n_ratings, "users": snapshot.n_users,
+                          "items": snapshot.n_items}
+
+    trainset = None
+    if any(algo != 'KNN_SPARSE' for algo in args.algos):
+        trainset, results["stages"]["trainset"] = timed(snapshot.to_trainset)
+
+    rng = np.random.default_rng(args.seed)
+    user_ids = rng.choice(np.asarray(snapshot.user_index), size=min(args.requests, snapshot.n_users), replace=False)
+    user_ids = [int(user_id) for user_id in user_ids]
+    service = RecommendationService(data_access)
+
+    for algo in args.algos:
+        algorithm = new_algorithm(algo)
+        _, fit = timed(lambda: algorithm.fit(snapshot if algo == 'KNN_SPARSE' else trainset))
+        scorer, scorer_build = timed(lambda: BatchScorer.from_algorithm(algorithm, snapshot))
+        results["algos"][algo] = {"fit": fit, "scorer": scorer_build,
+                                  "serving": benchmark_serving(service, scorer, user_ids, args.response_size)}
+        if algo == 'SVD' and args.ann_probes:
+            results["algos"][algo]["ann"] = benchmark_ann(scorer, user_ids, args.response_size, args.ann_lists,
+                                                          args.ann_probes)
+        logging.getLogger('benchmark').info(f"{algo}: fit {fit['seconds']}s, "
+                                            f"p50 {results['algos'][algo]['serving']['request']['p50_ms']}ms")
+        del algorithm, scorer
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    """Ratio current / baseline of every timing both runs have, below 1.0 is faster."""
+
+    def timings(results):
+        flat = {f"stages.{stage}": values["seconds"] for stage, values in results["stages"].items()}
+        for algo, values in results["algos"].items():
+            flat[f"{algo}.fit"] = values["fit"]["seconds"]
+            for stage, summary in values["serving"].items():
+                if isinstance(summary, dict):
+                    flat[f"{algo}.{stage}.p50_ms"] = summary["p50_ms"]
+                    flat[f"{algo}.{stage}.p95_ms"] = summary["p95_ms"]
+            for n_probe, summary in values.get("ann", {}).get("n_probe", {}).items():
+                flat[f"{algo}.ann.{n_probe}.p50_ms"] = summary["request"]["p50_ms"]
+        return flat
+
+    current_timings, baseline_timings = timings(current), timings(baseline)
+    return {name: round(value / baseline_timings[name], 3) if baseline_timings[name] else None
+            for name, value in current_timings.items() if name in baseline_timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', help='existing user_id,item_id,rating CSV instead of a generated one')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.01)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--algos', nargs='+', default=['KNN', 'SVD'], choices=['KNN', 'SVD', 'KNN_SPARSE'])
+    parser.add_argument('--requests', type=int, default=500, help='users scored per algo')
+    parser.add_argument('--response-size', type=int, default=10)
+    parser.add_argument('--ann-lists', type=int, default=0, help='clusters of the SVD item index, 0 = sqrt(items)')
+    parser.add_argument('--ann-probes', type=int, nargs='*', default=[1, 2, 4, 8, 16],
+                        help='n-probe values whose recall@N and latency are measured for SVD, none to skip')
+    parser.add_argument('--output', help='JSON result file, default benchmarks/results/<time>-<commit>.json')
+    parser.add_argument('--compare', help='JSON result of an earlier run to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('benchmark').setLevel(logging.INFO)
+
+    work_dir = tempfile.mkdtemp(prefix='recommend-benchmark-')
+    try:
+        csv_path = os.path.abspath(args.dataset) if args.dataset else os.path.join(work_dir, 'ratings.csv')
+        if not args.dataset:
+            generate_started_at = time.perf_counter()
+            write_ratings_csv(csv_path, *generate_ratings(args.users, args.items, args.density, args.duplicate_rate,
+                                                          args.seed))
+            logging.getLogger('benchmark').info(
+                f"Generated {csv_path} in {time.perf_counter() - generate_started_at:.1f}s")
+        use_csv_config(csv_path, work_dir)
+        results = run(args, csv_path)
+        if args.dataset:
+            shutil.rmtree(f"{csv_path}.snapshot", ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = git_commit()
+    results["meta"] = {"commit": commit, "created_at": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                       "args": vars(args)}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            results["compared_to"] = {"path": args.compare, "ratios": compare(results, json.load(baseline_file))}
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"{time.strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+    logging.getLogger('benchmark').info(f"Saved results to {output}")
+
+
+if __name__ == '__main__':
+    main()
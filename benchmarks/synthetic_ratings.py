@@ -0,0 +1,85 @@
+# benchmarks/synthetic_ratings.py
+"""
+Synthetic ratings in the user_id,item_id,rating CSV format the csv data source reads.
+
+Item popularity follows a Zipf-like curve and ratings come from user and item biases plus noise,
+so neighbourhood and factor models have structure to learn. A share of rows repeats an earlier
+(user, item) pair with a new rating, like re-ratings in the production table.
+
+Run from the repository root:
+    python benchmarks/synthetic_ratings.py --users 100000 --items 20000 --density 0.001 --output /tmp/ratings.csv
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+def generate_ratings(n_users, n_items, density, duplicate_rate=0.0, seed=42, popularity_exponent=0.8):
+    """Returns user ids, item ids (both 1-based) and ratings 1-5 of about n_users * n_items * density rows."""
+    if n_users <= 0 or n_items <= 0:
+        raise ValueError("Number of users and items must be positive")
+    if not 0.0 < density <= 1.0:
+        raise ValueError("Density must be in (0, 1]")
+    if not 0.0 <= duplicate_rate < 1.0:
+        raise ValueError("Duplicate rate must be in [0, 1)")
+
+    rng = np.random.default_rng(seed)
+    # every user rates at least one item, heavy raters are rarer than light ones
+    per_user = rng.poisson(max(density * n_items, 1.0), n_users).clip(1, n_items)
+
+    popularity = 1.0 / np.arange(1, n_items + 1) ** popularity_exponent
+    popularity /= popularity.sum()
+    # shuffle so popular items do not all have small ids
+    item_order = rng.permutation(n_items)
+
+    users = np.repeat(np.arange(n_users, dtype=np.int64), per_user)
+    items = item_order[rng.choice(n_items, size=len(users), p=popularity)]
+    # one rating per drawn (user, item) pair; popular items drawn twice for a user lower the count slightly
+    pairs = np.unique(users * n_items + items)
+    users, items = pairs // n_items, pairs % n_items
+
+    user_bias = rng.normal(0.0, 0.5, n_users)
+    item_bias = rng.normal(0.0, 0.7, n_items)
+    ratings = 3.5 + user_bias[users] + item_bias[items] + rng.normal(0.0, 0.8, len(users))
+
+    n_duplicates = int(len(users) * duplicate_rate)
+    if n_duplicates:
+        repeated = rng.integers(0, len(users), n_duplicates)
+        users = np.concatenate([users, users[repeated]])
+        items = np.concatenate([items, items[repeated]])
+        ratings = np.concatenate([ratings, ratings[repeated] + rng.normal(0.0, 1.0, n_duplicates)])
+
+    order = rng.permutation(len(users))
+    ratings = np.clip(np.rint(ratings[order]), 1, 5).astype(np.int8)
+    return users[order] + 1, items[order] + 1, ratings
+
+
+def write_ratings_csv(path, users, items, ratings, chunk_size=1_000_000):
+    with open(path, 'w') as csv_file:
+        csv_file.write('user_id,item_id,rating\n')
+        for start in range(0, len(users), chunk_size):
+            rows = np.column_stack([users[start:start + chunk_size], items[start:start + chunk_size],
+                                    ratings[start:start + chunk_size]])
+            np.savetxt(csv_file, rows, fmt='%d', delimiter=',')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.01, help='share of the user x item matrix that is rated')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of extra rows re-rating a rated pair')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    users, items, ratings = generate_ratings(args.users, args.items, args.density, args.duplicate_rate, args.seed)
+    write_ratings_csv(args.output, users, items, ratings)
+    print(json.dumps({"path": os.path.abspath(args.output), "rows": len(users),
+                      "users": int(len(np.unique(users))), "items": int(len(np.unique(items)))}))
+
+
+if __name__ == '__main__':
+    main()
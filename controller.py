@@ -1,11 +1,14 @@
 # controller.py
+import json
 import logging
+import time
 from colorama import init, Fore
-from flask import Flask, request, jsonify
-from recommendation_service import RecommendationService
-from data_access import DataAccess
+from flask import Flask, Response, g, request, jsonify, send_file
 from app_configuration import AppConfig
-from recommendation_service import FormulaService
+from formula_service import FormulaService
+from metrics import Metrics
+from request_profiler import RequestProfiler
+from service_warmup import ServiceWarmup
 # Initialize Colorama for colored console output
 init()
 class ColoredConsoleHandler(logging.StreamHandler):
@@ -27,16 +30,28 @@ logger = logging.getLogger()
 logger.handlers[0] = ColoredConsoleHandler()
 
 app = Flask(__name__)
-config = AppConfig()
+config = AppConfig.current()
+if config.config_reload_interval_in_s > 0:
+    AppConfig.watch(config.config_reload_interval_in_s)
 
-csv_repo = DataAccess(config.csv_path)
-rec_service = RecommendationService(csv_repo)
+Metrics.configure(config)
+# None unless profiling is enabled
+profiler = RequestProfiler.from_config(config)
+
+
+def profiled(endpoint):
+    return profiler.profile(endpoint) if profiler is not None else (lambda view: view)
+
+# pandas, surprise and the database engine are loaded by the warmup, not at import
+services = ServiceWarmup(config)
+services.start()
 
 
 class RecommendationController:
 
     @staticmethod
     @app.route('/v1/calculate-karma', methods=['POST'])
+    @profiled('calculate_karma')
     def calculateKarma():
         try:
 
@@ -62,8 +77,35 @@ class RecommendationController:
             logging.getLogger(RecommendationController.__name__).error("Error in /v1/calculate-karma: %s", e)
             return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
 
+    @staticmethod
+    @app.route('/v1/calculate-karma/batch', methods=['POST'])
+    def calculateKarmaBatch():
+        try:
+
+            data = request.json
+
+            user_ids = data.get('user_ids')
+
+            if not isinstance(user_ids, list) or not user_ids:
+                raise ValueError("User IDs must be a non-empty list")
+            if any(user_id is None for user_id in user_ids):
+                raise ValueError("User ID cannot be null")
+
+            # per-user failures are reported in the results, the request itself succeeds
+            results = FormulaService().calculate_for_users(user_ids)
+
+            failed = sum(1 for result in results if "error_type" in result)
+            logging.getLogger(RecommendationController.__name__).info(
+                f"Karma calculated for {len(results) - failed} of {len(results)} users")
+
+            return jsonify(results)
+        except Exception as e:
+            logging.getLogger(RecommendationController.__name__).error("Error in /v1/calculate-karma/batch: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
     @staticmethod
     @app.route('/v1/recommend', methods=['POST'])
+    @profiled('recommend')
     def recommend():
         try:
 
@@ -78,16 +120,162 @@ class RecommendationController:
 
             logging.getLogger(RecommendationController.__name__).info(f"User ID: '{user_id}', Algorithm: '{algo}'")
 
-            if algo not in ['KNN', 'SVD']:
-                raise ValueError("Invalid algorithm choice. Must be 'KNN' or 'SVD'.")
+            if algo not in ['KNN', 'SVD', 'KNN_SPARSE']:
+                raise ValueError("Invalid algorithm choice. Must be 'KNN', 'SVD' or 'KNN_SPARSE'.")
 
             # Corrected call to get_recommendations with proper number of arguments
-            top_recommendations = rec_service.get_recommendations(user_id, user_col, item_col, rating_col, response_size, algo)
-            return jsonify(top_recommendations.to_dict(orient='records'))
+            top_recommendations = services.recommendation_service().get_recommendations(user_id, user_col, item_col, rating_col, response_size, algo)
+            with Metrics.stage('recommend', 'serialize', algo):
+                return jsonify(top_recommendations.to_dict(orient='records'))
         except Exception as e:
             logging.getLogger(RecommendationController.__name__).error("Error in /v1/recommend: %s", e)
             return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
 
+    @staticmethod
+    @app.route('/v1/recommend/batch', methods=['POST'])
+    def recommend_batch():
+        try:
+
+            data = request.json
+
+            user_ids = data.get('user_ids')
+            user_col = data.get('user_column_name')
+            item_col = data.get('item_column_name')
+            rating_col = data.get('rating_column_name')
+            response_size = data.get('response_size')
+            algo = data.get('algo', 'KNN')  # Default to KNN if not provided
+
+            if not isinstance(user_ids, list) or not user_ids:
+                raise ValueError("User IDs must be a non-empty list")
+            if any(user_id is None for user_id in user_ids):
+                raise ValueError("User ID cannot be null")
+            batch_config = AppConfig.current()
+            if len(user_ids) > batch_config.recommend_batch_max_users:
+                raise ValueError(f"At most {batch_config.recommend_batch_max_users} user IDs per request")
+            if algo not in ['KNN', 'SVD', 'KNN_SPARSE']:
+                raise ValueError("Invalid algorithm choice. Must be 'KNN', 'SVD' or 'KNN_SPARSE'.")
+
+            logging.getLogger(RecommendationController.__name__).info(f"{len(user_ids)} users, Algorithm: '{algo}'")
+
+            recommendations = services.recommendation_service().get_recommendations_batch(
+                user_ids, user_col, item_col, rating_col, response_size, algo, batch_config.recommend_batch_chunk_size)
+
+            def ndjson_lines():
+                # one line per user as soon as its chunk is scored
+                try:
+                    for user_id, records in recommendations:
+                        yield json.dumps({"user_id": user_id, "recommendations": records}) + '\n'
+                except Exception as e:
+                    # the status is already sent, the error ends the stream as its last line
+                    logging.getLogger(RecommendationController.__name__).error("Error in /v1/recommend/batch: %s", e)
+                    yield json.dumps({"error_type": type(e).__name__, "error_message": str(e)}) + '\n'
+
+            return Response(ndjson_lines(), mimetype='application/x-ndjson')
+        except Exception as e:
+            logging.getLogger(RecommendationController.__name__).error("Error in /v1/recommend/batch: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
+    @staticmethod
+    @app.route('/v1/models', methods=['GET'])
+    def models():
+        try:
+            return jsonify(services.recommendation_service().get_model_registry_stats())
+        except Exception as e:
+            logging.getLogger(RecommendationController.__name__).error("Error in /v1/models: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
+    @staticmethod
+    @app.route('/v1/adapter/stats', methods=['GET'])
+    def adapter_stats():
+        try:
+            stats = FormulaService.adapter_client.stats()
+            if FormulaService.update_queue is not None:
+                stats["update_queue"] = FormulaService.update_queue.stats()
+            if FormulaService.input_cache is not None:
+                stats["formula_cache"] = FormulaService.input_cache.stats()
+            return jsonify(stats)
+        except Exception as e:
+            logging.getLogger(RecommendationController.__name__).error("Error in /v1/adapter/stats: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
+
+    @staticmethod
+    @app.route('/v1/formula-cache/invalidate', methods=['POST'])
+    def invalidate_formula_cache():
+        try:
+            data = request.get_json(silent=True) or {}
+            user_id = data.get('user_id')
+
+            cache = FormulaService.input_cache
+            if cache is not None:
+                if user_id is not None:
+                    cache.invalidate_user(user_id)
+                else:
+                    cache.invalidate()
+
+            logging.getLogger(RecommendationController.__name__).info(f"Formula cache invalidated (user_id: {user_id})")
+            return jsonify({"invalidated": cache is not None})
+        except Exception as e:
+            logging.getLogger(RecommendationController.__name__).error("Error in /v1/formula-cache/invalidate: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
+
+class MetricsController:
+    @staticmethod
+    @app.before_request
+    def start_request_timer():
+        g.request_started_at = time.perf_counter()
+
+    @staticmethod
+    @app.after_request
+    def observe_request(response):
+        started_at = g.get('request_started_at')
+        if started_at is not None:
+            # the route template, not the path, keeps the number of series bounded
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            Metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - started_at)
+        return response
+
+    @staticmethod
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(Metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ProfileController:
+    @staticmethod
+    @app.route('/v1/profiles', methods=['GET'])
+    def list_profiles():
+        try:
+            if profiler is None:
+                return jsonify({"enabled": False, "profiles": []})
+            if not profiler.is_authorized():
+                # the metadata holds request bodies, so without the token the endpoint does not exist
+                return jsonify({"error_type": "NotFound", "error_message": "Not found"}), 404
+            return jsonify({"enabled": True, "profiles": profiler.list_profiles()})
+        except Exception as e:
+            logging.getLogger(ProfileController.__name__).error("Error in /v1/profiles: %s", e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 503
+
+    @staticmethod
+    @app.route('/v1/profiles/<profile_id>', methods=['GET'])
+    def download_profile(profile_id):
+        try:
+            if profiler is None:
+                raise ValueError("Profiling is disabled")
+            if not profiler.is_authorized():
+                raise ValueError("Not found")
+            if request.args.get('format') == 'text':
+                report = profiler.report(profile_id, request.args.get('sort', 'cumulative'),
+                                         int(request.args.get('limit', 50)))
+                return Response(report, mimetype='text/plain')
+            # a pstats dump: python -m pstats <file> or snakeviz
+            return send_file(profiler.profile_path(profile_id), mimetype='application/octet-stream',
+                             as_attachment=True, download_name=f"{profile_id}.prof")
+        except Exception as e:
+            logging.getLogger(ProfileController.__name__).error("Error in /v1/profiles/%s: %s", profile_id, e)
+            return jsonify({"error_type": type(e).__name__, "error_message": str(e)}), 404
+
 
 class HealthController:
     @staticmethod
@@ -99,5 +287,20 @@ class HealthController:
         #logging.getLogger(HealthController.__name__).error("Health check invoked")
         return jsonify({"status": "ok"})
 
+    @staticmethod
+    @app.route('/health/live', methods=['GET'])
+    def liveness():
+        # the process answers requests, nothing else is checked so a slow warmup never gets the worker restarted
+        return jsonify({"status": "ok"})
+
+    @staticmethod
+    @app.route('/health/ready', methods=['GET'])
+    def readiness():
+        if not services.is_ready:
+            # a warmup that failed, e.g. while the database was down, is retried by the next probe
+            services.retry()
+            return jsonify({"status": "warming_up", **services.status()}), 503
+        return jsonify({"status": "ready", **services.status()})
+
 if __name__ == '__main__':
     app.run(port=config.http_port)
@@ -1,30 +1,72 @@
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from surprise import Reader, Dataset
 from app_configuration import AppConfig
-from sqlalchemy import create_engine
+from metrics import Metrics
+from ratings_snapshot import RatingsSnapshot
+from sqlalchemy import create_engine, text
 
 class DataAccessError(Exception):
     """Custom exception for data access errors."""
 
 class DataAccess:
 
-    app_config = AppConfig()
+    app_config = AppConfig.current()
 
-    engine = create_engine(
-        app_config.postgres_url,
-        echo=False,  # If set to True, SQL statements and other details are logged (useful for debugging)
-        pool_size=app_config.engine_pool_size,  # The number of connections to keep in the pool
-        pool_timeout=app_config.engine_pool_timeout_in_s,  # Number of seconds to wait before giving up on returning a connection from the pool
-        pool_recycle=app_config.engine_pool_recycle_in_s  # Number of seconds a connection can persist before being recycled
-        # Add other parameters as needed
-    )
+    # Created on first use, so importing this module neither needs the database nor fails while it is down
+    engine = None
+    _engine_lock = threading.Lock()
+
+    @staticmethod
+    def get_engine():
+        if DataAccess.engine is None:
+            with DataAccess._engine_lock:
+                if DataAccess.engine is None:
+                    app_config = AppConfig.current()
+                    DataAccess.engine = create_engine(
+                        app_config.postgres_url,
+                        echo=False,  # If set to True, SQL statements and other details are logged (useful for debugging)
+                        pool_size=app_config.engine_pool_size,  # The number of connections to keep in the pool
+                        pool_timeout=app_config.engine_pool_timeout_in_s,  # Number of seconds to wait before giving up on returning a connection from the pool
+                        pool_recycle=app_config.engine_pool_recycle_in_s  # Number of seconds a connection can persist before being recycled
+                        # Add other parameters as needed
+                    )
+        return DataAccess.engine
+
+    @staticmethod
+    def warm_up_connection_pool(connections):
+        """Opens and checks up to `connections` pooled connections so the first requests do not pay for connecting."""
+        engine = DataAccess.get_engine()
+        opened = []
+        try:
+            for _ in range(max(1, connections)):
+                connection = engine.connect()
+                opened.append(connection)
+                connection.execute(text("SELECT 1"))
+        finally:
+            for connection in opened:
+                connection.close()
+        return len(opened)
 
     def __init__(self, csv_path):
         self.csv_path = csv_path
-        self.app_configuration = AppConfig()
+        self.app_configuration = AppConfig.current()
         self.postgres_url = self.app_configuration.postgres_url
         self.pg_schema = self.app_configuration.postgres_schema
         self.pg_table = self.app_configuration.postgres_table
+        self.pg_id_column = self.app_configuration.postgres_id_column
+        self.incremental_load_enabled = self.app_configuration.incremental_load_enabled
+        self.full_reload_interval_in_s = self.app_configuration.full_reload_interval_in_s
+        self.load_chunk_size = self.app_configuration.load_chunk_size
+        self.source = self.app_configuration.data_source
 
 
     def load_data_from_csv(self, user_col, item_col, rating_col, rating_scale=(1, 5)):
@@ -48,7 +90,7 @@ class DataAccess:
             query = f"SELECT \"{user_col}\", \"{item_col}\", \"{rating_col}\" FROM \"{self.pg_schema}\".\"{self.pg_table}\""
 
 
-            return pd.read_sql_query(query, DataAccess.engine)
+            return pd.read_sql_query(query, DataAccess.get_engine())
         except Exception as e:
             raise DataAccessError(f"Error getting data frame from PostgreSQL: {e}")
 
@@ -58,11 +100,184 @@ class DataAccess:
             #query = f"SELECT \"{user_col}\", \"{item_col}\", \"{rating_col}\" FROM \"{self.pg_schema}\".\"{self.pg_table}\""
             query = f"SELECT * FROM \"{self.pg_schema}\".\"{self.pg_table}\""
 
-            df = pd.read_sql(query, DataAccess.engine)
+            df = pd.read_sql(query, DataAccess.get_engine())
             reader = Reader(rating_scale=rating_scale)
             data = Dataset.load_from_df(df[[user_col, item_col, rating_col]], reader)
             return data
         except Exception as e:
             raise DataAccessError(f"Error loading data from PostgreSQL: {e}")
 
+    class ColumnBuffer:
+        """Growable typed array filled chunk by chunk; falls back to object dtype for non-numeric ids."""
+
+        def __init__(self, dtype, capacity):
+            self.array = np.empty(max(capacity, 1), dtype=dtype)
+            self.size = 0
+
+        def extend(self, values):
+            try:
+                chunk = np.asarray(values, dtype=self.array.dtype)
+            except (TypeError, ValueError):
+                self.array = self.array.astype(object)
+                chunk = np.asarray(values, dtype=object)
+            if self.size + len(chunk) > len(self.array):
+                # the row count is not known up front: grow geometrically
+                grown = np.empty(max(2 * len(self.array), self.size + len(chunk)), dtype=self.array.dtype)
+                grown[:self.size] = self.array[:self.size]
+                self.array = grown
+            self.array[self.size:self.size + len(chunk)] = chunk
+            self.size += len(chunk)
+
+        def to_array(self):
+            # give back the unused tail of the last growth instead of keeping it behind a view
+            self.array.resize(self.size, refcheck=False)
+            return self.array
+
+    def _stream_postgres_columns(self, columns, dtypes, watermark=None):
+        # only the requested columns, fetched through a server-side cursor in fixed-size chunks
+        # and written straight into typed arrays, no DataFrame in between
+        try:
+            id_col = self.pg_id_column
+            # \" -> no sql inj possible, the watermark is a bound parameter
+            table = f"\"{self.pg_schema}\".\"{self.pg_table}\""
+            where = f" WHERE \"{id_col}\" > :watermark" if watermark is not None else ""
+            params = {"watermark": watermark} if watermark is not None else {}
+            select = ", ".join(f"\"{column}\"" for column in columns)
+            query = f"SELECT {select} FROM {table}{where}"
+            if watermark is not None:
+                query += f" ORDER BY \"{id_col}\""
+
+            with DataAccess.get_engine().connect() as connection:
+                # no count(*) to presize: it would scan the table a second time, the buffers grow instead
+                buffers = [DataAccess.ColumnBuffer(dtype, self.load_chunk_size) for dtype in dtypes]
+                result = connection.execution_options(stream_results=True, max_row_buffer=self.load_chunk_size) \
+                    .execute(text(query), params)
+                for rows in result.partitions(self.load_chunk_size):
+                    for buffer, values in zip(buffers, zip(*rows)):
+                        buffer.extend(values)
+
+            return [buffer.to_array() for buffer in buffers]
+        except Exception as e:
+            raise DataAccessError(f"Error streaming rows from PostgreSQL: {e}")
+
+    def _stream_postgres_ratings(self, user_col, item_col, rating_col, watermark=None, with_id=False):
+        columns = [user_col, item_col, rating_col]
+        dtypes = [np.int64, np.int64, np.float64]
+        if with_id:
+            columns.insert(0, self.pg_id_column)
+            dtypes.insert(0, np.int64)
+        return self._stream_postgres_columns(columns, dtypes, watermark)
+
+    def _is_full_reload_due(self, previous):
+        if previous is None or previous.watermark is None or previous.full_loaded_at is None:
+            return True
+        return (time.time() - previous.full_loaded_at) >= self.full_reload_interval_in_s
+
+    def _csv_snapshot_directory(self, user_col, item_col, rating_col):
+        # column names come from requests: a sanitized slug plus a hash, like ModelStore keys, never a raw path part
+        columns = (user_col, item_col, rating_col)
+        readable = re.sub(r'[^A-Za-z0-9_.-]', '_', '__'.join(columns))
+        digest = hashlib.sha1(repr(columns).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(f"{self.csv_path}.snapshot", f"{readable[:100]}-{digest}")
+
+    def _check_csv_columns(self, user_col, item_col, rating_col):
+        header = pd.read_csv(self.csv_path, nrows=0).columns
+        missing = [column for column in (user_col, item_col, rating_col) if column not in header]
+        if missing:
+            raise DataAccessError(f"Columns {missing} are not in {self.csv_path}")
+
+    @staticmethod
+    @contextmanager
+    def _exclusive(directory):
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        with open(f"{directory}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _load_csv_snapshot_if_current(directory, source_version):
+        meta = RatingsSnapshot.read_metadata(directory)
+        if meta is not None and all(meta.get(key) == value for key, value in source_version.items()):
+            try:
+                return RatingsSnapshot.load(directory)
+            except Exception as e:
+                logging.getLogger(DataAccess.__name__).warning(f"Rebuilding unreadable CSV snapshot {directory}: {e}")
+        return None
+
+    def load_csv_ratings_snapshot(self, user_col, item_col, rating_col):
+        # the CSV is parsed once into .npy columns next to it and memory-mapped afterwards,
+        # until the source file's mtime or size changes
+        try:
+            source_stat = os.stat(self.csv_path)
+            source_version = {'source_mtime_ns': source_stat.st_mtime_ns, 'source_size': source_stat.st_size}
+            directory = self._csv_snapshot_directory(user_col, item_col, rating_col)
+
+            snapshot = self._load_csv_snapshot_if_current(directory, source_version)
+            if snapshot is not None:
+                return snapshot
+
+            # nothing is created on disk for columns the file does not have
+            self._check_csv_columns(user_col, item_col, rating_col)
+            # one process rebuilds the snapshot, concurrent ones wait for it instead of replacing the same directory
+            with self._exclusive(directory):
+                snapshot = self._load_csv_snapshot_if_current(directory, source_version)
+                if snapshot is not None:
+                    return snapshot
+
+                logging.getLogger(DataAccess.__name__).info(f"Building binary snapshot of {self.csv_path}")
+                df = pd.read_csv(self.csv_path, usecols=[user_col, item_col, rating_col], dtype={rating_col: np.float64})
+                snapshot = RatingsSnapshot.from_data_frame(df, user_col, item_col, rating_col)
+                del df
+                snapshot.save(directory, source_version)
+                return RatingsSnapshot.load(directory)
+        except DataAccessError:
+            raise
+        except Exception as e:
+            raise DataAccessError(f"Error loading CSV ratings snapshot: {e}")
+
+    def load_ratings_snapshot(self, user_col, item_col, rating_col, previous: RatingsSnapshot = None):
+        if self.source == 'csv':
+            return self.load_csv_ratings_snapshot(user_col, item_col, rating_col)
+
+        try:
+            if not self.incremental_load_enabled:
+                users, items, ratings = self._stream_postgres_ratings(user_col, item_col, rating_col)
+                return RatingsSnapshot.from_columns(users, items, ratings)
+
+            if self._is_full_reload_due(previous):
+                # periodic full reconciliation picks up updated and deleted rows
+                loaded_at = time.time()
+                ids, users, items, ratings = self._stream_postgres_ratings(user_col, item_col, rating_col, with_id=True)
+                watermark = int(ids.max()) if len(ids) else None
+                return RatingsSnapshot.from_columns(users, items, ratings, watermark, loaded_at)
+
+            ids, users, items, ratings = self._stream_postgres_ratings(user_col, item_col, rating_col,
+                                                                       previous.watermark, with_id=True)
+            if len(ids) == 0:
+                return previous
+            logging.getLogger(DataAccess.__name__).info(f"Merging {len(ids)} new ratings above id {previous.watermark}")
+            return previous.append(users, items, ratings, int(ids.max()))
+        except DataAccessError:
+            raise
+        except Exception as e:
+            raise DataAccessError(f"Error building ratings snapshot: {e}")
+
+    @staticmethod
+    def collect_metrics():
+        engine = DataAccess.engine
+        if engine is None:
+            return []
+        pool = engine.pool
+        return [
+            ('recommender_db_pool_size', 'gauge', 'Configured size of the database connection pool.', [({}, pool.size())]),
+            ('recommender_db_pool_connections', 'gauge', 'Database connections by state.',
+             [({"state": "checked_out"}, pool.checkedout()),
+              ({"state": "idle"}, pool.checkedin()),
+              ({"state": "overflow"}, max(pool.overflow(), 0))]),
+        ]
+
 
+Metrics.register_collector(DataAccess.collect_metrics)
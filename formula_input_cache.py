@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class FormulaInputCacheError(Exception):
+    """Custom exception for formula input cache errors."""
+
+
+class FormulaInputCache:
+    """
+    TTL cache of adapter formula records per (formula, user), LRU bounded by max_entries records
+    (every user has one record per formula).
+    A single cache instead of a long-lived constants tier next to short-lived user counters: the adapter returns
+    the constants (c1-c16, k_j, Ka_t0, alpha, c_reg) inside every user record and has no constants-only call,
+    so caching the constants separately would not save a single adapter request.
+    """
+
+    def __init__(self, ttl_in_s, max_entries):
+        if ttl_in_s < 0:
+            raise FormulaInputCacheError("Cache TTL must be a non-negative number")
+        if max_entries <= 0:
+            raise FormulaInputCacheError("Cache max size must be a positive integer")
+        self.ttl_in_s = ttl_in_s
+        self.max_entries = max_entries
+        # (formula, user key) -> (fetched_at, record)
+        self._records = OrderedDict()
+        # user key -> formulas cached for that user, so invalidating a user does not scan the cache
+        self._formulas_by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def from_config(app_config):
+        if app_config.formula_inputs_ttl_in_s <= 0:
+            return None
+        return FormulaInputCache(app_config.formula_inputs_ttl_in_s, app_config.formula_inputs_max_entries)
+
+    @staticmethod
+    def _user_key(user_id):
+        # ids arrive as ints from JSON bodies and as strings from adapter responses
+        return str(user_id)
+
+    def get(self, formula, user_id):
+        """Cached adapter record of user_id for formula, or None when missing or expired."""
+        key = (formula, self._user_key(user_id))
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_in_s:
+                self.misses += 1
+                return None
+            self._records.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, formula, user_id, record):
+        user_key = self._user_key(user_id)
+        key = (formula, user_key)
+        with self._lock:
+            self._records[key] = (time.monotonic(), dict(record))
+            self._records.move_to_end(key)
+            self._formulas_by_user.setdefault(user_key, set()).add(formula)
+            while len(self._records) > self.max_entries:
+                (evicted_formula, evicted_user_key), _ = self._records.popitem(last=False)
+                self._forget(evicted_formula, evicted_user_key)
+                self.evictions += 1
+
+    def _forget(self, formula, user_key):
+        formulas = self._formulas_by_user.get(user_key)
+        if formulas is not None:
+            formulas.discard(formula)
+            if not formulas:
+                del self._formulas_by_user[user_key]
+
+    def invalidate_user(self, user_id):
+        user_key = self._user_key(user_id)
+        with self._lock:
+            for formula in self._formulas_by_user.pop(user_key, ()):
+                self._records.pop((formula, user_key), None)
+
+    def invalidate(self):
+        with self._lock:
+            self._records.clear()
+            self._formulas_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._records),
+                "users": len(self._formulas_by_user),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+                "evictions": self.evictions,
+                "ttl_in_s": self.ttl_in_s,
+            }
@@ -1,11 +1,16 @@
 import datetime
+import logging
 import sys
 import math
-import requests
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+from adapter_client import AdapterClient
 from app_configuration import AppConfig
+from formula_input_cache import FormulaInputCache
+from metrics import Metrics
+from update_queue import WriteBehindQueue
 
 
 class FormulaServiceError(Exception):
@@ -14,16 +19,35 @@ class FormulaServiceError(Exception):
 
 class FormulaService:
 
+    # Shared by every FormulaService instance, the controller creates one per request.
+    # With fewer than two workers the adapter calls are made one after another
+    _fetch_workers = AppConfig.current().adapter_fetch_workers
+    fetch_executor = ThreadPoolExecutor(max_workers=_fetch_workers, thread_name_prefix='formula-fetch') \
+        if _fetch_workers > 1 else None
+    # Keep-alive connections, timeouts, retries and the circuit breaker are shared by all adapter calls
+    adapter_client = AdapterClient.from_config(AppConfig.current())
+    # Constants and recent per-user inputs, so repeat calculations for a user skip the adapter
+    input_cache = FormulaInputCache.from_config(AppConfig.current())
+    # Optional: karma results are sent to the adapter in the background instead of before answering
+    update_queue = WriteBehindQueue.from_config(AppConfig.current(), adapter_client)
+
     def __init__(self):
-        # Initialize AppConfig once when an instance of FormulaService is created
-        self.app_config = AppConfig()
+        # The process-wide configuration, so URL changes apply to the next request after a reload
+        self.app_config = AppConfig.current()
         self.a_formula_data_url = self.app_config.a_formula_data_url
         self.r_formula_data_url = self.app_config.r_formula_data_url
         self.post_rating_formula_data_url = self.app_config.post_rating_formula_data_url
         self.karma_formula_data_url = self.app_config.karma_formula_data_url
         self.karma_level_formula_data_url = self.app_config.karma_level_formula_data_url
         self.update_url = self.app_config.update_userinfo_url
-
+        self.a_formula_data_batch_url = self.app_config.a_formula_data_batch_url
+        self.r_formula_data_batch_url = self.app_config.r_formula_data_batch_url
+        self.post_rating_formula_data_batch_url = self.app_config.post_rating_formula_data_batch_url
+        self.karma_formula_data_batch_url = self.app_config.karma_formula_data_batch_url
+        self.karma_level_formula_data_batch_url = self.app_config.karma_level_formula_data_batch_url
+        self.update_batch_url = self.app_config.update_userinfo_batch_url
+        self.fetch_batch_size = self.app_config.adapter_fetch_batch_size
+        self.update_batch_size = self.app_config.adapter_update_batch_size
 
     class FloatValidator:
         @staticmethod
@@ -68,11 +92,10 @@ class FormulaService:
             self.F_small_j = None
 
         def calculate_event_sum_result(self, times_to_sum, event_value, constant):
-            result = 0.0
-            for i in range(times_to_sum):
-                iteration_result = constant * self.k_j * event_value * self.f_t_tj_result
-                result += iteration_result
-            return result
+            # every event adds the same term, so the sum is a product
+            if times_to_sum <= 0:
+                return 0.0
+            return float(times_to_sum) * (constant * self.k_j * event_value * self.f_t_tj_result)
 
         def calculate_formula(self):
             self.unique_impression_sum_result = self.calculate_event_sum_result(self.unique_impression_sum_iterations,
@@ -143,11 +166,9 @@ class FormulaService:
             self.payment_function_iterations_num = None
 
         def calculate_event_sum_result(self, times_to_sum, event_value, constant, decreasing_function_result):
-            result = 0.0
-            for i in range(times_to_sum):
-                iteration_result = constant * self.k_j * event_value * decreasing_function_result
-                result += iteration_result
-            return result
+            if times_to_sum <= 0:
+                return 0.0
+            return float(times_to_sum) * (constant * self.k_j * event_value * decreasing_function_result)
 
         def calculate_formula(self):
             self.reply_function_sum_result = self.calculate_event_sum_result(self.reply_function_iterations_num,
@@ -222,10 +243,9 @@ class FormulaService:
             self.post_rating_sum_iterations = None
 
         def calculate_post_rating_sum(self):
-            result = 0.0
-            for _ in range(self.post_rating_sum_iterations):
-                result += self.post_rating_function_result
-            return result
+            if self.post_rating_sum_iterations <= 0:
+                return 0.0
+            return float(self.post_rating_sum_iterations) * self.post_rating_function_result
 
         def calculate_formula(self):
             final_formula_result = self.c15 * self.p_a * self.z_n_result * self.h_t_tr_result * self.calculate_post_rating_sum() + self.c_reg + self.alpha
@@ -258,16 +278,11 @@ class FormulaService:
             return self
 
     def build_and_calculate_a_data(self, user_id):
+        return self.request_a_formula_data_external(user_id).calculate_formula()
 
-        url_template = self.a_formula_data_url
-
-        safe_format = defaultdict(str, user_id=user_id)
-        url = url_template.format_map(safe_format)
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise FormulaServiceError("Failed to fetch A(t) formula data from server")
-
-        data = response.json()
+    def request_a_formula_data_external(self, user_id):
+        data = self._get_formula_data('a-formula', self.a_formula_data_url, user_id,
+                                      "Failed to fetch A(t) formula data from server")
 
         a_data = self.AData()
         a_data.user_id = user_id
@@ -293,21 +308,14 @@ class FormulaService:
         a_data.unique_view_sum_iterations = data["unique_view_sum_iterations"]
         a_data.view_sum_iterations = data["view_sum_iterations"]
 
-        # Calculate formula
-        result = a_data.calculate_formula()
-        return result
+        return a_data
 
     def build_and_calculate_r_data(self, user_id):
+        return self.request_r_formula_data_external(user_id).calculate_formula()
 
-        url_template = self.r_formula_data_url
-
-        safe_format = defaultdict(str, user_id=user_id)
-        url = url_template.format_map(safe_format)
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise FormulaServiceError("Failed to fetch R(t) data from server")
-
-        data = response.json()
+    def request_r_formula_data_external(self, user_id):
+        data = self._get_formula_data('r-formula', self.r_formula_data_url, user_id,
+                                      "Failed to fetch R(t) data from server")
 
         r_data = self.RData()
         r_data.user_id = user_id
@@ -330,9 +338,7 @@ class FormulaService:
         r_data.g_t_tj_result = data["g_t_tj_result"]
         r_data.y_t_tj_result = data["y_t_tj_result"]
 
-        # Calculate formula
-        result = r_data.calculate_formula()
-        return result
+        return r_data
 
     def build_init_data_for_post_rating_formula(self, user_id):
         post_rating_external_data = self.request_post_rating_data_external(user_id)
@@ -345,15 +351,8 @@ class FormulaService:
         return post_rating_external_data
 
     def request_post_rating_data_external(self, user_id):
-        url_template = self.post_rating_formula_data_url
-
-        safe_format = defaultdict(str, user_id=user_id)
-        url = url_template.format_map(safe_format)
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise FormulaServiceError("Failed to fetch PostRating formula data from server")
-
-        data = response.json()
+        data = self._get_formula_data('post-rating', self.post_rating_formula_data_url, user_id,
+                                      "Failed to fetch PostRating formula data from server")
 
         post_rating_external_data = self.PostRatingData()
         post_rating_external_data.user_id = user_id
@@ -366,15 +365,8 @@ class FormulaService:
         return post_rating_external_data
 
     def request_karma_formula_data_external(self, user_id):
-        url_template = self.karma_formula_data_url
-
-        safe_format = defaultdict(str, user_id=user_id)
-        url = url_template.format_map(safe_format)
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise FormulaServiceError("Failed to fetch Karma formula data from server")
-
-        data = response.json()
+        data = self._get_formula_data('karma-formula', self.karma_formula_data_url, user_id,
+                                      "Failed to fetch Karma formula data from server")
 
         karma_formula_data = self.KarmaFormulaData()
         karma_formula_data.user_id = user_id
@@ -390,15 +382,8 @@ class FormulaService:
         return karma_formula_data
 
     def request_karma_level_data_external(self, user_id):
-        url_template = self.karma_level_formula_data_url
-
-        safe_format = defaultdict(str, user_id=user_id)
-        url = url_template.format_map(safe_format)
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise FormulaServiceError("Failed to fetch Karma Level formula data from server")
-
-        data = response.json()
+        data = self._get_formula_data('karma-level', self.karma_level_formula_data_url, user_id,
+                                      "Failed to fetch Karma Level formula data from server")
 
         karma_level_data = self.KarmaLevelData()
         karma_level_data.user_id = user_id
@@ -406,24 +391,77 @@ class FormulaService:
 
         return karma_level_data
 
+    def _get_formula_data(self, formula, url_template, user_id, error_message):
+        if FormulaService.input_cache is not None:
+            data = FormulaService.input_cache.get(formula, user_id)
+            if data is not None:
+                return data
+
+        safe_format = defaultdict(str, user_id=user_id)
+        url = url_template.format_map(safe_format)
+        response = FormulaService.adapter_client.get(url, endpoint=formula)
+        if response.status_code != 200:
+            raise FormulaServiceError(error_message)
+
+        data = response.json()
+        if FormulaService.input_cache is not None:
+            FormulaService.input_cache.put(formula, user_id, data)
+        return data
+
     class CalculationResult:
         def __init__(self, karma_value, karma_lvl_value):
             self.karma_value = karma_value
             self.karma_lvl_value = karma_lvl_value
 
+    class FormulaInputs:
+        """Adapter responses for one user; every attribute is resolved in the order the formulas need it."""
+
+        def __init__(self, post_rating_data, a_data, r_data, karma_formula_data, karma_level_data):
+            self.post_rating_data = post_rating_data
+            self.a_data = a_data
+            self.r_data = r_data
+            self.karma_formula_data = karma_formula_data
+            self.karma_level_data = karma_level_data
+
+    def fetch_formula_inputs(self, user_id):
+        """
+        Starts the five independent adapter GETs at once, so the latency is that of the slowest call instead of the sum.
+        Returns callables that wait for each response and raise its error, if any, when called.
+        """
+        requests_in_formula_order = (self.request_post_rating_data_external,
+                                     self.request_a_formula_data_external,
+                                     self.request_r_formula_data_external,
+                                     self.request_karma_formula_data_external,
+                                     self.request_karma_level_data_external)
+
+        if FormulaService.fetch_executor is None:
+            # sequential mode keeps the original behaviour of stopping at the first failed call
+            return self.FormulaInputs(*[lambda request=request: request(user_id) for request in requests_in_formula_order])
+
+        futures = [FormulaService.fetch_executor.submit(request, user_id) for request in requests_in_formula_order]
+        return self.FormulaInputs(*[future.result for future in futures])
+
     def calculate_for_user(self, user_id):
-        post_rating_data = self.build_init_data_for_post_rating_formula(user_id)
-        calculated_post_rating_data = post_rating_data.calculate_formula()
+        # fetching and calculating overlap, per-call adapter latency is recorded by the adapter client
+        with Metrics.stage('karma', 'fetch_and_calculate'):
+            inputs = self.fetch_formula_inputs(user_id)
 
-        initiated_karma_formula = self.request_karma_formula_data_external(user_id)
-        initiated_karma_formula.post_rating_function_result = calculated_post_rating_data.final_formula_result
+            # Responses are consumed in the same order as the former sequential calls,
+            # so the first failing call or formula still decides which error is raised
+            post_rating_data = inputs.post_rating_data()
+            post_rating_data.A_t_result = inputs.a_data().calculate_formula().final_formula_result
+            post_rating_data.R_t_result = inputs.r_data().calculate_formula().final_formula_result
+            calculated_post_rating_data = post_rating_data.calculate_formula()
 
-        calculated_karma_formula_data = initiated_karma_formula.calculate_formula()
+            initiated_karma_formula = inputs.karma_formula_data()
+            initiated_karma_formula.post_rating_function_result = calculated_post_rating_data.final_formula_result
 
-        karma_level_data = self.request_karma_level_data_external(user_id)
-        karma_level_data.K_t = calculated_karma_formula_data.final_formula_result
+            calculated_karma_formula_data = initiated_karma_formula.calculate_formula()
 
-        calculated_karma_level_data = karma_level_data.calculate_karma_level_formula()
+            karma_level_data = inputs.karma_level_data()
+            karma_level_data.K_t = calculated_karma_formula_data.final_formula_result
+
+            calculated_karma_level_data = karma_level_data.calculate_karma_level_formula()
 
         #update info
         data = {
@@ -432,9 +470,15 @@ class FormulaService:
             "user_id": user_id
         }
 
+        if FormulaService.update_queue is not None and FormulaService.update_queue.offer(data):
+            return self.CalculationResult(karma_value=calculated_karma_formula_data.final_formula_result,
+                                          karma_lvl_value=calculated_karma_level_data.final_formula_result)
+
+        # write-behind disabled or its queue is full: update synchronously
         url_template = self.update_url
 
-        response = requests.post(url_template, json=data)
+        with Metrics.stage('karma', 'update'):
+            response = FormulaService.adapter_client.post(url_template, json=data, endpoint='update-info')
 
         # Print the response from the server
         print(response.text)
@@ -443,3 +487,137 @@ class FormulaService:
 
         return self.CalculationResult(karma_value=calculated_karma_formula_data.final_formula_result,
                                       karma_lvl_value=calculated_karma_level_data.final_formula_result)
+
+    def request_formula_data_batch_external(self, formula, url, user_ids, formula_name):
+        """Adapter records for user_ids in the same order, None for users the adapter returned nothing for."""
+        cache = FormulaService.input_cache
+        records = [cache.get(formula, user_id) if cache is not None else None for user_id in user_ids]
+        missing_user_ids = [user_id for user_id, record in zip(user_ids, records) if record is None]
+        if not missing_user_ids:
+            return records
+
+        response = FormulaService.adapter_client.post(url, json={"user_ids": missing_user_ids}, idempotent=True,
+                                                      endpoint=f"{formula}/batch")
+        if response.status_code != 200:
+            raise FormulaServiceError(f"Failed to fetch {formula_name} formula data from server")
+
+        records_by_user = {str(record["user_id"]): record for record in response.json()}
+        if cache is not None:
+            for user_id in missing_user_ids:
+                if str(user_id) in records_by_user:
+                    cache.put(formula, user_id, records_by_user[str(user_id)])
+        return [record if record is not None else records_by_user.get(str(user_id))
+                for user_id, record in zip(user_ids, records)]
+
+    def fetch_formula_inputs_batch(self, user_ids):
+        """Records per formula, in the order of KarmaBatchEngine.calculate, fetched with one batch call each."""
+        batch_requests = (('post-rating', self.post_rating_formula_data_batch_url, 'PostRating'),
+                          ('a-formula', self.a_formula_data_batch_url, 'A(t)'),
+                          ('r-formula', self.r_formula_data_batch_url, 'R(t)'),
+                          ('karma-formula', self.karma_formula_data_batch_url, 'Karma'),
+                          ('karma-level', self.karma_level_formula_data_batch_url, 'Karma Level'))
+
+        if FormulaService.fetch_executor is None:
+            return [self.request_formula_data_batch_external(formula, url, user_ids, name)
+                    for formula, url, name in batch_requests]
+
+        futures = [FormulaService.fetch_executor.submit(self.request_formula_data_batch_external, formula, url, user_ids,
+                                                        name)
+                   for formula, url, name in batch_requests]
+        return [future.result() for future in futures]
+
+    def calculate_for_users(self, user_ids):
+        """
+        Karma for many users with batched adapter calls and one vectorized calculation per chunk of fetch_batch_size users.
+        Returns one record per user in input order: the calculation result or error_type and error_message.
+        """
+        records = []
+        for start in range(0, len(user_ids), self.fetch_batch_size):
+            records.extend(self._calculate_chunk(user_ids[start:start + self.fetch_batch_size]))
+
+        calculated = [record for record in records if "error_type" not in record]
+        if FormulaService.update_queue is not None:
+            calculated = [record for record in calculated if not FormulaService.update_queue.offer(dict(record))]
+        for start in range(0, len(calculated), self.update_batch_size):
+            self._update_users_batch(calculated[start:start + self.update_batch_size])
+        return records
+
+    def _calculate_chunk(self, user_ids):
+        try:
+            with Metrics.stage('karma_batch', 'fetch'):
+                formula_records = self.fetch_formula_inputs_batch(user_ids)
+        except Exception as e:
+            logging.getLogger(FormulaService.__name__).error(f"Error fetching formula data for {len(user_ids)} users: {e}")
+            return [self._error_record(user_id, e) for user_id in user_ids]
+
+        complete = [position for position in range(len(user_ids))
+                    if all(records[position] is not None for records in formula_records)]
+        # NumPy is only needed for batches, keep it off the import path of the service
+        from karma_batch import KarmaBatchEngine
+
+        chunk_records = [self._error_record(user_id, FormulaServiceError(f"No formula data for user {user_id}"))
+                         for user_id in user_ids]
+        try:
+            with Metrics.stage('karma_batch', 'calculate'):
+                columns = [KarmaBatchEngine.columns_from_records([records[position] for position in complete])
+                           for records in formula_records]
+                result_records = KarmaBatchEngine().calculate([user_ids[position] for position in complete],
+                                                              *columns).to_records()
+        except Exception as e:
+            # e.g. an input column no record has: this chunk's users fail, the other chunks are still updated
+            logging.getLogger(FormulaService.__name__).error(f"Error calculating karma for {len(complete)} users: {e}")
+            result_records = [self._error_record(user_ids[position], e) for position in complete]
+
+        for position, result_record in zip(complete, result_records):
+            chunk_records[position] = result_record
+        return chunk_records
+
+    def _update_users_batch(self, records):
+        try:
+            with Metrics.stage('karma_batch', 'update'):
+                response = FormulaService.adapter_client.post(self.update_batch_url, json=records,
+                                                              endpoint='update-info/batch')
+            if response.status_code != 200:
+                raise FormulaServiceError("Failed to update user data")
+        except Exception as e:
+            logging.getLogger(FormulaService.__name__).error(f"Error updating {len(records)} users: {e}")
+            for record in records:
+                user_id = record["user_id"]
+                record.clear()
+                record.update(self._error_record(user_id, e))
+
+    @staticmethod
+    def _error_record(user_id, error):
+        return {"user_id": user_id, "error_type": type(error).__name__, "error_message": str(error)}
+
+    @staticmethod
+    def collect_metrics():
+        client_stats = FormulaService.adapter_client.stats()
+        families = [
+            ('recommender_adapter_retries_total', 'counter', 'Adapter call retries.', [({}, client_stats["retries"])]),
+            ('recommender_adapter_retries_denied_total', 'counter', 'Adapter call retries refused by the retry budget.',
+             [({}, client_stats["retries_denied"])]),
+            ('recommender_adapter_circuit_open', 'gauge', '1 while the adapter circuit breaker rejects calls.',
+             [({}, int(client_stats["circuit_breaker"]["state"] != 'closed'))]),
+            ('recommender_adapter_pool_connections', 'gauge', 'Adapter keep-alive connections per host.',
+             [({"host": pool["host"], "state": state}, pool[key])
+              for pool in client_stats["pools"]
+              for state, key in (('opened', 'connections_opened'), ('idle', 'idle_connections'))]),
+        ]
+        if FormulaService.input_cache is not None:
+            cache_stats = FormulaService.input_cache.stats()
+            families.append(('recommender_cache_requests_total', 'counter', 'Cache lookups by result.',
+                             [({"cache": "formula_inputs", "result": "hit"}, cache_stats["hits"]),
+                              ({"cache": "formula_inputs", "result": "miss"}, cache_stats["misses"])]))
+            families.append(('recommender_cache_entries', 'gauge', 'Entries held by a cache.',
+                             [({"cache": "formula_inputs"}, cache_stats["entries"])]))
+        if FormulaService.update_queue is not None:
+            queue_stats = FormulaService.update_queue.stats()
+            families.append(('recommender_update_queue_depth', 'gauge', 'Karma updates waiting in the write-behind queue.',
+                             [({}, queue_stats["depth"])]))
+            families.append(('recommender_update_queue_spilled_total', 'counter',
+                             'Karma updates written to the spill file.', [({}, queue_stats["spilled"])]))
+        return families
+
+
+Metrics.register_collector(FormulaService.collect_metrics)
@@ -0,0 +1,153 @@
+import math
+import sys
+
+import numpy as np
+
+
+class KarmaBatchError(Exception):
+    """Custom exception for batch karma calculation errors."""
+
+
+class KarmaBatchResult:
+    def __init__(self, user_ids, karma_values, karma_lvl_values, errors):
+        self.user_ids = list(user_ids)
+        self.karma_values = karma_values
+        self.karma_lvl_values = karma_lvl_values
+        # position -> (error type name, message) for users whose calculation failed
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def to_records(self):
+        records = []
+        karma_values, karma_lvl_values = self.karma_values.tolist(), self.karma_lvl_values.tolist()
+        for position, user_id in enumerate(self.user_ids):
+            if position in self.errors:
+                error_type, error_message = self.errors[position]
+                records.append({"user_id": user_id, "error_type": error_type, "error_message": error_message})
+            else:
+                records.append({"karma_value": karma_values[position], "karma_lvl_value": karma_lvl_values[position],
+                                "user_id": user_id})
+        return records
+
+
+class KarmaBatchEngine:
+    """
+    Evaluates A(t), R(t), post rating, karma and karma level for many users at once on columns of formula inputs.
+    Uses the same closed forms and operation order as the FormulaService data classes, so every value is identical
+    to a per-user calculation; a user whose calculation would raise gets an entry in errors instead.
+    """
+
+    A_EVENTS = (
+        # (iterations column, event value column, constant column)
+        ('unique_impression_sum_iterations', 'I_j', 'c4'),
+        ('unique_view_sum_iterations', 'V_j', 'c5'),
+        ('unique_full_view_sum_iterations', 'F_j', 'c6'),
+        ('impression_sum_iterations', 'I_small_j', 'c7'),
+        ('view_sum_iterations', 'V_small_j', 'c8'),
+        ('full_view_sum_iterations', 'F_small_j', 'c9'),
+    )
+    R_EVENTS = (
+        # (iterations column, event value column, constant column, decreasing function column)
+        ('reply_function_iterations_num', 'r_j', 'c10', 'g_t_tj_result'),
+        ('like_function_iterations_num', 'l_j', 'c11', 'g_t_tj_result'),
+        ('master_class_iterations_num', 'm_j', 'c12', 'y_t_tj_result'),
+        ('comment_function_iterations_num', 's_j', 'c13', 'y_t_tj_result'),
+        ('payment_function_iterations_num', 'p_j', 'c14', 'y_t_tj_result'),
+    )
+
+    # placeholder of a field a user's record does not have, told apart from an explicit null
+    MISSING = object()
+
+    @staticmethod
+    def columns_from_records(records):
+        """Adapter responses (one dict per user) as a dict of columns, fields a record lacks become MISSING."""
+        columns = {}
+        for position, record in enumerate(records):
+            for name, value in record.items():
+                columns.setdefault(name, [KarmaBatchEngine.MISSING] * len(records))[position] = value
+        return columns
+
+    @staticmethod
+    def _column(columns, name, n_users):
+        """Values of a column as floats plus the masks of missing and non-numeric values, which are NaN."""
+        try:
+            values = columns[name]
+        except KeyError:
+            raise KarmaBatchError(f"Formula input column '{name}' is missing")
+        if len(values) != n_users:
+            raise KarmaBatchError(f"Formula input column '{name}' has {len(values)} values, expected {n_users}")
+        if not isinstance(values, list):
+            values = np.asarray(values, dtype=np.float64)
+            return values, np.zeros(n_users, dtype=bool), np.zeros(n_users, dtype=bool)
+
+        missing = np.array([value is KarmaBatchEngine.MISSING for value in values], dtype=bool)
+        # what the per-user formulas can multiply: numbers, bools included; None and strings raise TypeError there
+        non_numeric = np.array([not isinstance(value, (int, float)) for value in values], dtype=bool) & ~missing
+        numbers = np.array([np.nan if invalid else value for value, invalid in zip(values, missing | non_numeric)],
+                           dtype=np.float64)
+        return numbers, missing, non_numeric
+
+    @staticmethod
+    def _event_sum(times_to_sum, term):
+        # no events contribute 0.0 even when the term itself is undefined, like an empty loop
+        return np.where(times_to_sum > 0, times_to_sum * term, 0.0)
+
+    @staticmethod
+    def _is_valid_float(values):
+        return np.abs(values) <= sys.float_info.max
+
+    @np.errstate(over='ignore', invalid='ignore')
+    def calculate(self, user_ids, post_rating_columns, a_columns, r_columns, karma_columns, karma_level_columns):
+        n_users = len(user_ids)
+        errors = {}
+
+        def fail(mask, error_type, message):
+            # the first failing formula of a user decides the error, like the exception in a per-user calculation
+            for position in np.flatnonzero(mask).tolist():
+                errors.setdefault(position, (error_type, message))
+
+        def column(columns, name):
+            # NaN inputs are not computed with: _event_sum would turn them into a plausible 0 contribution
+            values, missing, non_numeric = KarmaBatchEngine._column(columns, name, n_users)
+            fail(missing, 'KeyError', f"'{name}'")
+            fail(non_numeric, 'TypeError', f"Formula input '{name}' is not a number")
+            return values
+
+        a_k_j, f_t_tj = column(a_columns, 'k_j'), column(a_columns, 'f_t_tj_result')
+        a_result = 0.0
+        for iterations, event_value, constant in KarmaBatchEngine.A_EVENTS:
+            term = column(a_columns, constant) * a_k_j * column(a_columns, event_value) * f_t_tj
+            a_result = a_result + self._event_sum(column(a_columns, iterations), term)
+        fail(~self._is_valid_float(a_result), 'ValueError', "A(t) formula resulted in an invalid float result")
+
+        r_k_j = column(r_columns, 'k_j')
+        r_result = 0.0
+        for iterations, event_value, constant, decreasing_function in KarmaBatchEngine.R_EVENTS:
+            term = column(r_columns, constant) * r_k_j * column(r_columns, event_value) * \
+                column(r_columns, decreasing_function)
+            r_result = r_result + self._event_sum(column(r_columns, iterations), term)
+        fail(~self._is_valid_float(r_result), 'ValueError', "R(t) formula resulted in an invalid float result")
+
+        post_rating_result = column(post_rating_columns, 'c1') * column(post_rating_columns, 'k_j') * \
+            column(post_rating_columns, 'Ka_t0') * \
+            (column(post_rating_columns, 'c2') * a_result + column(post_rating_columns, 'c3') * r_result)
+
+        post_rating_sum = self._event_sum(column(karma_columns, 'post_rating_sum_iterations'), post_rating_result)
+        karma_result = column(karma_columns, 'c15') * column(karma_columns, 'p_a') * \
+            column(karma_columns, 'z_n_result') * column(karma_columns, 'h_t_tr_result') * post_rating_sum + \
+            column(karma_columns, 'c_reg') + column(karma_columns, 'alpha')
+
+        # K_t is NaN only when an input was missing, which already failed above
+        c16 = column(karma_level_columns, 'c16')
+        fail(~(karma_result > 0), 'ValueError', "K_t cannot be null or less than 0")
+        fail(~(c16 > 0), 'ValueError', "c16 cannot be null or less than 0")
+
+        karma_lvl_result = np.full(n_users, np.nan)
+        valid = (karma_result > 0) & (c16 > 0)
+        # math.log instead of np.log: NumPy's vectorized log may differ in the last bit
+        logs = np.fromiter(map(math.log, karma_result[valid].tolist()), dtype=np.float64, count=int(valid.sum()))
+        karma_lvl_result[valid] = np.abs(c16[valid] * logs)
+
+        return KarmaBatchResult(user_ids, karma_result, karma_lvl_result, errors)
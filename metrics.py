@@ -0,0 +1,204 @@
+import bisect
+import logging
+import threading
+import time
+
+
+class MetricsError(Exception):
+    """Custom exception for metrics errors."""
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter per label combination."""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, value=1):
+        if len(label_values) != len(self.label_names):
+            raise MetricsError(f"{self.name} expects labels {self.label_names}, got {label_values}")
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+        for label_values, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Latency histogram per label combination with fixed upper bounds, rendered cumulatively as Prometheus expects.
+    An observation is a bisect and three additions under the lock, cheap enough for every request.
+    """
+
+    DEFAULT_BUCKETS_IN_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS_IN_S):
+        if list(buckets) != sorted(buckets) or not buckets:
+            raise MetricsError(f"{name} buckets must be a non-empty ascending sequence")
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if len(label_values) != len(self.label_names):
+            raise MetricsError(f"{self.name} expects labels {self.label_names}, got {label_values}")
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items()),
+                            key=lambda item: tuple(map(str, item[0])))
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, [('le', _format_value(upper_bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Timer:
+    """Context manager observing the elapsed wall time of its block, also when the block raises."""
+
+    __slots__ = ('histogram', 'label_values', 'started_at')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.histogram is not None:
+            self.histogram.observe(time.perf_counter() - self.started_at, *self.label_values)
+        return False
+
+
+class Metrics:
+    """
+    Process-wide metrics of the service, rendered in the Prometheus text format by /metrics.
+    Latencies and counters are recorded on the hot path; gauges that already exist elsewhere (cache hit counters,
+    database and adapter pools) are read by collectors only when scraped. Every gunicorn worker has its own values.
+    """
+
+    _disabled_timer = Timer(None, ())
+
+    enabled = True
+
+    stage_latency = Histogram('recommender_stage_duration_seconds',
+                              'Duration of a pipeline stage.', ('pipeline', 'stage', 'algo'))
+    request_latency = Histogram('recommender_http_request_duration_seconds',
+                                'Duration of HTTP requests per route.', ('method', 'route', 'status'))
+    adapter_latency = Histogram('recommender_adapter_request_duration_seconds',
+                                'Duration of formula data adapter calls including retries.', ('method', 'endpoint'))
+    adapter_calls = Counter('recommender_adapter_requests_total',
+                            'Formula data adapter calls by outcome.', ('method', 'endpoint', 'outcome'))
+
+    _collectors = []
+    _collectors_lock = threading.Lock()
+
+    @staticmethod
+    def configure(app_config):
+        Metrics.enabled = app_config.metrics_enabled
+
+    @staticmethod
+    def stage(pipeline, stage, algo=''):
+        """Times a block as one stage of a pipeline: `with Metrics.stage('recommend', 'fit', algo): ...`."""
+        if not Metrics.enabled:
+            return Metrics._disabled_timer
+        return Timer(Metrics.stage_latency, (pipeline, stage, algo))
+
+    @staticmethod
+    def observe_request(method, route, status, duration_in_s):
+        if Metrics.enabled:
+            Metrics.request_latency.observe(duration_in_s, method, route, str(status))
+
+    @staticmethod
+    def observe_adapter_call(method, endpoint, outcome, duration_in_s):
+        if Metrics.enabled:
+            Metrics.adapter_latency.observe(duration_in_s, method, endpoint)
+            Metrics.adapter_calls.inc(method, endpoint, outcome)
+
+    @staticmethod
+    def register_collector(collector):
+        """
+        Adds a callable returning (name, type, documentation, [(labels dict, value), ...]) tuples, called on every scrape.
+        Modules register their collectors when imported, so nothing is loaded just to be measured.
+        """
+        with Metrics._collectors_lock:
+            Metrics._collectors.append(collector)
+
+    @staticmethod
+    def render():
+        lines = []
+        for metric in (Metrics.stage_latency, Metrics.request_latency, Metrics.adapter_latency, Metrics.adapter_calls):
+            lines.extend(metric.render())
+
+        with Metrics._collectors_lock:
+            collectors = list(Metrics._collectors)
+        # several collectors may report the same family (e.g. hit counters of different caches), each is rendered once
+        families = {}
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                # one broken collector must not take the whole scrape down
+                logging.getLogger(Metrics.__name__).error(f"Metrics collector {collector.__qualname__} failed: {e}")
+                continue
+            for name, metric_type, documentation, samples in collected:
+                families.setdefault(name, (metric_type, documentation, []))[2].extend(samples)
+
+        for name, (metric_type, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
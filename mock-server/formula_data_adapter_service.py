@@ -1,8 +1,85 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, abort
+import argparse
 import datetime
+import os
+import random
+import threading
+import time
 
 app = Flask(__name__)
 
+
+class FaultInjection:
+    """
+    Latency, jitter and errors added to the adapter routes, for load tests against a slow or failing adapter.
+    Settings per route prefix ('a-formula', 'update-info', ...) override the defaults; routes under /mock are never delayed.
+    Start values come from the command line or MOCK_* environment variables and can be changed at runtime:
+        POST /mock/faults {"latency_ms": 50, "jitter_ms": 10, "error_rate": 0.01, "routes": {"r-formula": {"latency_ms": 200}}}
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503):
+        self.lock = threading.Lock()
+        self.defaults = {"latency_ms": latency_ms, "jitter_ms": jitter_ms, "error_rate": error_rate,
+                         "error_status": error_status}
+        self.routes = {}
+
+    @staticmethod
+    def route_of(path):
+        # /v1/formula-data/a-formula/1 -> a-formula, /v1/formula-data/a-formula/batch -> a-formula/batch,
+        # /v1/update-info/batch -> update-info/batch
+        parts = [part for part in path.split('/') if part][1:]
+        if parts and parts[0] == 'formula-data':
+            parts = parts[1:]
+        if len(parts) > 1 and parts[1] != 'batch':
+            parts = parts[:1]
+        return '/'.join(parts)
+
+    def settings_for(self, route):
+        with self.lock:
+            settings = dict(self.defaults)
+            # 'a-formula' applies to the batch route as well, 'a-formula/batch' only to it
+            settings.update(self.routes.get(route.split('/')[0], {}))
+            settings.update(self.routes.get(route, {}))
+            return settings
+
+    def update(self, changes):
+        with self.lock:
+            if changes.get('reset_routes'):
+                self.routes = {}
+            for name in self.defaults:
+                if name in changes:
+                    self.defaults[name] = changes[name]
+            for route, route_settings in changes.get('routes', {}).items():
+                self.routes.setdefault(route, {}).update(route_settings)
+
+    def to_dict(self):
+        with self.lock:
+            return {**self.defaults, "routes": dict(self.routes)}
+
+    def apply(self):
+        if request.path.startswith('/mock'):
+            return
+        settings = self.settings_for(FaultInjection.route_of(request.path))
+        delay_ms = settings["latency_ms"] + random.uniform(-settings["jitter_ms"], settings["jitter_ms"])
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+        if settings["error_rate"] > 0 and random.random() < settings["error_rate"]:
+            abort(settings["error_status"])
+
+
+faults = FaultInjection(latency_ms=float(os.environ.get('MOCK_LATENCY_MS', 0)),
+                        jitter_ms=float(os.environ.get('MOCK_JITTER_MS', 0)),
+                        error_rate=float(os.environ.get('MOCK_ERROR_RATE', 0)),
+                        error_status=int(os.environ.get('MOCK_ERROR_STATUS', 503)))
+app.before_request(faults.apply)
+
+
+@app.route('/mock/faults', methods=['GET', 'POST'])
+def mock_faults():
+    if request.method == 'POST':
+        faults.update(request.get_json())
+    return jsonify(faults.to_dict())
+
 class KarmaFormulaData:
     def __init__(self, user_id):
         self.final_formula_result = None
@@ -38,6 +115,11 @@ def karma_formula(userId):
 
     return jsonify(response)
 
+# Endpoint: POST /v1/formula-data/karma-formula/batch {"user_ids": [...]}
+@app.route('/v1/formula-data/karma-formula/batch', methods=['POST'])
+def karma_formula_batch():
+    return jsonify([karma_formula(user_id).get_json() for user_id in request.get_json()['user_ids']])
+
 # Endpoint 2: GET /v1/formula-data/a-formula/:userId
 class AData:
     def __init__(self, user_id):
@@ -105,6 +187,11 @@ def a_formula(userId):
     response = {attr: getattr(a_data, attr) for attr in vars(a_data)}
     return jsonify(response)
 
+# Endpoint: POST /v1/formula-data/a-formula/batch {"user_ids": [...]}
+@app.route('/v1/formula-data/a-formula/batch', methods=['POST'])
+def a_formula_batch():
+    return jsonify([a_formula(user_id).get_json() for user_id in request.get_json()['user_ids']])
+
 class RData:
     def __init__(self, user_id):
         self.final_formula_result = None
@@ -164,6 +251,11 @@ def r_data(userId):
     response = {attr: getattr(r_data, attr) for attr in vars(r_data)}
     return jsonify(response)
 
+# Endpoint: POST /v1/formula-data/r-formula/batch {"user_ids": [...]}
+@app.route('/v1/formula-data/r-formula/batch', methods=['POST'])
+def r_data_batch():
+    return jsonify([r_data(user_id).get_json() for user_id in request.get_json()['user_ids']])
+
 class KarmaLevelData:
     def __init__(self, user_id):
         self.final_formula_result = None
@@ -181,6 +273,11 @@ def karma_level(userId):
     response = {attr: getattr(karma_level_data, attr) for attr in vars(karma_level_data)}
     return jsonify(response)
 
+# Endpoint: POST /v1/formula-data/karma-level/batch {"user_ids": [...]}
+@app.route('/v1/formula-data/karma-level/batch', methods=['POST'])
+def karma_level_batch():
+    return jsonify([karma_level(user_id).get_json() for user_id in request.get_json()['user_ids']])
+
 class PostRatingData:
     def __init__(self, user_id):
         self.final_formula_result = None
@@ -207,6 +304,11 @@ def post_rating(userId):
     response = {attr: getattr(post_rating_external_data, attr) for attr in vars(post_rating_external_data)}
     return jsonify(response)
 
+# Endpoint: POST /v1/formula-data/post-rating/batch {"user_ids": [...]}
+@app.route('/v1/formula-data/post-rating/batch', methods=['POST'])
+def post_rating_batch():
+    return jsonify([post_rating(user_id).get_json() for user_id in request.get_json()['user_ids']])
+
 
 # Define the class for parsing incoming JSON data
 class CalculationResult:
@@ -224,9 +326,42 @@ def update_info():
     data = request.get_json()
     # Create an instance of CalculationResult
     calculation_result = CalculationResult(**data)
-    print(f"CalculationResult(karma_value={calculation_result.karma_value}, karma_lvl_value={calculation_result.karma_lvl_value}, user_id={calculation_result.user_id})")
+    if not app.config.get('QUIET'):
+        print(f"CalculationResult(karma_value={calculation_result.karma_value}, karma_lvl_value={calculation_result.karma_lvl_value}, user_id={calculation_result.user_id})")
+
+    return jsonify({"message": "Data received successfully"}), 200
+
+@app.route('/v1/update-info/batch', methods=['POST'])
+def update_info_batch():
+    data = request.get_json()
+    calculation_results = [CalculationResult(**item) for item in data]
+    if not app.config.get('QUIET'):
+        print(f"Received {len(calculation_results)} calculation results, first: {calculation_results[0] if calculation_results else None}")
 
     return jsonify({"message": "Data received successfully"}), 200
 
 if __name__ == '__main__':
-    app.run(port=5002)
+    parser = argparse.ArgumentParser(description='Mock formula data adapter')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5002)
+    parser.add_argument('--latency-ms', type=float, help='added to every adapter call')
+    parser.add_argument('--jitter-ms', type=float, help='uniform +/- variation of the latency')
+    parser.add_argument('--error-rate', type=float, help='share of calls answered with --error-status')
+    parser.add_argument('--error-status', type=int)
+    parser.add_argument('--route', action='append', default=[], metavar='ROUTE:LATENCY_MS[:JITTER_MS[:ERROR_RATE]]',
+                        help='per route settings, e.g. r-formula:200:20:0.05')
+    parser.add_argument('--quiet', action='store_true', help='do not print received updates')
+    args = parser.parse_args()
+
+    changes = {name: value for name, value in (('latency_ms', args.latency_ms), ('jitter_ms', args.jitter_ms),
+                                               ('error_rate', args.error_rate), ('error_status', args.error_status))
+               if value is not None}
+    changes['routes'] = {}
+    for route_setting in args.route:
+        route, *values = route_setting.split(':')
+        changes['routes'][route] = {name: float(value)
+                                    for name, value in zip(('latency_ms', 'jitter_ms', 'error_rate'), values)}
+    faults.update(changes)
+    app.config['QUIET'] = args.quiet
+    # threaded, so a slow route delays only its own callers, like the real adapter
+    app.run(host=args.host, port=args.port, threaded=True)
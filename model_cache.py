@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+class ModelCacheError(Exception):
+    """Custom exception for model cache errors."""
+
+
+# Immutable snapshot of a published model; swapping the whole tuple makes the update atomic for readers
+ModelVersion = namedtuple('ModelVersion', ['key', 'version', 'model', 'trained_at', 'train_duration_in_s'])
+
+
+class ModelCache:
+    """Thread-safe, versioned LRU registry of trained models keyed by (algo, user_col, item_col, rating_col) with a TTL."""
+
+    def __init__(self, ttl_in_s, max_size):
+        if ttl_in_s is None or ttl_in_s < 0:
+            raise ModelCacheError("Cache TTL must be a non-negative number")
+        if max_size is None or max_size <= 0:
+            raise ModelCacheError("Cache max size must be a positive integer")
+        self.ttl_in_s = ttl_in_s
+        self.max_size = max_size
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _is_expired(self, entry, now):
+        return (now - entry.trained_at) > self.ttl_in_s
+
+    def _lookup(self, key, now, allow_stale=False):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry, now):
+            if not allow_stale:
+                return None
+            self.stale_hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, allow_stale=False):
+        with self._lock:
+            entry = self._lookup(key, time.time(), allow_stale)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry.model
+
+    def peek(self, key):
+        # Returns the current ModelVersion without touching LRU order, TTL or counters
+        with self._lock:
+            return self._entries.get(key)
+
+    def publish(self, key, model, train_duration_in_s=0.0, trained_at=None):
+        with self._lock:
+            self.version += 1
+            entry = ModelVersion(key, self.version, model, trained_at if trained_at is not None else time.time(),
+                                 train_duration_in_s)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._key_locks.pop(evicted_key, None)
+                self.evictions += 1
+                logging.getLogger(ModelCache.__name__).info(f"Evicted model {evicted_key} from cache")
+            return entry
+
+    def train_and_publish(self, key, train):
+        started_at = time.perf_counter()
+        model = train()
+        entry = self.publish(key, model, time.perf_counter() - started_at)
+        logging.getLogger(ModelCache.__name__).info(
+            f"Published model {key} version {entry.version} (trained in {entry.train_duration_in_s:.3f}s)")
+        return entry
+
+    def get_or_train(self, key, train, allow_stale=False):
+        with self._lock:
+            entry = self._lookup(key, time.time(), allow_stale)
+            if entry is not None:
+                self.hits += 1
+                return entry.model
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another request may have trained this key while we were waiting
+            with self._lock:
+                entry = self._lookup(key, time.time(), allow_stale)
+                if entry is not None:
+                    self.hits += 1
+                    return entry.model
+                self.misses += 1
+
+            logging.getLogger(ModelCache.__name__).info(f"Cache miss for model {key}, training")
+            return self.train_and_publish(key, train).model
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_in_s": self.ttl_in_s,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "version": self.version,
+                "models": [
+                    {
+                        "key": list(entry.key),
+                        "version": entry.version,
+                        "trained_at": entry.trained_at,
+                        "train_duration_in_s": entry.train_duration_in_s,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
@@ -0,0 +1,203 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from batch_scoring import BatchScorer
+from ratings_snapshot import RatingsSnapshot
+
+
+class ModelStoreError(Exception):
+    """Custom exception for model store errors."""
+
+
+class ModelStore:
+    """
+    Directory of published scorer artifacts (.npy arrays + meta.json) that every worker process memory-maps read-only.
+    One process trains a key under an exclusive file lock and publishes it; the others attach to the published
+    version instead of training their own copy, so the OS page cache holds a single copy for all workers.
+    On a persistent directory the artifacts survive restarts and are used to warm-start new processes.
+    """
+
+    FORMAT_VERSION = 1
+    CURRENT_FILE = 'CURRENT'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            raise ModelStoreError(f"Cannot create model store directory {directory}: {e}")
+        # key directory -> (version name, attached scorer), so repeated attaches reuse the same mapping
+        self._attached = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(app_config):
+        if not app_config.model_store_enabled:
+            return None
+        try:
+            return ModelStore(app_config.model_store_directory)
+        except ModelStoreError as e:
+            # every worker falls back to its own private models
+            logging.getLogger(ModelStore.__name__).warning(f"Model store disabled: {e}")
+            return None
+
+    @staticmethod
+    def _key_slug(key):
+        readable = re.sub(r'[^A-Za-z0-9_.-]', '_', '__'.join(str(part) for part in key))
+        digest = hashlib.sha1(repr(tuple(key)).encode('utf-8')).hexdigest()[:8]
+        return f"{readable[:100]}-{digest}"
+
+    def _key_directory(self, key):
+        return os.path.join(self.directory, self._key_slug(key))
+
+    @contextmanager
+    def _exclusive(self, key):
+        key_directory = self._key_directory(key)
+        os.makedirs(key_directory, exist_ok=True)
+        with open(os.path.join(key_directory, ModelStore.LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def current_version(self, key):
+        """(version name, metadata) of the published artifact for key, or None."""
+        current = self._read_current(self._key_directory(key))
+        if current is None or current[1].get('key') != list(key):
+            return None
+        return current
+
+    def published_keys(self):
+        keys = []
+        for name in sorted(os.listdir(self.directory)):
+            key_directory = os.path.join(self.directory, name)
+            if not os.path.isdir(key_directory):
+                continue
+            current = self._read_current(key_directory)
+            if current is not None:
+                keys.append(tuple(current[1]['key']))
+        return keys
+
+    @staticmethod
+    def _read_current(key_directory):
+        try:
+            with open(os.path.join(key_directory, ModelStore.CURRENT_FILE), 'r') as file:
+                version_name = file.read().strip()
+            with open(os.path.join(key_directory, version_name, 'meta.json'), 'r') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if meta.get('format_version') != ModelStore.FORMAT_VERSION:
+            return None
+        return version_name, meta
+
+    def publish(self, key, scorer: BatchScorer):
+        key_directory = self._key_directory(key)
+        os.makedirs(key_directory, exist_ok=True)
+        version_name = f"v{time.time_ns()}-{os.getpid()}"
+        tmp_directory = tempfile.mkdtemp(prefix='.publish-', dir=key_directory)
+        try:
+            scorer.snapshot.save(os.path.join(tmp_directory, 'snapshot'))
+            arrays = scorer.artifact_arrays()
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), np.asarray(array))
+            meta = {
+                'format_version': ModelStore.FORMAT_VERSION,
+                'key': list(key),
+                'kind': scorer.KIND,
+                'params': scorer.artifact_params(),
+                'arrays': sorted(arrays.keys()),
+                'trained_at': time.time(),
+            }
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as file:
+                json.dump(meta, file)
+            os.replace(tmp_directory, os.path.join(key_directory, version_name))
+        except Exception:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+
+        # switching the pointer file is the atomic publish step
+        current_tmp = os.path.join(key_directory, f".{ModelStore.CURRENT_FILE}.{os.getpid()}")
+        with open(current_tmp, 'w') as file:
+            file.write(version_name)
+        os.replace(current_tmp, os.path.join(key_directory, ModelStore.CURRENT_FILE))
+        self._remove_old_versions(key_directory, version_name)
+        logging.getLogger(ModelStore.__name__).info(f"Published model {key} as {version_name}")
+        return version_name
+
+    @staticmethod
+    def _remove_old_versions(key_directory, keep_version_name):
+        # mapped files stay readable for processes still attached to them after unlinking
+        for name in os.listdir(key_directory):
+            if name.startswith('v') and name != keep_version_name:
+                shutil.rmtree(os.path.join(key_directory, name), ignore_errors=True)
+
+    def attach(self, key):
+        """Memory-maps the current published version of key regardless of its age; None when nothing compatible exists."""
+        current = self.current_version(key)
+        if current is None:
+            return None
+        version_name, meta = current
+        key_directory = self._key_directory(key)
+
+        with self._lock:
+            attached = self._attached.get(key_directory)
+            if attached is not None and attached[0] == version_name:
+                return attached[1]
+
+        version_directory = os.path.join(key_directory, version_name)
+        try:
+            snapshot = RatingsSnapshot.load(os.path.join(version_directory, 'snapshot'))
+            arrays = {name: np.load(os.path.join(version_directory, f"{name}.npy"), mmap_mode='r')
+                      for name in meta['arrays']}
+            scorer = BatchScorer.from_artifact(meta['kind'], meta['params'], arrays, snapshot)
+        except Exception as e:
+            # the version may have been replaced and removed while we were reading it
+            logging.getLogger(ModelStore.__name__).warning(f"Could not attach model {key} ({version_name}): {e}")
+            return None
+
+        with self._lock:
+            self._attached[key_directory] = (version_name, scorer)
+        return scorer
+
+    def _attach_if_fresh(self, key, max_age_in_s):
+        current = self.current_version(key)
+        if current is None or (time.time() - current[1]['trained_at']) >= max_age_in_s:
+            return None
+        return self.attach(key)
+
+    def get_or_train(self, key, train, max_age_in_s):
+        """Attaches the published model for key if younger than max_age_in_s, otherwise trains it exactly once."""
+        scorer = self._attach_if_fresh(key, max_age_in_s)
+        if scorer is not None:
+            return scorer
+
+        with self._exclusive(key):
+            # another worker may have published while we waited for the lock
+            scorer = self._attach_if_fresh(key, max_age_in_s)
+            if scorer is not None:
+                return scorer
+            try:
+                trained_scorer = train()
+            except Exception:
+                # a key that cannot train (unknown columns or algo) must not leave its directory and lock behind
+                if self.current_version(key) is None:
+                    shutil.rmtree(self._key_directory(key), ignore_errors=True)
+                raise
+            self.publish(key, trained_scorer)
+
+        # prefer the shared mapping over this process's private copy
+        return self.attach(key) or trained_scorer
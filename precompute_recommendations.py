@@ -0,0 +1,172 @@
+# precompute_recommendations.py
+"""
+Materializes the top-n recommendations of every user into the precomputed store (precompute.directory),
+from which /v1/recommend answers with precompute.serving enabled.
+
+The model is trained once (or attached from the model store), then the users are scored in chunks
+by a pool of forkserver worker processes that each receive the model once. Optionally the result is also copied
+into a Postgres table (user, rank, item, rating) with COPY, replacing the table atomically.
+
+    python precompute_recommendations.py --algo SVD
+    python precompute_recommendations.py --algo KNN_SPARSE --top-n 20 --workers 8 --postgres-table recommendation_service.top_n
+"""
+import argparse
+import io
+import logging
+import multiprocessing
+import re
+import time
+
+import numpy as np
+
+from app_configuration import AppConfig
+from batch_scoring import BatchScorer
+from data_access import DataAccess
+from precomputed_store import PrecomputedStore
+from recommendation_service import RecommendationService
+
+
+class PrecomputeError(Exception):
+    """Custom exception for precompute job errors."""
+
+
+# set in every worker by _init_worker, read by _score_chunk
+_scorer = None
+_top_n = None
+
+
+def _init_worker(scorer, top_n):
+    global _scorer, _top_n
+    _scorer, _top_n = scorer, top_n
+
+
+def _score_chunk(user_codes):
+    start, end = user_codes
+    inner_uids = list(range(start, end))
+    scores = _scorer.score_users(inner_uids)
+    rows, columns = BatchScorer.top_n_rows(scores, _scorer.rated_mask(inner_uids), _top_n)
+
+    counts = np.bincount(rows, minlength=len(inner_uids))
+    ranks = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    item_codes = np.zeros((len(inner_uids), _top_n), dtype=np.int32)
+    ratings = np.full((len(inner_uids), _top_n), np.nan)
+    item_codes[rows, ranks] = columns
+    ratings[rows, ranks] = scores[rows, columns]
+    return start, item_codes, ratings, counts.astype(np.int32)
+
+
+def precompute(scorer: BatchScorer, top_n, workers, chunk_size):
+    """Item codes, ratings and counts of the top_n of every snapshot user, in user code order."""
+    n_users = scorer.snapshot.n_users
+    item_codes = np.zeros((n_users, top_n), dtype=np.int32)
+    ratings = np.full((n_users, top_n), np.nan)
+    counts = np.zeros(n_users, dtype=np.int32)
+
+    chunks = [(start, min(start + chunk_size, n_users)) for start in range(0, n_users, chunk_size)]
+
+    def collect(results):
+        started_at = time.perf_counter()
+        for done, (start, chunk_items, chunk_ratings, chunk_counts) in enumerate(results, 1):
+            end = start + len(chunk_counts)
+            item_codes[start:end], ratings[start:end], counts[start:end] = chunk_items, chunk_ratings, chunk_counts
+            if done % 100 == 0 or done == len(chunks):
+                logging.getLogger('precompute_recommendations').info(
+                    f"Scored {min(done * chunk_size, n_users)} of {n_users} users "
+                    f"in {time.perf_counter() - started_at:.1f}s")
+
+    if workers <= 1:
+        _init_worker(scorer, top_n)
+        try:
+            collect(map(_score_chunk, chunks))
+        finally:
+            _init_worker(None, None)
+    else:
+        # not fork: the parent may already run threads (the config file watcher), a forked child could inherit
+        # a lock held by one of them. The scorer is pickled once per worker, memory-mapped arrays included.
+        # Leaving the with block terminates the workers, also when scoring or collecting fails
+        with multiprocessing.get_context('forkserver').Pool(workers, _init_worker, (scorer, top_n)) as pool:
+            collect(pool.imap_unordered(_score_chunk, chunks))
+    return item_codes, ratings, counts
+
+
+def copy_to_postgres(table, user_col, item_col, rating_col, user_raw_ids, item_raw_ids, item_codes, ratings, counts,
+                     batch_rows=1_000_000):
+    """Loads the rows with COPY into a staging table and swaps it in, readers see the old or the new table."""
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?', table):
+        raise PrecomputeError(f"Invalid table name '{table}'")
+    schema, _, name = table.rpartition('.')
+    qualified = f"\"{schema}\".\"{name}\"" if schema else f"\"{name}\""
+    staging = f"\"{schema}\".\"{name}_staging\"" if schema else f"\"{name}_staging\""
+
+    connection = DataAccess.get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        # \" -> no sql inj possible
+        cursor.execute(f"CREATE TABLE {staging} (\"{user_col}\" TEXT NOT NULL, \"rank\" INTEGER NOT NULL, "
+                       f"\"{item_col}\" TEXT NOT NULL, \"{rating_col}\" DOUBLE PRECISION NOT NULL)")
+        rows_per_batch = max(1, batch_rows // max(1, item_codes.shape[1]))
+        for start in range(0, len(counts), rows_per_batch):
+            buffer = io.StringIO()
+            for row in range(start, min(start + rows_per_batch, len(counts))):
+                user_id = user_raw_ids[row]
+                for rank in range(int(counts[row])):
+                    buffer.write(f"{user_id}\t{rank + 1}\t{item_raw_ids[item_codes[row, rank]]}\t{ratings[row, rank]!r}\n")
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {staging} FROM STDIN", buffer)
+        cursor.execute(f"CREATE INDEX ON {staging} (\"{user_col}\", \"rank\")")
+        cursor.execute(f"DROP TABLE IF EXISTS {qualified}")
+        cursor.execute(f"ALTER TABLE {staging} RENAME TO \"{name}\"")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def main():
+    app_config = AppConfig.current()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--algo', default='SVD', choices=['KNN', 'SVD', 'KNN_SPARSE'])
+    parser.add_argument('--user-column-name', default='user_id')
+    parser.add_argument('--item-column-name', default='item_id')
+    parser.add_argument('--rating-column-name', default='rating')
+    parser.add_argument('--top-n', type=int, default=app_config.precompute_top_n)
+    parser.add_argument('--workers', type=int, default=app_config.precompute_workers)
+    parser.add_argument('--chunk-size', type=int, default=app_config.precompute_chunk_size)
+    parser.add_argument('--directory', default=app_config.precompute_directory)
+    parser.add_argument('--postgres-table', help='also COPY the result into this [schema.]table')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.top_n <= 0 or args.chunk_size <= 0:
+        raise PrecomputeError("Top n and chunk size must be positive integers")
+    key = (args.algo, args.user_column_name, args.item_column_name, args.rating_column_name)
+
+    started_at = time.perf_counter()
+    service = RecommendationService(DataAccess(app_config.csv_path))
+    scorer = service.train_scorer(args.user_column_name, args.item_column_name, args.rating_column_name, args.algo)
+    trained_at = time.perf_counter()
+    logging.getLogger('precompute_recommendations').info(f"Model {key} ready in {trained_at - started_at:.1f}s")
+
+    item_codes, ratings, counts = precompute(scorer, args.top_n, args.workers, args.chunk_size)
+    scored_at = time.perf_counter()
+
+    snapshot = scorer.snapshot
+    user_raw_ids = snapshot.user_index.to_numpy()
+    directory = PrecomputedStore(args.directory).save(
+        key, user_raw_ids, snapshot.item_raw_ids, item_codes, ratings, counts,
+        {'ratings': snapshot.n_ratings, 'score_duration_in_s': round(scored_at - trained_at, 3),
+         'workers': args.workers})
+    logging.getLogger('precompute_recommendations').info(
+        f"Wrote top {args.top_n} of {len(counts)} users to {directory}, scoring took {scored_at - trained_at:.1f}s")
+
+    if args.postgres_table:
+        copy_to_postgres(args.postgres_table, args.user_column_name, args.item_column_name, args.rating_column_name,
+                         user_raw_ids, snapshot.item_raw_ids, item_codes, ratings, counts)
+        logging.getLogger('precompute_recommendations').info(f"Copied {int(counts.sum())} rows to {args.postgres_table}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class PrecomputedStoreError(Exception):
+    """Custom exception for precomputed store errors."""
+
+
+class PrecomputedRecommendations:
+    """Top-n items and ratings of every user of one model key, rows memory-mapped from the store directory."""
+
+    ARRAY_NAMES = ('user_raw_ids', 'item_raw_ids', 'item_codes', 'ratings', 'counts')
+
+    def __init__(self, meta, user_raw_ids, item_raw_ids, item_codes, ratings, counts):
+        self.meta = meta
+        # hash index, one lookup per request regardless of the number of users
+        self.user_index = pd.Index(user_raw_ids)
+        self.item_raw_ids = item_raw_ids
+        self.item_codes = item_codes
+        self.ratings = ratings
+        self.counts = counts
+
+    @property
+    def top_n(self):
+        return self.item_codes.shape[1]
+
+    @property
+    def created_at(self):
+        return self.meta['created_at']
+
+    def lookup(self, user_id, n):
+        """(item raw ids, ratings) of the n best items of user_id, or None for users that were not precomputed."""
+        row = self.user_index.get_indexer([user_id])[0]
+        if row < 0:
+            return None
+        count = min(int(self.counts[row]), n)
+        return self.item_raw_ids[self.item_codes[row, :count]], np.asarray(self.ratings[row, :count])
+
+
+class PrecomputedStore:
+    """
+    Directory of precomputed top-n recommendations per (algo, user column, item column, rating column),
+    written by precompute_recommendations.py and memory-mapped by every worker process.
+    A key is served while it is younger than max_age_in_s; a new job output is picked up within
+    reload_check_interval_in_s, the directory of a key being replaced atomically.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory, max_age_in_s=86400, reload_check_interval_in_s=10.0):
+        self.directory = directory
+        self.max_age_in_s = max_age_in_s
+        self.reload_check_interval_in_s = reload_check_interval_in_s
+        # key -> (checked_at, meta.json mtime, PrecomputedRecommendations or None)
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_config(app_config):
+        if not app_config.precompute_serving_enabled:
+            return None
+        return PrecomputedStore(app_config.precompute_directory, app_config.precompute_max_age_in_s)
+
+    def key_directory(self, key):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', '__'.join(str(part) for part in key)))
+
+    def save(self, key, user_raw_ids, item_raw_ids, item_codes, ratings, counts, metadata=None):
+        """Writes one .npy file per array plus meta.json; the key directory is replaced atomically."""
+        directory = self.key_directory(key)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(prefix='.precomputed-', dir=self.directory)
+        try:
+            arrays = {'user_raw_ids': user_raw_ids, 'item_raw_ids': item_raw_ids, 'item_codes': item_codes,
+                      'ratings': ratings, 'counts': counts}
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                if array.dtype == object:
+                    # fixed-width strings can be memory-mapped, pickled objects cannot
+                    array = array.astype(str)
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), array)
+
+            meta = dict(metadata or {})
+            meta.update({'format_version': PrecomputedStore.FORMAT_VERSION, 'key': list(key),
+                         'created_at': meta.get('created_at', time.time()), 'users': len(user_raw_ids),
+                         'top_n': int(np.shape(item_codes)[1])})
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as file:
+                json.dump(meta, file)
+
+            if os.path.isdir(directory):
+                stale_directory = tempfile.mkdtemp(prefix='.stale-', dir=self.directory)
+                os.replace(directory, os.path.join(stale_directory, 'precomputed'))
+                os.replace(tmp_directory, directory)
+                shutil.rmtree(stale_directory, ignore_errors=True)
+            else:
+                os.replace(tmp_directory, directory)
+        except Exception:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+        return directory
+
+    def _load(self, directory):
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        if meta.get('format_version') != PrecomputedStore.FORMAT_VERSION:
+            raise PrecomputedStoreError(f"Incompatible precomputed recommendations in {directory}")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+                  for name in PrecomputedRecommendations.ARRAY_NAMES}
+        return PrecomputedRecommendations(meta, **arrays)
+
+    def get(self, key):
+        """The loaded recommendations of key, reloaded when the job replaced them, or None."""
+        now = time.monotonic()
+        entry = self._loaded.get(key)
+        if entry is not None and now - entry[0] < self.reload_check_interval_in_s:
+            return entry[2]
+
+        with self._lock:
+            directory = self.key_directory(key)
+            try:
+                mtime = os.stat(os.path.join(directory, 'meta.json')).st_mtime_ns
+            except OSError:
+                mtime = None
+            entry = self._loaded.get(key)
+            if entry is not None and entry[1] == mtime:
+                recommendations = entry[2]
+            elif mtime is None:
+                recommendations = None
+            else:
+                try:
+                    recommendations = self._load(directory)
+                    logging.getLogger(PrecomputedStore.__name__).info(
+                        f"Loaded precomputed recommendations of {recommendations.meta['users']} users for {key}")
+                except (OSError, ValueError, KeyError, PrecomputedStoreError) as e:
+                    logging.getLogger(PrecomputedStore.__name__).error(f"Cannot load precomputed recommendations {directory}: {e}")
+                    recommendations = None
+            self._loaded[key] = (now, mtime, recommendations)
+            return recommendations
+
+    def lookup(self, key, user_id, n):
+        """(item raw ids, ratings) from the store, None when the caller has to score live."""
+        recommendations = self.get(key)
+        found = None
+        if recommendations is not None and n <= recommendations.top_n and \
+                (self.max_age_in_s <= 0 or time.time() - recommendations.created_at <= self.max_age_in_s):
+            found = recommendations.lookup(user_id, n)
+        with self._lock:
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return found
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "keys": [{"key": list(key), "users": recommendations.meta['users'], "top_n": recommendations.top_n,
+                          "created_at": recommendations.created_at}
+                         for key, (_, _, recommendations) in self._loaded.items() if recommendations is not None],
+            }
@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from surprise import Trainset
+
+
+class RatingsSnapshotError(Exception):
+    """Custom exception for ratings snapshot errors."""
+
+
+class RatingsSnapshot:
+    """
+    Immutable, id-encoded copy of the ratings table shared by training and prediction.
+    Codes are assigned in order of first appearance, exactly like surprise assigns inner ids,
+    so a trainset built from the snapshot uses the snapshot codes as inner ids.
+    """
+
+    FORMAT_VERSION = 2
+    ARRAY_NAMES = ('user_raw_ids', 'item_raw_ids', 'user_codes', 'item_codes', 'ratings', 'user_indptr', 'user_items')
+
+    def __init__(self, user_raw_ids, item_raw_ids, user_codes, item_codes, ratings, watermark=None, full_loaded_at=None,
+                 user_indptr=None, user_items=None):
+        if not (len(user_codes) == len(item_codes) == len(ratings)):
+            raise RatingsSnapshotError("User, item and rating arrays must have the same length")
+        # highest row id seen so far (None when the source has no id column) and the time of the last full load
+        self.watermark = watermark
+        self.full_loaded_at = full_loaded_at
+        self.user_index = pd.Index(user_raw_ids)
+        self.item_index = pd.Index(item_raw_ids)
+        # asarray keeps memory-mapped arrays of the right dtype as they are
+        self.user_codes = np.asarray(user_codes, dtype=np.int32)
+        self.item_codes = np.asarray(item_codes, dtype=np.int32)
+        self.ratings = np.asarray(ratings, dtype=np.float64)
+
+        if user_indptr is not None and user_items is not None:
+            self.user_indptr = np.asarray(user_indptr, dtype=np.int64)
+            self.user_items = np.asarray(user_items, dtype=np.int32)
+            return
+
+        # CSR user -> rated items; a stable sort keeps each user's ratings in table order
+        order = np.argsort(self.user_codes, kind='stable')
+        self.user_items = self.item_codes[order]
+        self.user_indptr = np.zeros(self.n_users + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.user_codes, minlength=self.n_users), out=self.user_indptr[1:])
+
+    @staticmethod
+    def from_columns(user_raw_ids, item_raw_ids, ratings, watermark=None, full_loaded_at=None):
+        user_codes, user_uniques = pd.factorize(user_raw_ids, sort=False)
+        item_codes, item_uniques = pd.factorize(item_raw_ids, sort=False)
+        if (user_codes < 0).any() or (item_codes < 0).any():
+            raise RatingsSnapshotError("User and item ids cannot be null")
+        return RatingsSnapshot(user_uniques, item_uniques, user_codes, item_codes, ratings, watermark, full_loaded_at)
+
+    @staticmethod
+    def from_data_frame(data_frame, user_col, item_col, rating_col, watermark=None, full_loaded_at=None):
+        return RatingsSnapshot.from_columns(data_frame[user_col].to_numpy(), data_frame[item_col].to_numpy(),
+                                            data_frame[rating_col].to_numpy(), watermark, full_loaded_at)
+
+    @staticmethod
+    def _extend_codes(index, raw_ids):
+        codes = index.get_indexer(raw_ids)
+        unseen = codes < 0
+        if not unseen.any():
+            return codes, index
+        new_codes, new_raw_ids = pd.factorize(raw_ids[unseen], sort=False)
+        if (new_codes < 0).any():
+            raise RatingsSnapshotError("User and item ids cannot be null")
+        codes[unseen] = new_codes + len(index)
+        return codes, index.append(pd.Index(new_raw_ids))
+
+    def append(self, user_raw_ids, item_raw_ids, ratings, watermark=None):
+        """New snapshot with the given rows added after the existing ones; existing codes are kept."""
+        if len(ratings) == 0:
+            return self
+        user_codes, user_index = self._extend_codes(self.user_index, np.asarray(user_raw_ids))
+        item_codes, item_index = self._extend_codes(self.item_index, np.asarray(item_raw_ids))
+        return RatingsSnapshot(user_index, item_index,
+                               np.concatenate([self.user_codes, user_codes.astype(np.int32)]),
+                               np.concatenate([self.item_codes, item_codes.astype(np.int32)]),
+                               np.concatenate([self.ratings, np.asarray(ratings, dtype=np.float64)]),
+                               watermark if watermark is not None else self.watermark,
+                               self.full_loaded_at)
+
+    @property
+    def n_users(self):
+        return len(self.user_index)
+
+    @property
+    def n_items(self):
+        return len(self.item_index)
+
+    @property
+    def n_ratings(self):
+        return len(self.ratings)
+
+    @property
+    def item_raw_ids(self):
+        return self.item_index.to_numpy()
+
+    def user_code(self, raw_uid):
+        code = self.user_index.get_indexer([raw_uid])[0]
+        return None if code < 0 else int(code)
+
+    def item_codes_of(self, raw_iids):
+        # -1 marks items that are not in the snapshot
+        return self.item_index.get_indexer(raw_iids)
+
+    def items_rated_by(self, user_code):
+        if user_code is None:
+            return np.empty(0, dtype=np.int32)
+        return self.user_items[self.user_indptr[user_code]:self.user_indptr[user_code + 1]]
+
+    def items_not_rated_by(self, user_code):
+        candidates = np.ones(self.n_items, dtype=bool)
+        candidates[self.items_rated_by(user_code)] = False
+        return np.flatnonzero(candidates)
+
+    def to_trainset(self, rating_scale=(1, 5)):
+        if self.n_ratings == 0:
+            raise RatingsSnapshotError("Cannot build a trainset from an empty ratings snapshot")
+
+        ur = defaultdict(list)
+        ir = defaultdict(list)
+        for user_code, item_code, rating in zip(self.user_codes.tolist(), self.item_codes.tolist(), self.ratings.tolist()):
+            ur[user_code].append((item_code, rating))
+            ir[item_code].append((user_code, rating))
+
+        raw2inner_id_users = {raw_id: code for code, raw_id in enumerate(self.user_index.tolist())}
+        raw2inner_id_items = {raw_id: code for code, raw_id in enumerate(self.item_index.tolist())}
+
+        return Trainset(ur, ir, self.n_users, self.n_items, self.n_ratings, rating_scale,
+                        raw2inner_id_users, raw2inner_id_items)
+
+    def save(self, directory, metadata=None):
+        """Writes one .npy file per array plus meta.json; the directory is replaced atomically."""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+        try:
+            arrays = {
+                'user_raw_ids': self.user_index.to_numpy(),
+                'item_raw_ids': self.item_index.to_numpy(),
+                'user_codes': self.user_codes,
+                'item_codes': self.item_codes,
+                'ratings': self.ratings,
+                'user_indptr': self.user_indptr,
+                'user_items': self.user_items,
+            }
+            for name, array in arrays.items():
+                if array.dtype == object:
+                    # fixed-width strings can be memory-mapped, pickled objects cannot
+                    array = array.astype(str)
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), array)
+
+            meta = dict(metadata or {})
+            meta.update({
+                'format_version': RatingsSnapshot.FORMAT_VERSION,
+                'watermark': self.watermark,
+                'full_loaded_at': self.full_loaded_at,
+            })
+            with open(os.path.join(tmp_directory, 'meta.json'), 'w') as file:
+                json.dump(meta, file)
+
+            if os.path.isdir(directory):
+                stale_directory = tempfile.mkdtemp(prefix='.stale-', dir=parent)
+                os.replace(directory, os.path.join(stale_directory, 'snapshot'))
+                os.replace(tmp_directory, directory)
+                shutil.rmtree(stale_directory, ignore_errors=True)
+            else:
+                os.replace(tmp_directory, directory)
+        except Exception:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def read_metadata(directory):
+        try:
+            with open(os.path.join(directory, 'meta.json'), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def load(directory, mmap=True):
+        meta = RatingsSnapshot.read_metadata(directory)
+        if meta is None or meta.get('format_version') != RatingsSnapshot.FORMAT_VERSION:
+            raise RatingsSnapshotError(f"No compatible ratings snapshot in {directory}")
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in RatingsSnapshot.ARRAY_NAMES}
+        return RatingsSnapshot(arrays['user_raw_ids'], arrays['item_raw_ids'], arrays['user_codes'],
+                               arrays['item_codes'], arrays['ratings'], meta.get('watermark'),
+                               meta.get('full_loaded_at'), arrays['user_indptr'], arrays['user_items'])
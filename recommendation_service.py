@@ -1,11 +1,19 @@
 import logging
 from surprise import KNNBasic, SVD
 from data_access import DataAccess
+from batch_scoring import BatchScorer
+from ratings_snapshot import RatingsSnapshot
 import numpy as np
 import pandas as pd
 import time
 
 from app_configuration import AppConfig
+from metrics import Metrics
+from model_cache import ModelCache
+from model_store import ModelStore
+from precomputed_store import PrecomputedStore
+from retrain_scheduler import RetrainScheduler
+from sparse_knn import SparseKNN
 
 from formula_service import FormulaService
 
@@ -16,11 +24,19 @@ class RecommendationServiceError(Exception):
 
 class RecommendationService:
 
-    config = AppConfig()
+    config = AppConfig.current()
 
-    CACHE_EXPIRY_TIME = config.trainset_cache_time
-    trainset_cache = None
-    last_cache_update = 0
+    model_cache = ModelCache(config.trainset_cache_time, config.model_cache_max_size)
+    # Background refits keep warm models fresh, so requests never wait for a fit once a key is cached
+    retrain_scheduler = RetrainScheduler(model_cache, config.retrain_interval_in_s) if config.retrain_interval_in_s > 0 else None
+    # One ratings load per refresh, shared by every algo trained on the same columns.
+    # Expires no later than the retrain interval so each background refit sees fresh data
+    snapshot_cache = ModelCache(min(config.trainset_cache_time, config.retrain_interval_in_s or config.trainset_cache_time),
+                                config.model_cache_max_size)
+    # Trained models shared read-only by all worker processes, trained by one of them at a time
+    model_store = ModelStore.from_config(config)
+    # Optional: top-n of every user computed offline, looked up instead of scoring
+    precomputed_store = PrecomputedStore.from_config(config)
 
     def __init__(self, data_access: DataAccess):
         if data_access is None:
@@ -29,8 +45,7 @@ class RecommendationService:
         self.algorithm = None
         self.formula_service = FormulaService()
 
-    def train_model(self, user_col: str, item_col: str, rating_col: str, algo='KNN'):
-        #current_time = time.time()
+    def train_model(self, user_col: str, item_col: str, rating_col: str, algo='KNN', snapshot: RatingsSnapshot = None):
         try:
             if not user_col:
                 raise RecommendationServiceError("User column name cannot be null or empty")
@@ -39,28 +54,32 @@ class RecommendationService:
             if not rating_col:
                 raise RecommendationServiceError("Rating column name cannot be null or empty")
 
-            # Check if cache is expired   ## different fields require different trinset
-            # if RecommendationService.trainset_cache is None or (
-            #         current_time - RecommendationService.last_cache_update) > RecommendationService.CACHE_EXPIRY_TIME:
-            #     data = self.data_access.load_data_from_db(user_col, item_col, rating_col)
-            #     RecommendationService.trainset_cache = data.build_full_trainset()
-            #     RecommendationService.last_cache_update = current_time
-            #
-            # trainset = RecommendationService.trainset_cache
-
-            data = self.data_access.load_data_from_db(user_col, item_col, rating_col)
-
-            trainset = data.build_full_trainset()
-
             # Choose the algorithm based on algo parameter
             if algo == 'KNN':
-                self.algorithm = KNNBasic()
+                algorithm = KNNBasic()
             elif algo == 'SVD':
-                self.algorithm = SVD()
+                algorithm = SVD()
+            elif algo == 'KNN_SPARSE':
+                algorithm = SparseKNN(n_neighbors=AppConfig.current().sparse_knn_neighbors,
+                                      block_size=AppConfig.current().sparse_knn_block_size)
             else:
                 raise RecommendationServiceError("Invalid algorithm choice")
 
-            self.algorithm.fit(trainset)
+            if snapshot is None:
+                snapshot = self.get_ratings_snapshot(user_col, item_col, rating_col)
+
+            if algo == 'KNN_SPARSE':
+                # works on the id-encoded snapshot directly, no surprise trainset needed
+                with Metrics.stage('train', 'fit', algo):
+                    algorithm.fit(snapshot)
+            else:
+                with Metrics.stage('train', 'trainset', algo):
+                    trainset = snapshot.to_trainset()
+                with Metrics.stage('train', 'fit', algo):
+                    algorithm.fit(trainset)
+
+            self.algorithm = algorithm
+            return algorithm
 
         except RecommendationServiceError as e:
             logging.getLogger(RecommendationService.__name__).error(f"Error in recommendation service: {e}")
@@ -89,14 +108,30 @@ class RecommendationService:
 
             #logging.getLogger(RecommendationService.__name__).info(f"Karma lvl for user {user_id}: {calculation_result.karma_lvl_value}")
 
-            self.train_model(user_col, item_col, rating_col, algo)
-            predictions = self._predict_ratings(user_id, user_col, item_col, rating_col)
-
-
-            pred_ratings = pd.DataFrame([(pred.uid, pred.iid, pred.est) for pred in predictions],
-                                        columns=[user_col, item_col, rating_col]).sort_values(rating_col, ascending=False)  # order control:  ascending=False
-
-            recommendations = pred_ratings.head(n)
+            store = RecommendationService.precomputed_store
+            if store is not None:
+                with Metrics.stage('recommend', 'precomputed', algo):
+                    precomputed = store.lookup((algo, user_col, item_col, rating_col), user_id, n)
+                if precomputed is not None:
+                    items, ratings = precomputed
+                    return pd.DataFrame({user_col: [user_id] * len(items), item_col: items, rating_col: ratings})
+
+            # a cache miss includes loading the ratings and training, recorded as stages of the 'train' pipeline
+            with Metrics.stage('recommend', 'model', algo):
+                scorer = self.get_trained_model(user_col, item_col, rating_col, algo)
+            with Metrics.stage('recommend', 'predict', algo):
+                items_to_predict, scores = self._predict_ratings(scorer, user_id, user_col, item_col, rating_col, n)
+
+            # partial selection of the n best instead of sorting every prediction, order control: descending
+            with Metrics.stage('recommend', 'top_n', algo):
+                top_indices = BatchScorer.top_n(scores, n)
+
+            with Metrics.stage('recommend', 'frame', algo):
+                recommendations = pd.DataFrame({
+                    user_col: [user_id] * len(top_indices),
+                    item_col: items_to_predict[top_indices],
+                    rating_col: scores[top_indices],
+                })
 
             return recommendations
 
@@ -108,20 +143,177 @@ class RecommendationService:
             logging.getLogger(RecommendationService.__name__).error(f"Unexpected error in get_recommendations: {e}")
             raise RecommendationServiceError(e)
 
-    def _predict_ratings(self, user_id, user_col, item_col, rating_col):
-        try:
-            data_frame = self.data_access.get_postgres_data_frame(user_col, item_col, rating_col)
-            unique_ids = data_frame[item_col].unique()
-            items_rated_by_user = data_frame[data_frame[user_col] == user_id][item_col].unique()
-            items_to_predict = np.setdiff1d(unique_ids, items_rated_by_user)
+    def get_recommendations_batch(self, user_ids, user_col: str, item_col: str, rating_col: str, n=5, algo='KNN',
+                                  chunk_size=256):
+        """
+        Top-n recommendations for many users from one shared model, scored chunk_size users at a time as a matrix.
+        Returns a generator of (user_id, records) per user in input order, records like get_recommendations' rows.
+        """
+        if not user_col:
+            raise RecommendationServiceError("User column name cannot be null or empty")
+        if not item_col:
+            raise RecommendationServiceError("Item column name cannot be null or empty")
+        if not rating_col:
+            raise RecommendationServiceError("Rating column name cannot be null or empty")
+        if n is None or n <= 0:
+            raise RecommendationServiceError("Number of recommendations 'n' must be a positive integer")
 
-            predictions = [self.algorithm.predict(user_id, item_id) for item_id in items_to_predict]
-            return predictions
+        try:
+            # the model is resolved before the first result, so a failed training is raised here and not mid-stream
+            with Metrics.stage('recommend_batch', 'model', algo):
+                scorer = self.get_trained_model(user_col, item_col, rating_col, algo)
+        except Exception as e:
+            logging.getLogger(RecommendationService.__name__).error(f"Error in get_recommendations_batch: {e}")
+            raise RecommendationServiceError(e)
+        item_raw_ids = scorer.snapshot.item_raw_ids
+
+        def recommendations():
+            for start in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[start:start + chunk_size]
+                inner_uids = [scorer.to_inner_uid(user_id) for user_id in chunk]
+                with Metrics.stage('recommend_batch', 'score', algo):
+                    scores = scorer.score_users(inner_uids)
+                with Metrics.stage('recommend_batch', 'top_n', algo):
+                    rows, columns = BatchScorer.top_n_rows(scores, scorer.rated_mask(inner_uids), n)
+                    row_ends = np.searchsorted(rows, np.arange(1, len(chunk) + 1))
+                    # plain Python values, ready for json
+                    items = item_raw_ids[columns].tolist()
+                    ratings = scores[rows, columns].tolist()
+                row_start = 0
+                for user_id, row_end in zip(chunk, row_ends.tolist()):
+                    yield user_id, [{user_col: user_id, item_col: item, rating_col: rating}
+                                    for item, rating in zip(items[row_start:row_end], ratings[row_start:row_end])]
+                    row_start = row_end
+
+        return recommendations()
+
+    def _model_trainer(self, cache_key):
+        algo, user_col, item_col, rating_col = cache_key
+
+        def fit():
+            snapshot = self.get_ratings_snapshot(user_col, item_col, rating_col)
+            current = RecommendationService.model_cache.peek(cache_key)
+            if current is not None and current.model.snapshot is snapshot:
+                # no new ratings since the last fit, refitting would produce the same model
+                return current.model
+            algorithm = self.train_model(user_col, item_col, rating_col, algo, snapshot)
+            scorer = BatchScorer.from_algorithm(algorithm, snapshot)
+            if algo == 'SVD' and AppConfig.current().ann_enabled:
+                with Metrics.stage('train', 'ann_index', algo):
+                    scorer.build_ann_index(AppConfig.current().ann_n_lists)
+            return scorer
+
+        def train():
+            store = RecommendationService.model_store
+            if store is None:
+                return fit()
+            # attach the model another worker already published, or train and publish it for all of them
+            max_age_in_s = RecommendationService.config.retrain_interval_in_s or RecommendationService.config.trainset_cache_time
+            return store.get_or_train(cache_key, fit, max_age_in_s)
+
+        return train
+
+    def train_scorer(self, user_col: str, item_col: str, rating_col: str, algo='KNN'):
+        """A scorer trained on fresh ratings, or attached from the model store, without caching or background refits."""
+        return self._model_trainer((algo, user_col, item_col, rating_col))()
+
+    def get_trained_model(self, user_col: str, item_col: str, rating_col: str, algo='KNN'):
+        # different fields require different trainset, so the column names are part of the key
+        cache_key = (algo, user_col, item_col, rating_col)
+        train = self._model_trainer(cache_key)
+
+        scheduler = RecommendationService.retrain_scheduler
+        if scheduler is None:
+            return RecommendationService.model_cache.get_or_train(cache_key, train)
+
+        # Serve the last published version even past its TTL, the scheduler swaps in a fresh one
+        model = RecommendationService.model_cache.get_or_train(cache_key, train, allow_stale=True)
+        scheduler.register(cache_key, train)
+        return model
+
+    def warm_start(self):
+        """Attaches every model persisted in the model store, so a fresh process serves without training first."""
+        store = RecommendationService.model_store
+        if store is None:
+            return 0
+
+        attached = 0
+        for cache_key in store.published_keys():
+            current = store.current_version(cache_key)
+            scorer = store.attach(cache_key)
+            if current is None or scorer is None:
+                continue
+            # keep the artifact's own train time: without a scheduler the TTL still applies,
+            # with one an old artifact is served while it is refreshed in the background
+            RecommendationService.model_cache.publish(cache_key, scorer, trained_at=current[1]['trained_at'])
+            if RecommendationService.retrain_scheduler is not None:
+                RecommendationService.retrain_scheduler.register(cache_key, self._model_trainer(cache_key))
+            attached += 1
+
+        logging.getLogger(RecommendationService.__name__).info(f"Warm start attached {attached} persisted models")
+        return attached
+
+    def get_ratings_snapshot(self, user_col: str, item_col: str, rating_col: str):
+        snapshot_key = (user_col, item_col, rating_col)
+
+        def load():
+            # the expired snapshot lets the data layer fetch only rows added since the last load
+            previous = RecommendationService.snapshot_cache.peek(snapshot_key)
+            with Metrics.stage('train', 'load'):
+                return self.data_access.load_ratings_snapshot(user_col, item_col, rating_col,
+                                                              previous.model if previous is not None else None)
+
+        return RecommendationService.snapshot_cache.get_or_train(snapshot_key, load)
+
+    def get_model_registry_stats(self):
+        stats = RecommendationService.model_cache.stats()
+        scheduler = RecommendationService.retrain_scheduler
+        stats["retrain_interval_in_s"] = scheduler.interval_in_s if scheduler is not None else None
+        stats["snapshots"] = RecommendationService.snapshot_cache.stats()
+        if RecommendationService.precomputed_store is not None:
+            stats["precomputed"] = RecommendationService.precomputed_store.stats()
+        return stats
+
+    def _predict_ratings(self, scorer: BatchScorer, user_id, user_col, item_col, rating_col, n=None):
+        try:
+            # candidates come from the snapshot the model was trained on, no extra query per request
+            snapshot = scorer.snapshot
+            user_code = snapshot.user_code(user_id)
+            items_to_predict = None
+            if n is not None and AppConfig.current().ann_enabled:
+                # only the items of the probed index clusters, when the model has an index
+                items_to_predict = scorer.candidate_items(user_code, n, AppConfig.current().ann_n_probe)
+            if items_to_predict is None:
+                items_to_predict = snapshot.items_not_rated_by(user_code)
+
+            # one vectorized pass over all candidates instead of a predict call per item
+            scores = scorer.score(user_code, items_to_predict)
+            return snapshot.item_raw_ids[items_to_predict], scores
 
         except Exception as e:
             logging.getLogger(RecommendationService.__name__).error(f"Error in _predict_ratings: {e}")
             raise RecommendationServiceError(e)
 
-
-
-
+    @staticmethod
+    def collect_metrics():
+        families = []
+        for cache_name, cache in (('models', RecommendationService.model_cache),
+                                  ('snapshots', RecommendationService.snapshot_cache)):
+            stats = cache.stats()
+            families.append(('recommender_cache_requests_total', 'counter', 'Cache lookups by result.',
+                             [({"cache": cache_name, "result": "hit"}, stats["hits"]),
+                              ({"cache": cache_name, "result": "stale_hit"}, stats["stale_hits"]),
+                              ({"cache": cache_name, "result": "miss"}, stats["misses"])]))
+            families.append(('recommender_cache_entries', 'gauge', 'Entries held by a cache.',
+                             [({"cache": cache_name}, stats["size"])]))
+            families.append(('recommender_cache_evictions_total', 'counter', 'Entries evicted from a cache.',
+                             [({"cache": cache_name}, stats["evictions"])]))
+        if RecommendationService.precomputed_store is not None:
+            stats = RecommendationService.precomputed_store.stats()
+            families.append(('recommender_cache_requests_total', 'counter', 'Cache lookups by result.',
+                             [({"cache": "precomputed", "result": "hit"}, stats["hits"]),
+                              ({"cache": "precomputed", "result": "miss"}, stats["misses"])]))
+        return families
+
+
+Metrics.register_collector(RecommendationService.collect_metrics)
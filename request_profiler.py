@@ -0,0 +1,180 @@
+import cProfile
+import functools
+import hmac
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import request
+
+
+class RequestProfilerError(Exception):
+    """Custom exception for request profiler errors."""
+
+
+class RequestProfiler:
+    """
+    Opt-in cProfile of single requests: a request is profiled when it carries the trigger header with the configured
+    token or is picked by the sampling rate; without a token, header triggers and reading profiles are disabled.
+    Each profile is stored as a pstats file plus a JSON file with the request metadata; the directory keeps only
+    the newest max_profiles of them.
+    At most one request per process is profiled at a time, both to bound the overhead and because
+    Python 3.12+ allows a single active profiler. Work handed to other threads, e.g. the parallel adapter calls,
+    is not part of the profile.
+    """
+
+    PROFILE_ID_PATTERN = re.compile(r'^[0-9]+-[0-9]+-[0-9]+-[A-Za-z0-9_]+$')
+    MAX_REQUEST_BODY_LENGTH = 4096
+
+    def __init__(self, directory, sample_rate=0.0, header_name='X-Profile-Request', token='', max_profiles=50):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise RequestProfilerError("Profiling sample rate must be between 0 and 1")
+        if max_profiles <= 0:
+            raise RequestProfilerError("Max profiles must be a positive integer")
+        self.directory = os.path.abspath(directory)
+        self.sample_rate = sample_rate
+        self.header_name = header_name
+        self.token = token
+        self.max_profiles = max_profiles
+        self._active = threading.Lock()
+        self._sequence = itertools.count()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def from_config(app_config):
+        if not app_config.profiling_enabled:
+            return None
+        if not app_config.profiling_token:
+            logging.getLogger(RequestProfiler.__name__).warning(
+                "Profiling token is empty: only sampled requests are profiled and /v1/profiles answers 404")
+        return RequestProfiler(app_config.profiling_directory,
+                               sample_rate=app_config.profiling_sample_rate,
+                               header_name=app_config.profiling_header,
+                               token=app_config.profiling_token,
+                               max_profiles=app_config.profiling_max_profiles)
+
+    def is_authorized(self):
+        """True when the current request carries the configured token in the trigger header; never without a token."""
+        if not self.token:
+            return False
+        return hmac.compare_digest(request.headers.get(self.header_name, ''), self.token)
+
+    def _trigger(self):
+        if request.headers.get(self.header_name) is not None and self.is_authorized():
+            return 'header'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def profile(self, endpoint):
+        """Decorator for a Flask view; unprofiled requests pay for one header lookup."""
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                trigger = self._trigger()
+                if trigger is None or not self._active.acquire(blocking=False):
+                    return view(*args, **kwargs)
+                try:
+                    profiler = cProfile.Profile()
+                    started_at = time.time()
+                    started = time.perf_counter()
+                    profiler.enable()
+                    try:
+                        response = view(*args, **kwargs)
+                    finally:
+                        profiler.disable()
+                        duration_in_s = time.perf_counter() - started
+                    self._save(profiler, endpoint, trigger, started_at, duration_in_s, response)
+                    return response
+                finally:
+                    self._active.release()
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def _status_code(response):
+        # views return a dict, a response, or a (body, status) tuple
+        if isinstance(response, tuple) and len(response) > 1:
+            return response[1]
+        return getattr(response, 'status_code', 200)
+
+    def _save(self, profiler, endpoint, trigger, started_at, duration_in_s, response):
+        profile_id = f"{int(started_at * 1000)}-{os.getpid()}-{next(self._sequence)}-{endpoint}"
+        metadata = {
+            "id": profile_id,
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "request": request.get_data(as_text=True)[:RequestProfiler.MAX_REQUEST_BODY_LENGTH],
+            "trigger": trigger,
+            "status": self._status_code(response),
+            "started_at": started_at,
+            "duration_in_s": round(duration_in_s, 6),
+            "pid": os.getpid(),
+        }
+        try:
+            profile_path = os.path.join(self.directory, f"{profile_id}.prof")
+            profiler.dump_stats(profile_path + '.tmp')
+            os.replace(profile_path + '.tmp', profile_path)
+            # the metadata is written last, a profile is listed only once it is complete
+            metadata_path = os.path.join(self.directory, f"{profile_id}.json")
+            with open(metadata_path + '.tmp', 'w') as metadata_file:
+                json.dump(metadata, metadata_file)
+            os.replace(metadata_path + '.tmp', metadata_path)
+            self._prune()
+        except OSError as e:
+            # profiling must never fail the request it observed
+            logging.getLogger(RequestProfiler.__name__).error(f"Cannot store profile {profile_id}: {e}")
+            return
+        logging.getLogger(RequestProfiler.__name__).info(
+            f"Profiled {request.method} {request.path} ({trigger}) in {duration_in_s:.3f}s as {profile_id}")
+
+    def _metadata_files(self):
+        return [name for name in os.listdir(self.directory) if name.endswith('.json')]
+
+    def _prune(self):
+        # ids start with the start time in ms, so name order is age order across all worker processes
+        for name in sorted(self._metadata_files())[:-self.max_profiles]:
+            profile_id = name[:-len('.json')]
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self):
+        """Metadata of the stored profiles, newest first."""
+        profiles = []
+        for name in sorted(self._metadata_files(), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name)) as metadata_file:
+                    profiles.append(json.load(metadata_file))
+            except (OSError, ValueError):
+                # pruned by another worker meanwhile
+                continue
+        return profiles
+
+    def profile_path(self, profile_id):
+        if not RequestProfiler.PROFILE_ID_PATTERN.match(profile_id):
+            raise RequestProfilerError(f"Invalid profile id '{profile_id}'")
+        path = os.path.join(self.directory, f"{profile_id}.prof")
+        if not os.path.exists(path):
+            raise RequestProfilerError(f"Profile '{profile_id}' not found")
+        return path
+
+    def report(self, profile_id, sort_by='cumulative', limit=50):
+        """The pstats text report of a stored profile, for a look without downloading it."""
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile_path(profile_id), stream=output)
+        stats.sort_stats(sort_by).print_stats(limit)
+        return output.getvalue()
@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+
+class RetrainScheduler:
+    """Daemon thread that refits registered models off the request path and publishes them into a ModelCache."""
+
+    def __init__(self, model_cache, interval_in_s, poll_interval_in_s=1.0):
+        self.model_cache = model_cache
+        self.interval_in_s = interval_in_s
+        self.poll_interval_in_s = min(poll_interval_in_s, interval_in_s)
+        self._trainers = {}
+        self._failed_at = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def register(self, key, train):
+        with self._lock:
+            self._trainers[key] = train
+            if not self.is_running:
+                self._start()
+
+    def unregister(self, key):
+        with self._lock:
+            self._trainers.pop(key, None)
+            self._failed_at.pop(key, None)
+
+    def registered_keys(self):
+        with self._lock:
+            return list(self._trainers.keys())
+
+    def _start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=RetrainScheduler.__name__, daemon=True)
+        self._thread.start()
+        logging.getLogger(RetrainScheduler.__name__).info(f"Started retrain scheduler, interval {self.interval_in_s}s")
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll_interval_in_s):
+            self.retrain_due()
+
+    def retrain_due(self):
+        now = time.time()
+        with self._lock:
+            trainers = list(self._trainers.items())
+
+        for key, train in trainers:
+            entry = self.model_cache.peek(key)
+            if entry is None:
+                # Evicted from the cache: nobody requested it recently, stop refreshing it
+                self.unregister(key)
+                continue
+            last_attempt = max(entry.trained_at, self._failed_at.get(key, 0))
+            if now - last_attempt < self.interval_in_s:
+                continue
+            try:
+                self.model_cache.train_and_publish(key, train)
+                self._failed_at.pop(key, None)
+            except Exception as e:
+                # Keep serving the previous version, retry after another interval
+                self._failed_at[key] = time.time()
+                logging.getLogger(RetrainScheduler.__name__).error(f"Error retraining model {key}: {e}")
@@ -0,0 +1,142 @@
+import importlib
+import logging
+import os
+import threading
+import time
+
+from app_configuration import AppConfig
+
+
+class ServiceWarmupError(Exception):
+    """Custom exception for service warmup errors."""
+
+
+class ServiceWarmup:
+    """
+    Builds the recommendation service off the import path: imports pandas, surprise and SQLAlchemy,
+    opens database connections and attaches or trains the preloaded models, timing every stage.
+    The worker reports ready only after this finished, so the load balancer routes traffic to warm workers only.
+    With warmup disabled the same steps run on the first request that needs the service.
+    """
+
+    def __init__(self, app_config: AppConfig):
+        self.background = app_config.startup_warmup
+        self.preload_models = [tuple(key) for key in app_config.startup_preload_models]
+        self.warm_connections = app_config.startup_warm_connections
+        self.csv_path = app_config.csv_path
+        self.data_source = app_config.data_source
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._service = None
+        self._error = None
+        self._stages = {}
+        self._started_at = None
+        self._finished_at = None
+
+    def start(self):
+        """Starts the background warmup once per process; no-op when warmup is disabled."""
+        if not self.background:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # a warmup thread of the parent process does not exist in a forked worker
+            self._reset()
+            self._thread = threading.Thread(target=self._warm_up, name=ServiceWarmup.__name__, daemon=True)
+            self._thread.start()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._done.clear()
+        self._service = None
+        self._error = None
+        self._stages = {}
+        self._started_at = time.time()
+        self._finished_at = None
+
+    def _stage(self, name, action):
+        started_at = time.perf_counter()
+        result = action()
+        self._stages[name] = round(time.perf_counter() - started_at, 3)
+        logging.getLogger(ServiceWarmup.__name__).info(f"Warmup stage '{name}' took {self._stages[name]}s")
+        return result
+
+    def _warm_up(self):
+        try:
+            recommendation_service = self._stage('import', lambda: importlib.import_module('recommendation_service'))
+            data_access = importlib.import_module('data_access')
+            service = self._stage('build', lambda: recommendation_service.RecommendationService(
+                data_access.DataAccess(self.csv_path)))
+
+            if self.data_source == 'postgres':
+                self._stage('connections', lambda: data_access.DataAccess.warm_up_connection_pool(self.warm_connections))
+
+            def warm_start():
+                try:
+                    service.warm_start()
+                except Exception as e:
+                    # a broken artifact must not keep the worker from booting, models are trained on demand instead
+                    logging.getLogger(ServiceWarmup.__name__).error(f"Warm start failed: {e}")
+
+            self._stage('warm_start', warm_start)
+            for algo, user_col, item_col, rating_col in self.preload_models:
+                try:
+                    self._stage(f"preload {algo}/{user_col}/{item_col}/{rating_col}",
+                                lambda: service.get_trained_model(user_col, item_col, rating_col, algo))
+                except Exception as e:
+                    # the model is trained by its first request instead
+                    logging.getLogger(ServiceWarmup.__name__).error(f"Preloading model {algo} failed: {e}")
+            self._service = service
+        except Exception as e:
+            self._error = e
+            logging.getLogger(ServiceWarmup.__name__).error(f"Warmup failed: {e}")
+        finally:
+            self._finished_at = time.time()
+            self._done.set()
+
+    def recommendation_service(self):
+        """The warmed-up service; waits for a running warmup or, without one, builds the service now."""
+        self.start()
+        if self.background:
+            self._done.wait()
+            if self._service is None:
+                # without a readiness probe nothing else retries, so the request restarts the warmup like a lazy init
+                self.retry()
+                self._done.wait()
+            if self._service is None:
+                raise ServiceWarmupError(f"Service is not available, warmup failed: {self._error}")
+            return self._service
+
+        with self._lock:
+            if self._service is None or self._pid != os.getpid():
+                self._reset()
+                self._warm_up()
+                if self._service is None:
+                    raise ServiceWarmupError(f"Service is not available: {self._error}")
+            return self._service
+
+    def retry(self):
+        """Restarts a failed background warmup, e.g. after the database came back."""
+        with self._lock:
+            if self._done.is_set() and self._service is None:
+                self._pid = None
+        self.start()
+
+    @property
+    def is_ready(self):
+        if not self.background:
+            # lazy mode: serving traffic is what initializes the service
+            return True
+        return self._pid == os.getpid() and self._done.is_set() and self._service is not None
+
+    def status(self):
+        return {
+            "mode": "warmup" if self.background else "lazy",
+            "ready": self.is_ready,
+            "started_at": self._started_at,
+            "finished_at": self._finished_at,
+            "stages_in_s": dict(self._stages),
+            "error": str(self._error) if self._error is not None else None,
+        }
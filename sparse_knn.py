@@ -0,0 +1,140 @@
+import logging
+
+import numpy as np
+import scipy.sparse as sp
+
+from ratings_snapshot import RatingsSnapshot
+
+
+class SparseKNNError(Exception):
+    """Custom exception for sparse KNN errors."""
+
+
+class SparseKNN:
+    """
+    User based KNN that keeps only the n_neighbors most similar users of every user instead of a dense n x n matrix.
+    Similarities are computed block by block with sparse products, so memory is O(n_users * n_neighbors).
+    Similarities are bit-identical to surprise's (msd, cosine) for integer ratings. When n_neighbors covers every
+    co-rating user, unrated items are predicted exactly like KNNBasic with the same k and min_k; a smaller
+    n_neighbors drops the least similar users (ties at the cut lose the higher user codes), so predictions differ.
+    """
+
+    SIMILARITIES = ('msd', 'cosine')
+
+    def __init__(self, k=40, min_k=1, n_neighbors=200, block_size=1024, sim_options=None, rating_scale=(1, 5)):
+        sim_options = sim_options or {}
+        self.rating_scale = rating_scale
+        self.k = k
+        self.min_k = min_k
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.sim_name = sim_options.get('name', 'msd').lower()
+        self.min_support = sim_options.get('min_support', 1)
+        if self.sim_name not in SparseKNN.SIMILARITIES:
+            raise SparseKNNError(f"Unsupported similarity '{self.sim_name}', expected one of {SparseKNN.SIMILARITIES}")
+        if n_neighbors <= 0 or block_size <= 0:
+            raise SparseKNNError("n_neighbors and block_size must be positive integers")
+
+        self.global_mean = None
+        self.neighbor_indptr = None
+        self.neighbor_ids = None
+        self.neighbor_sims = None
+
+    def fit(self, snapshot: RatingsSnapshot):
+        n_users, n_items = snapshot.n_users, snapshot.n_items
+        rows, cols = snapshot.user_codes, snapshot.item_codes
+        ratings = snapshot.ratings.astype(np.float64)
+
+        # duplicate (user, item) ratings are summed, which keeps every pair of duplicate ratings
+        # in the pairwise sums exactly like surprise iterates over them
+        def user_item_matrix(values):
+            return sp.csr_matrix((values, (rows, cols)), shape=(n_users, n_items))
+
+        counts = user_item_matrix(np.ones(len(ratings)))
+        sums = user_item_matrix(ratings)
+        squares = user_item_matrix(ratings ** 2)
+        counts_t, sums_t, squares_t = counts.T.tocsr(), sums.T.tocsr(), squares.T.tocsr()
+
+        indptr = np.zeros(n_users + 1, dtype=np.int64)
+        ids_blocks, sims_blocks = [], []
+        for block_start in range(0, n_users, self.block_size):
+            block = slice(block_start, min(block_start + self.block_size, n_users))
+            freq = (counts[block] @ counts_t).tocsr()
+            if self.sim_name == 'msd':
+                # sum over common items of (r_a - r_b)^2, expanded into sparse products
+                sq_diff = squares[block] @ counts_t - 2 * (sums[block] @ sums_t) + counts[block] @ squares_t
+                sim = self._msd(freq, sq_diff)
+            else:
+                sim = self._cosine(freq, sums[block] @ sums_t, squares[block] @ counts_t, counts[block] @ squares_t)
+            block_ids, block_sims, block_counts = self._top_neighbors(sim, block_start)
+            ids_blocks.append(block_ids)
+            sims_blocks.append(block_sims)
+            indptr[block.start + 1:block.stop + 1] = block_counts
+
+        np.cumsum(indptr, out=indptr)
+        self.neighbor_indptr = indptr
+        self.neighbor_ids = np.concatenate(ids_blocks) if ids_blocks else np.empty(0, dtype=np.int32)
+        self.neighbor_sims = np.concatenate(sims_blocks) if sims_blocks else np.empty(0, dtype=np.float64)
+        self.global_mean = float(np.mean(ratings)) if len(ratings) else 0.0
+        logging.getLogger(SparseKNN.__name__).info(
+            f"Computed {len(self.neighbor_ids)} {self.sim_name} neighbors for {n_users} users")
+        return self
+
+    @staticmethod
+    def _values_at(matrix, pattern):
+        # entries of matrix at the stored positions of pattern, in pattern.data order
+        rows = np.repeat(np.arange(pattern.shape[0]), np.diff(pattern.indptr))
+        return np.asarray(matrix.tocsr()[rows, pattern.indices]).ravel()
+
+    def _msd(self, freq, sq_diff):
+        freq = freq.tocsr()
+        freq.sum_duplicates()
+        # surprise's expression to the last bit, 1 / (msd + 1) rounds differently and reorders tied neighbors
+        sq_diff = np.maximum(self._values_at(sq_diff, freq), 0)
+        sim = sp.csr_matrix((1 / (sq_diff / freq.data + 1), freq.indices, freq.indptr), shape=freq.shape)
+        return self._apply_min_support(sim, freq)
+
+    def _cosine(self, freq, prods, sq_i, sq_j):
+        freq = freq.tocsr()
+        freq.sum_duplicates()
+        # prods / sqrt(sq_i * sq_j) like surprise, not a product with the reciprocal
+        denominator = np.sqrt(self._values_at(sq_i, freq) * self._values_at(sq_j, freq))
+        values = np.divide(self._values_at(prods, freq), denominator, out=np.zeros(len(denominator)),
+                           where=denominator > 0)
+        sim = sp.csr_matrix((values, freq.indices, freq.indptr), shape=freq.shape)
+        return self._apply_min_support(sim, freq)
+
+    def _apply_min_support(self, sim, freq):
+        if self.min_support > 1:
+            sim = sim.multiply(freq >= self.min_support).tocsr()
+        sim.eliminate_zeros()
+        return sim
+
+    def _top_neighbors(self, sim, row_offset):
+        sim = sim.tocsr()
+        sim.sort_indices()
+        n_rows = sim.shape[0]
+        block_rows = np.repeat(np.arange(n_rows, dtype=np.int32), np.diff(sim.indptr))
+        block_cols, block_sims = sim.indices.astype(np.int32), sim.data
+        not_self = block_cols != block_rows + row_offset
+        block_rows, block_cols, block_sims = block_rows[not_self], block_cols[not_self], block_sims[not_self]
+        row_counts = np.bincount(block_rows, minlength=n_rows)
+
+        # only rows with more candidates than n_neighbors need ordering; within a row entries are already
+        # sorted by user code, so two stable sorts give (row, similarity desc, user code) like a full lexsort
+        crowded_counts = np.where(row_counts > self.n_neighbors, row_counts, 0)
+        crowded = np.repeat(crowded_counts > 0, row_counts)
+        keep = ~crowded
+        if crowded.any():
+            positions = np.flatnonzero(crowded)
+            order = positions[np.argsort(-block_sims[positions], kind='stable')]
+            order = order[np.argsort(block_rows[order], kind='stable')]
+            crowded_starts = np.cumsum(crowded_counts) - crowded_counts
+            ranks = np.arange(len(order)) - np.repeat(crowded_starts, crowded_counts)
+            keep[order[ranks < self.n_neighbors]] = True
+        # kept neighbors of a crowded row stay in user code order, which the scorer does not depend on
+        return block_cols[keep], block_sims[keep], np.minimum(row_counts, self.n_neighbors)
+
+    def neighbors_of(self, user_code):
+        start, end = self.neighbor_indptr[user_code], self.neighbor_indptr[user_code + 1]
+        return self.neighbor_ids[start:end], self.neighbor_sims[start:end]
@@ -0,0 +1,234 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class UpdateQueueError(Exception):
+    """Custom exception for update queue errors."""
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of karma results that a daemon thread posts to the adapter's batch update-info URL.
+    Batches are retried with backoff; batches that still fail, and everything left in the queue at shutdown,
+    are appended to a spill file that is replayed into the queue the next time a process starts it.
+    """
+
+    def __init__(self, adapter_client, batch_url, max_size=10000, batch_size=200, flush_interval_in_s=1.0,
+                 max_retries=3, retry_backoff_in_s=0.5, spill_path=None, shutdown_timeout_in_s=5.0):
+        self.adapter_client = adapter_client
+        self.batch_url = batch_url
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval_in_s = flush_interval_in_s
+        self.max_retries = max_retries
+        self.retry_backoff_in_s = retry_backoff_in_s
+        self.spill_path = spill_path
+        self.shutdown_timeout_in_s = shutdown_timeout_in_s
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._rejected = 0
+        self._flushed = 0
+        self._flushes = 0
+        self._failed_flushes = 0
+        self._spilled = 0
+        self._replayed = 0
+        self._flush_latency_sum_in_s = 0.0
+        self._flush_latency_max_in_s = 0.0
+        self._last_flush_latency_in_s = None
+
+    @staticmethod
+    def from_config(app_config, adapter_client):
+        if not app_config.write_behind_enabled:
+            return None
+        return WriteBehindQueue(adapter_client, app_config.update_userinfo_batch_url,
+                                max_size=app_config.write_behind_max_queue_size,
+                                batch_size=app_config.write_behind_batch_size,
+                                flush_interval_in_s=app_config.write_behind_flush_interval_in_s,
+                                max_retries=app_config.write_behind_max_retries,
+                                spill_path=app_config.write_behind_spill_file)
+
+    @property
+    def is_running(self):
+        # a thread started before a fork does not exist in the child, e.g. with gunicorn --preload
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def _ensure_started(self):
+        if self.is_running:
+            return
+        with self._lock:
+            if self.is_running or self._stop_event.is_set():
+                return
+            self._pid = os.getpid()
+            self._replay_spill()
+            self._thread = threading.Thread(target=self._run, name=WriteBehindQueue.__name__, daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
+            logging.getLogger(WriteBehindQueue.__name__).info(
+                f"Started write-behind queue for {self.batch_url}, max size {self.max_size}")
+
+    def offer(self, record):
+        """Queues one update; False when the queue is full or shut down and the caller has to send it itself."""
+        self._ensure_started()
+        if self._stop_event.is_set():
+            self._count('_rejected')
+            return False
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._count('_rejected')
+            return False
+        self._count('_enqueued')
+        return True
+
+    def _count(self, counter, value=1):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._take_batch(self.flush_interval_in_s)
+            if batch and not self._flush(batch, self.max_retries):
+                self._spill(batch)
+
+    def _take_batch(self, timeout):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch, max_retries):
+        for attempt in range(max_retries + 1):
+            started_at = time.perf_counter()
+            try:
+                response = self.adapter_client.post(self.batch_url, json=batch, endpoint='update-info/batch')
+                if response.status_code == 200:
+                    self._record_flush(len(batch), time.perf_counter() - started_at)
+                    return True
+                error = f"status {response.status_code}"
+            except Exception as e:
+                error = e
+            self._count('_failed_flushes')
+            logging.getLogger(WriteBehindQueue.__name__).warning(
+                f"Flushing {len(batch)} karma updates failed (attempt {attempt + 1}): {error}")
+            if attempt < max_retries and self._stop_event.wait(self.retry_backoff_in_s * (2 ** attempt)):
+                # shutting down: leave the batch to the spill file instead of waiting
+                return False
+        return False
+
+    def _record_flush(self, size, latency_in_s):
+        with self._stats_lock:
+            self._flushes += 1
+            self._flushed += size
+            self._flush_latency_sum_in_s += latency_in_s
+            self._flush_latency_max_in_s = max(self._flush_latency_max_in_s, latency_in_s)
+            self._last_flush_latency_in_s = latency_in_s
+
+    def _drain(self):
+        records = []
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                return records
+
+    def shutdown(self):
+        """Stops the worker, makes a last attempt to send what is queued and spills the rest."""
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.shutdown_timeout_in_s)
+
+        records = self._drain()
+        deadline = time.monotonic() + self.shutdown_timeout_in_s
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            if time.monotonic() >= deadline or not self._flush(batch, 0):
+                self._spill(batch)
+
+    def _spill(self, records):
+        if not self.spill_path:
+            logging.getLogger(WriteBehindQueue.__name__).error(f"Lost {len(records)} karma updates, no spill file configured")
+            return
+        try:
+            with open(self.spill_path, 'a') as spill_file:
+                fcntl.flock(spill_file, fcntl.LOCK_EX)
+                try:
+                    for record in records:
+                        spill_file.write(json.dumps(record) + '\n')
+                    spill_file.flush()
+                    os.fsync(spill_file.fileno())
+                finally:
+                    fcntl.flock(spill_file, fcntl.LOCK_UN)
+        except OSError as e:
+            logging.getLogger(WriteBehindQueue.__name__).error(f"Lost {len(records)} karma updates, cannot spill: {e}")
+            return
+        self._count('_spilled', len(records))
+        logging.getLogger(WriteBehindQueue.__name__).warning(f"Spilled {len(records)} karma updates to {self.spill_path}")
+
+    def _replay_spill(self):
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        try:
+            with open(self.spill_path, 'r+') as spill_file:
+                # every worker process replays, the lock makes sure each record is claimed by one of them
+                fcntl.flock(spill_file, fcntl.LOCK_EX)
+                try:
+                    records = [json.loads(line) for line in spill_file if line.strip()]
+                    remaining = []
+                    for record in records:
+                        try:
+                            self._queue.put_nowait(record)
+                        except queue.Full:
+                            remaining.append(record)
+                    spill_file.seek(0)
+                    spill_file.truncate()
+                    for record in remaining:
+                        spill_file.write(json.dumps(record) + '\n')
+                finally:
+                    fcntl.flock(spill_file, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            logging.getLogger(WriteBehindQueue.__name__).error(f"Cannot replay spilled karma updates: {e}")
+            return
+        self._count('_replayed', len(records) - len(remaining))
+        if records:
+            logging.getLogger(WriteBehindQueue.__name__).info(
+                f"Replaying {len(records) - len(remaining)} spilled karma updates")
+
+    def stats(self):
+        with self._stats_lock:
+            flushes = self._flushes
+            return {
+                "running": self.is_running,
+                "depth": self._queue.qsize(),
+                "max_size": self.max_size,
+                "enqueued": self._enqueued,
+                "rejected": self._rejected,
+                "flushed": self._flushed,
+                "flushes": flushes,
+                "failed_flushes": self._failed_flushes,
+                "spilled": self._spilled,
+                "replayed": self._replayed,
+                "flush_latency_avg_in_s": self._flush_latency_sum_in_s / flushes if flushes else None,
+                "flush_latency_max_in_s": self._flush_latency_max_in_s if flushes else None,
+                "last_flush_latency_in_s": self._last_flush_latency_in_s,
+            }